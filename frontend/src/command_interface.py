@@ -5,9 +5,14 @@ import threading
 import time
 import os
 import pika
+from router import router
 
 confirms_recv = 0
 
+# Web commands are interactive, they are delivered ahead of bulk workload commands
+# (manager/src/priority.py). The ingress time is used for the latency metrics.
+INTERACTIVE_PRIORITY = 5
+
 
 def send_command(requested_command):
     """Send commands to the backend.
@@ -38,11 +43,16 @@ def send_command(requested_command):
         queue=queue_name
     )
 
+    exchange, routing_key = router.route(requested_command)
+    if exchange != os.environ["FRONTEND_EXCHANGE"]:
+        publisher_channel.exchange_declare(exchange=exchange)
+        router.sent()
+
     publisher_channel.basic_publish(
-        exchange=os.environ["FRONTEND_EXCHANGE"],
-        routing_key="frontend",
+        exchange=exchange,
+        routing_key=routing_key,
         body=requested_command,
-        properties=pika.BasicProperties(),
+        properties=pika.BasicProperties(priority=INTERACTIVE_PRIORITY, headers={'ingress': time.time()}),
         mandatory=True
     )
 
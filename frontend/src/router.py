@@ -0,0 +1,74 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import redis
+
+# Published by the manager when it runs with ROUTING_MODE=direct (manager/src/routing.py).
+RING_KEY = 'routing:ring'
+SENT_KEY = 'routing:sent'
+
+
+class Router():
+    ''' Picks where a command is published. With a ring published by the manager,
+    commands go straight to the worker queue of their user. Otherwise, and for
+    DUMPLOG (which needs the manager's barrier), they go to the frontend exchange.
+    '''
+    REFRESH_PERIOD = 5.0 # Seconds between reads of the ring
+
+    def __init__(self, redis_cache, frontend_exchange, frontend_route="frontend"):
+        self.redis_cache = redis_cache
+        self.frontend = (frontend_exchange, frontend_route)
+
+        self._mutex = threading.Lock()
+        self._ring = None
+        self._routes = {} # uid -> (exchange, route key) for the current ring
+        self._next_refresh = 0.0
+
+    def ring(self):
+        with self._mutex:
+            if time.time() >= self._next_refresh:
+                self._next_refresh = time.time() + self.REFRESH_PERIOD
+                try:
+                    ring = self.redis_cache.get(RING_KEY)
+                    ring = json.loads(ring) if ring else None
+                except (redis.RedisError, ValueError) as e:
+                    print(f"Could not read the routing ring, using the frontend exchange: {e}")
+                    ring = None
+
+                if ring is None or self._ring is None or ring['version'] != self._ring['version']:
+                    self._routes = {}
+                self._ring = ring
+            return self._ring
+
+    def route(self, command: str) -> tuple:
+        ''' Returns (exchange, routing key) for the command. '''
+        ring = self.ring()
+        tokens = command.split(',')
+        if ring is None or 'DUMPLOG' in tokens[0] or len(tokens) < 2:
+            return self.frontend
+
+        uid = tokens[1].strip()
+        route = self._routes.get(uid)
+        if route is None:
+            route = (ring['exchange'], ring['route_keys'][calculate_worker_index(uid, len(ring['route_keys']))])
+            self._routes[uid] = route
+        return route
+
+    def sent(self, count=1):
+        ''' Counts commands published to the worker queues, the manager's DUMPLOG barrier waits for their confirms. '''
+        self.redis_cache.incrby(SENT_KEY, count)
+
+
+def calculate_worker_index(uid: str, NUM_WORKERS: int):
+    ''' Same hashing the manager uses to route a user to a worker. '''
+    worker_index = hashlib.sha256(uid.encode('utf-8')).digest()
+    worker_index = int.from_bytes(worker_index, byteorder='big', signed=False) % NUM_WORKERS
+    return worker_index
+
+
+router = Router(
+    redis_cache=redis.Redis(host=os.environ.get("REDIS_HOST", "redishost")),
+    frontend_exchange=os.environ["FRONTEND_EXCHANGE"]
+)
@@ -4,6 +4,24 @@ import signal
 import pika
 import os
 import gzip
+import io
+import time
+import queue
+import threading
+import zlib
+import json
+import hashlib
+from collections import deque
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import redis
+except ImportError:
+    redis = None
 
 ''' CLI flags. For normal user based input command testing no flags
 are needed. To test a workload file, specify it with the -f flag.
@@ -21,7 +39,7 @@ parser.add_argument('-p', '--port',
 )
 parser.add_argument('-f', '--file',
     dest='filename',
-    help='Workload file to be sent to backend',
+    help='Workload file to be sent to backend (plain, .gz or .zst)',
     metavar='FILE'
 )
 parser.add_argument('-v', '--verbose',
@@ -36,6 +54,38 @@ parser.add_argument('--exchange',
     dest='exchange', default='frontend_exchange',
     help='Rabbit queue exchange'
 )
+parser.add_argument('--connections',
+    dest='connections', type=int, default=4,
+    help='Number of parallel publisher connections used for workload files'
+)
+parser.add_argument('--rate',
+    dest='rate', type=float, default=0,
+    help='Maximum commands sent per second for workload files (0 for no limit)'
+)
+parser.add_argument('--batch',
+    dest='batch_size', type=int, default=500,
+    help='Number of commands published per batch'
+)
+parser.add_argument('--max-unconfirmed',
+    dest='max_unconfirmed', type=int, default=10000,
+    help='Maximum number of unconfirmed commands per publisher connection'
+)
+parser.add_argument('--direct',
+    action='store_true', dest='direct', default=False,
+    help='Publish commands straight to the worker queues using the ring the manager publishes in Redis (ROUTING_MODE=direct)'
+)
+parser.add_argument('--redis-address',
+    dest='redis_address', default=None,
+    help='Redis address for --direct (defaults to --address)'
+)
+parser.add_argument('--redis-port',
+    dest='redis_port', type=int, default=6379,
+    help='Redis port for --direct'
+)
+parser.add_argument('--read-buffer',
+    dest='read_buffer', type=int, default=1 << 20,
+    help='Read buffer size in bytes for workload files'
+)
 args=parser.parse_args()
 
 
@@ -49,25 +99,329 @@ connection = pika.BlockingConnection(
 channel = connection.channel()
 channel.exchange_declare(exchange=args.exchange)
 
+# Workload commands are bulk, typed commands are interactive and delivered ahead of them
+# (manager/src/priority.py). Every message of a batch shares one properties instance
+# with the batch's ingress time, which the workers use for latency metrics.
+BULK_PRIORITY = 0
+INTERACTIVE_PRIORITY = 5
+
+def bulk_properties():
+    return pika.BasicProperties(priority=BULK_PRIORITY, headers={'ingress': time.time()})
+
+
+class Ring():
+    ''' Worker routes published by the manager in direct routing mode (manager/src/routing.py).
+    A user's commands go to route_keys[sha256(uid) % len(route_keys)], like the manager's balancer.
+    The ring is read once, so it shouldn't change while a workload is sent.
+    '''
+    RING_KEY = 'routing:ring'
+    SENT_KEY = 'routing:sent'
+
+    def __init__(self, redis_cache):
+        self.redis_cache = redis_cache
+        ring = redis_cache.get(self.RING_KEY)
+        if not ring:
+            raise RuntimeError("No routing ring in Redis, is the manager running with ROUTING_MODE=direct?")
+        ring = json.loads(ring)
+        self.version = ring['version']
+        self.exchange = ring['exchange']
+        self.route_keys = ring['route_keys']
+        self._routes = {} # uid -> route key
+
+    def route(self, uid: bytes) -> str:
+        route_key = self._routes.get(uid)
+        if route_key is None:
+            worker_index = int.from_bytes(hashlib.sha256(uid).digest(), byteorder='big', signed=False) % len(self.route_keys)
+            route_key = self.route_keys[worker_index]
+            self._routes[uid] = route_key
+        return route_key
+
+    def sent(self, count):
+        ''' The manager's DUMPLOG barrier waits for this many confirms. '''
+        self.redis_cache.incrby(self.SENT_KEY, count)
+
+
+ring = None
+if args.direct:
+    if redis is None:
+        print("The redis package is needed for --direct")
+        sys.exit(1)
+    ring = Ring(redis.Redis(host=args.redis_address or args.address, port=args.redis_port))
+    channel.exchange_declare(exchange=ring.exchange)
+    print(f"Direct routing to {len(ring.route_keys)} workers (ring version {ring.version})")
+
+
+class TokenBucket():
+    ''' Limits the number of commands sent per second across all publishers.
+    Publishers send at most burst commands at a time, after waiting for their tokens.
+    '''
+
+    def __init__(self, rate, burst):
+        self._rate = rate
+        self.burst = max(1, int(burst))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._mutex = threading.Lock()
+
+    def acquire(self, n) -> float:
+        ''' Takes n tokens. Returns the number of seconds to wait before sending. '''
+        if self._rate <= 0:
+            return 0.0
+
+        with self._mutex:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            self._tokens -= n
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self._rate
+
+
+class WorkloadPublisher(threading.Thread):
+    ''' Publishes batches of commands on its own confirm-enabled connection.
+    Batches of (routing key, command) are read from a queue, a None batch means
+    the workload is finished.
+    '''
+    IDLE_WAIT = 0.005 # Seconds
+
+    def __init__(self, batches, rate_limiter, max_unconfirmed):
+        threading.Thread.__init__(self)
+        self.batches = batches
+        self.rate_limiter = rate_limiter
+        self.max_unconfirmed = max_unconfirmed
+
+        self._connection = None
+        self._channel = None
+        self._finished = False
+        self._closing = False
+        self._delivery_tag = 0
+        self._unconfirmed = deque()
+        self._chunks = deque() # The current batch, split to the rate limiter's burst
+
+        self.sent = 0
+        self.acked = 0
+        self.nacked = 0
+        self.error = None # Why the connection failed, None if it didn't
+
+    def run(self):
+        self._connection = pika.SelectConnection(
+            parameters=pika.ConnectionParameters(host=args.address, heartbeat=600),
+            on_open_callback=self.on_connection_open,
+            on_open_error_callback=self.on_connection_open_error,
+            on_close_callback=self.on_connection_closed
+        )
+        self._connection.ioloop.start()
+
+    def on_connection_open_error(self, _unused_connection, err):
+        print(f'Publisher connection open failed: {err}')
+        self.error = err
+        self._connection.ioloop.stop()
+
+    def on_connection_closed(self, _unused_connection, reason):
+        if not self._closing:
+            print(f'Publisher connection closed: {reason}')
+            sys.stdout.flush()
+            self.error = reason
+        self._connection.ioloop.stop()
+
+    def close(self):
+        self._closing = True
+        self._connection.close()
+
+    def on_connection_open(self, _unused_connection):
+        self._connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_channel_open(self, channel):
+        self._channel = channel
+        self._channel.confirm_delivery(self.on_delivery_confirmation)
+        self.publish_batch()
+
+    def on_delivery_confirmation(self, method_frame):
+        confirmation_type = method_frame.method.NAME.split('.')[1].lower()
+        delivery_tag = method_frame.method.delivery_tag
+
+        confirmed = 0
+        if method_frame.method.multiple:
+            while self._unconfirmed and self._unconfirmed[0] <= delivery_tag:
+                self._unconfirmed.popleft()
+                confirmed += 1
+        else:
+            self._unconfirmed.remove(delivery_tag)
+            confirmed = 1
+
+        if confirmation_type == 'ack':
+            self.acked += confirmed
+        else:
+            self.nacked += confirmed
+
+        if self._finished and not self._unconfirmed:
+            self.close()
+
+    def publish_batch(self):
+        if self._finished:
+            return
+
+        # Wait for confirms when too many commands are in flight.
+        if len(self._unconfirmed) >= self.max_unconfirmed:
+            self._connection.ioloop.call_later(self.IDLE_WAIT, self.publish_batch)
+            return
+
+        if not self._chunks:
+            try:
+                batch = self.batches.get_nowait()
+            except queue.Empty:
+                self._connection.ioloop.call_later(self.IDLE_WAIT, self.publish_batch)
+                return
+
+            if batch is None:
+                self._finished = True
+                if not self._unconfirmed:
+                    self.close()
+                return
+
+            size = self.rate_limiter.burst
+            self._chunks.extend(batch[i:i + size] for i in range(0, len(batch), size))
+
+        # The chunk waits for its tokens, so the rate holds at any batch size.
+        chunk = self._chunks.popleft()
+        wait = self.rate_limiter.acquire(len(chunk))
+        self._connection.ioloop.call_later(wait, lambda: self.publish(chunk))
+
+    def publish(self, chunk):
+        if ring is not None:
+            ring.sent(len(chunk))
+        exchange = ring.exchange if ring is not None else args.exchange
+        properties = bulk_properties()
+        for routing_key, line in chunk:
+            self._channel.basic_publish(
+                exchange=exchange,
+                routing_key=routing_key,
+                body=line,
+                properties=properties
+            )
+            self._delivery_tag += 1
+            self._unconfirmed.append(self._delivery_tag)
+        self.sent += len(chunk)
+
+        self.publish_batch()
+
+
+def open_workload(filename):
+    ''' Opens a plain, gzip or zstd workload file as a buffered binary stream. '''
+    _, file_extension = os.path.splitext(filename)
+    raw = open(filename, 'rb', buffering=args.read_buffer)
+
+    if file_extension == '.gz':
+        return io.BufferedReader(gzip.GzipFile(fileobj=raw), buffer_size=args.read_buffer)
+    elif file_extension in ('.zst', '.zstd'):
+        if zstandard is None:
+            print("The zstandard package is needed to read .zst workload files")
+            sys.exit(1)
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw), buffer_size=args.read_buffer)
+
+    return raw
+
+def print_rates(publishers, start, prev_sent, prev_acked, period) -> tuple:
+    sent = sum(p.sent for p in publishers)
+    acked = sum(p.acked for p in publishers)
+    nacked = sum(p.nacked for p in publishers)
+    print("Sent: {:>10} | Acked: {:>10} | Nacked: {:>6} | Sent/s: {:>10.1f} | Acked/s: {:>10.1f} | Elapsed: {:>8.1f}s".format(
+        sent, acked, nacked, (sent-prev_sent)/period, (acked-prev_acked)/period, time.time()-start)
+    )
+    sys.stdout.flush()
+    return sent, acked
+
+def hand_off(publisher, batch):
+    ''' Queues a batch for a publisher. Dropped if the publisher's connection failed. '''
+    while publisher.error is None:
+        try:
+            publisher.batches.put(batch, timeout=1.0)
+            return
+        except queue.Full:
+            pass
+
 ''' Sends file specified in params to the backend server.
-Exits once finished.
+Commands are sharded by user over parallel publisher connections so each
+user's commands stay in order. DUMPLOG is sent last (always through the
+manager), once every other command has been confirmed. Exits once finished,
+with status 1 if a publisher connection failed.
 '''
 def send_workload() -> None:
-    temp, file_extension = os.path.splitext(args.filename)
-
-    if(file_extension == '.gz'):
-        f = gzip.open(args.filename)
-        print("TODO: Implement reading from gzip file")
-
-    else:
-        f = open(args.filename, 'r')
-        for l in f:
-            channel.basic_publish(
-                exchange=args.exchange,
-                routing_key=args.route_key,
-                body=l,
-                properties=pika.BasicProperties()
-            )
+    # Bursts of up to a second's worth of commands, and no more than a batch.
+    burst = min(args.rate, args.batch_size) if args.rate > 0 else args.batch_size
+    rate_limiter = TokenBucket(rate=args.rate, burst=burst)
+    publishers = []
+    pending = []
+    for _ in range(args.connections):
+        publishers.append(WorkloadPublisher(
+            batches=queue.Queue(maxsize=64),
+            rate_limiter=rate_limiter,
+            max_unconfirmed=args.max_unconfirmed
+        ))
+        pending.append([])
+
+    start = time.time()
+    for p in publishers:
+        p.start()
+
+    # Report rates while the file is being read.
+    reporting = threading.Event()
+    def report():
+        prev_sent, prev_acked = 0, 0
+        while not reporting.wait(1.0):
+            prev_sent, prev_acked = print_rates(publishers, start, prev_sent, prev_acked, 1.0)
+    t_report = threading.Thread(target=report)
+    t_report.setDaemon(True)
+    t_report.start()
+
+    dumplogs = []
+    with open_workload(args.filename) as f:
+        for line in f:
+            tokens = line.split(b',', 2)
+            if b'DUMPLOG' in tokens[0]:
+                dumplogs.append(line)
+                continue
+
+            uid = tokens[1].strip() if len(tokens) > 1 else b''
+            index = zlib.crc32(uid) % args.connections
+            pending[index].append((ring.route(uid) if ring is not None else args.route_key, line))
+            if len(pending[index]) >= args.batch_size:
+                hand_off(publishers[index], pending[index])
+                pending[index] = []
+
+    for index, p in enumerate(publishers):
+        if pending[index]:
+            hand_off(p, pending[index])
+        hand_off(p, None)
+
+    for p in publishers:
+        p.join()
+
+    reporting.set()
+    t_report.join()
+    print_rates(publishers, start, 0, 0, max(time.time()-start, 1e-9))
+
+    failed = [p for p in publishers if p.error is not None]
+    for p in failed:
+        print(f"Publisher connection failed after sending {p.sent} commands ({p.sent - p.acked - p.nacked} unconfirmed): {p.error}")
+    if failed:
+        # The dump would be missing commands (and in direct mode wait for confirms that never come).
+        print(f"Not sending {len(dumplogs)} DUMPLOG commands, {len(failed)} of {len(publishers)} publisher connections failed")
+        sys.exit(1)
+
+    for line in dumplogs:
+        channel.basic_publish(
+            exchange=args.exchange,
+            routing_key=args.route_key,
+            body=line,
+            properties=bulk_properties()
+        )
+
+    elapsed = time.time() - start
+    sent = sum(p.sent for p in publishers) + len(dumplogs)
+    acked = sum(p.acked for p in publishers)
+    print(f"Finished sending {sent} commands in {elapsed:.2f}s ({sent/max(elapsed, 1e-9):.1f} commands/s), {acked} acked")
 
 ''' Keeps application alive and listening for user inputs.
 Inputs ending with a newline are sent to the Rabbitmq container.
@@ -77,11 +431,17 @@ def send_user_input() -> None:
     while True:
         user_input = input('Enter Command: ')
 
+        exchange, routing_key = args.exchange, args.route_key
+        tokens = user_input.split(',')
+        if ring is not None and 'DUMPLOG' not in tokens[0] and len(tokens) > 1:
+            exchange, routing_key = ring.exchange, ring.route(tokens[1].strip().encode('utf-8'))
+            ring.sent(1)
+
         channel.basic_publish(
-            exchange=args.exchange,
-            routing_key=args.route_key,
+            exchange=exchange,
+            routing_key=routing_key,
             body=user_input,
-            properties=pika.BasicProperties()
+            properties=pika.BasicProperties(priority=INTERACTIVE_PRIORITY, headers={'ingress': time.time()})
         )
 
 if __name__=='__main__':
@@ -93,4 +453,4 @@ if __name__=='__main__':
     except KeyboardInterrupt:
         pass
     finally:
-        connection.close()
\ No newline at end of file
+        connection.close()
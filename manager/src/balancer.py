@@ -1,22 +1,33 @@
 import threading
 from parser import Command, parse_command
 from publisher import Publisher
+from transport import LocalPublisher
 from threading import Thread, Timer, Lock
-from dataclassesfile import ThreadCommunication
+from ring_buffer import RingBuffer
+from quote_prefetch import QuotePrefetcher, QUOTE_PREFETCH
+import routing
+from routing import ROUTING_MODE
+from credits import CreditTracker, MAX_BACKLOG
+from priority import WeightedFairQueue, lane_of, INTERACTIVE, BULK, BULK_PRIORITY
+from barrier import DumplogBarrier, BarrierStats
+from collections import deque
 import time
 import os
 import pika
+import redis
 import sys
 import random
 import hashlib
 from functools import wraps
 
 class Balancer():
-    def __init__(self, workers, communication, runtime_data):
+    PUBLISH_BUFFER = 100000
+    CREDIT_WAIT = 0.05 # Seconds to wait for credits when commands are held back
+
+    def __init__(self, workers, communication, runtime_data, broker=None):
         self.workers = workers
         self._NUM_WORKERS = len(workers)
         self.communication = communication
-        self._send_buffer = None
 
         self._print_status_timer = None
         self._total_commands_seen = 0
@@ -24,29 +35,69 @@ class Balancer():
         self._prev_active_commands = 0
         self._PRINT_PERIOD = 10.0 # Seconds
 
-        self._send_address = "rabbitmq"
+        self._send_address = os.environ.get("RABBITMQ_HOST", "rabbitmq")
+        self.broker = broker # LocalBroker when running in one process, RabbitMQ otherwise
         self.publish_communication = None
         self.publisher = None
         self.t_publisher = None
+        self.prefetcher = None
+        self.redis_cache = None
+        self._sent_base = 0 # Commands counted in routing:sent before this manager started.
+        self.credits = None
+        self.pending = [WeightedFairQueue() for _ in workers] # (message, properties, arrival) waiting for their worker's credits, per priority lane
+        self._held = 0
+        self.routed = [0 for _ in workers] # Arrival number of the last command routed to each worker
+        self.seq = [0 for _ in workers] # Sequence number of the last command sent to each worker
+        self.seq_base = [0 for _ in workers] # Last sequence number sent to each worker's previous session
+        self._restarts = [0 for _ in workers] # Worker restarts seen when seq_base was last set
+        self.barriers = deque() # DUMPLOGs waiting for the workers' applied watermarks, oldest first
+        self.dumplogs = deque() # Direct routing: (message, properties) of DUMPLOGs waiting for every confirm
+        self.barrier_stats = BarrierStats()
 
     ''' Connects to frontend and backend rabbit queue
     and then begins listening for incoming commands. 
     '''
     def setup(self):
-        self.publish_communication = ThreadCommunication(
-            buffer = [],
-            length=0,
-            mutex=Lock()
-        )
+        self.publish_communication = RingBuffer(capacity=self.PUBLISH_BUFFER)
 
-        self.publisher = Publisher(
-            connection_param=self._send_address,
-            exchange_name=os.environ["BACKEND_EXCHANGE"],
-            communication = self.publish_communication
-        )
+        if self.broker is not None:
+            self.publisher = LocalPublisher(
+                broker=self.broker,
+                exchange_name=os.environ["BACKEND_EXCHANGE"],
+                communication=self.publish_communication
+            )
+        else:
+            self.publisher = Publisher(
+                connection_param=self._send_address,
+                exchange_name=os.environ["BACKEND_EXCHANGE"],
+                communication = self.publish_communication
+            )
+        self.publish_communication.on_not_empty = self.publisher.wake
         self.t_publisher = threading.Thread(target=self.publisher.run)
         self.t_publisher.start()
 
+        self.redis_cache = redis.Redis(host=os.environ.get("REDIS_HOST", "redishost"))
+        self._sent_base = routing.commands_sent(self.redis_cache)
+        if ROUTING_MODE == 'direct':
+            ring = routing.publish_ring(self.redis_cache, self.workers, os.environ["BACKEND_EXCHANGE"])
+            print(f"Direct routing, published ring version {ring['version']} with {len(ring['route_keys'])} workers")
+        else:
+            routing.clear_ring(self.redis_cache)
+
+        # Tracks the workers' credits and applied watermarks. With CREDIT_FLOW workers only get
+        # commands they have room for. In direct mode the frontends publish to the workers, so
+        # the workers' own consumers hold back instead and DUMPLOG waits for every confirm.
+        if ROUTING_MODE != 'direct':
+            self.credits = CreditTracker(self.redis_cache, [worker.route_key for worker in self.workers])
+
+        if QUOTE_PREFETCH:
+            self.prefetcher = QuotePrefetcher(
+                redis_cache=self.redis_cache,
+                quote_host=os.environ.get("QUOTE_SERVER_HOST", "192.168.4.2"),
+                quote_port=int(os.environ["QUOTE_SERVER_PORT"])
+            )
+            self.prefetcher.start()
+
         self._print_status_timer = Timer(
             self._PRINT_PERIOD,
             self.print_status,
@@ -55,48 +106,210 @@ class Balancer():
         )
         self._print_status_timer.start()
 
-    def balance(self):
-        with self.communication.mutex:
-            self._send_buffer = self.communication.buffer
-            self.communication.buffer = []
-            self.communication.length = 0
+    ''' One iteration of the manager's main loop. Returns within about a second
+    so the caller can check whether it should exit.
+    '''
+    def step(self):
+        if self.backlogged():
+            # Workers are out of credits. The buffer fills up and the consumer pauses.
+            self.wait_for_credits(timeout=self.CREDIT_WAIT)
+            return
+
+        # Wakes as soon as commands arrive, the timeout only lets the exit flag be checked
+        # (or held back commands be dispatched once their workers have credits).
+        messages = self.communication.get_batch(timeout=self.CREDIT_WAIT if self.backlog() else 1.0)
+        if messages:
+            self.balance(messages)
+        elif self.backlog():
+            self.wait_for_credits(timeout=self.CREDIT_WAIT)
 
+    def balance(self, messages):
         start = time.time()
-        for message in self._send_buffer:
+        send_buffer = []
+        commands = []
+        for message, properties in messages:
             self._total_commands_seen = self._total_commands_seen + 1
             routing_key = None
             command = parse_command(message)
 
             if command.command == "DUMPLOG":
-                while self.runtime_data.active_commands != 0:
-                    time.sleep(5)
-                routing_key = "worker_queue_0"
-                print("Sent DUMPLOG to worker_queue_0")
+                if self.credits is not None:
+                    # Sent by release_barriers once the workers have applied everything routed so far.
+                    held = [len(pending) for pending in self.pending]
+                    self.barriers.append(DumplogBarrier(message, properties, self.seq, self.routed, held))
+                    print(f"DUMPLOG waiting for {sum(held)} held commands and applied watermarks {self.seq}")
+                    continue
+
+                # Direct routing: the frontends' commands have no sequence numbers, so the DUMPLOG
+                # is held until every command sent so far is confirmed. Sent by release_dumplogs.
+                self.prefetch(commands)
+                commands = []
+                self.send(send_buffer)
+                send_buffer = []
+                self.dumplogs.append((message, properties))
+                print("DUMPLOG waiting for every command sent to be confirmed")
+                continue
             else:
                 worker_index = calculate_worker_index(command.uid, self._NUM_WORKERS)
 
-                routing_key = self.workers[worker_index].route_key
                 with self.runtime_data.mutex:
                     self.runtime_data.active_commands += 1
+                commands.append(command)
+
+                if self.credits is not None:
+                    self.routed[worker_index] += 1
+                    self.pending[worker_index].append(lane_of(properties), (message, properties, self.routed[worker_index]))
+                    self._held += 1
+                    continue
+                routing_key = self.workers[worker_index].route_key
+
+            send_buffer.append((routing_key, message, properties))
+
+        self.prefetch(commands)
+        self.send(send_buffer)
+        self.dispatch()
+        print(f"balance() took {time.time()-start} to process {len(messages)} commands")
+
+    def send(self, send_buffer):
+        if ROUTING_MODE == 'direct' and send_buffer:
+            routing.add_sent(self.redis_cache, len(send_buffer))
+        self.publish_communication.put_batch(send_buffer)
+
+    ''' Number of commands held back for workers without credits or waiting on a barrier. '''
+    def backlog(self) -> int:
+        return self._held + len(self.barriers) + len(self.dumplogs)
+
+    ''' True when no more commands should be taken until workers return credits. '''
+    def backlogged(self) -> bool:
+        return self._held >= MAX_BACKLOG
+
+    ''' Sends each worker as many of its held back commands as it has credits for.
+    Commands are numbered here, in the order the worker is sent them, since the
+    priority lanes let later interactive commands overtake bulk ones.
+    '''
+    def dispatch(self):
+        if self.credits is None:
+            self.release_dumplogs()
+            return
+        if self.backlog() == 0:
+            return
+
+        self.credits.refresh()
+        send_buffer = []
+        self.fence_restarted(send_buffer)
+        self.release_barriers()
+
+        for i, pending in enumerate(self.pending):
+            count = min(len(pending), self.credits.credits(i))
+            if count == 0:
+                continue
+            route_key = self.workers[i].route_key
+            for _ in range(count):
+                message, properties, arrival = pending.popleft()
+                self.seq[i] += 1
+                for barrier in self.barriers:
+                    barrier.sent(i, arrival, self.seq[i])
+                send_buffer.append((route_key, message, with_sequence(properties, self.seq[i], self.seq_base[i])))
+            self.credits.take(i, count)
+            self._held -= count
+
+        self.send(send_buffer)
+
+    ''' Numbers from seq_base on for the workers that restarted and adds a fence for each to send_buffer.
+    What the old session took from its queue and didn't apply is lost, but the commands
+    still in the queue go to the new session. The fence is sent at the lowest priority,
+    so it is delivered after all of them and the new session's watermark only passes it
+    once they have been applied. Barriers waiting on the old session wait for the fence.
+    '''
+    def fence_restarted(self, send_buffer):
+        for i in range(self._NUM_WORKERS):
+            if self.credits.restarts[i] == self._restarts[i]:
+                continue
+            self._restarts[i] = self.credits.restarts[i]
+            self.seq_base[i] = self.seq[i]
+            self.seq[i] += 1
+            for barrier in self.barriers:
+                barrier.restarted(i, self.seq[i])
+            send_buffer.append((self.workers[i].route_key, "", fence(self.seq[i], self.seq_base[i])))
+            self.credits.take(i, 1)
+            print(f"{self.workers[i].route_key} restarted, sent fence {self.seq[i]}")
+
+    ''' Queues the DUMPLOGs whose barriers have been reached for worker 0, in order. '''
+    def release_barriers(self):
+        while self.barriers and self.barriers[0].reached(self.credits.applied):
+            barrier = self.barriers.popleft()
+            wait = time.time() - barrier.started
+            self.barrier_stats.record(wait)
+
+            self.routed[0] += 1
+            self.pending[0].append(lane_of(barrier.properties), (barrier.message, barrier.properties, self.routed[0]))
+            self._held += 1
+            print(f"Sent DUMPLOG to worker_queue_0 after waiting {wait:.3f}s for the barrier")
+
+    ''' Direct routing: sends the held DUMPLOGs to worker_queue_0 once the workers are idle. '''
+    def release_dumplogs(self):
+        if not self.dumplogs or not self.workers_idle():
+            return
+        send_buffer = [("worker_queue_0", message, properties) for message, properties in self.dumplogs]
+        self.dumplogs.clear()
+        self.send(send_buffer)
+        print(f"Sent {len(send_buffer)} held DUMPLOGs to worker_queue_0")
 
-            with self.publish_communication.mutex:
-                self.publish_communication.buffer.append((routing_key, message))
-                self.publish_communication.length += 1
+    ''' Waits until a worker confirms a command (so it may have credits again) and dispatches. '''
+    def wait_for_credits(self, timeout):
+        self.runtime_data.progress.wait(timeout)
+        self.runtime_data.progress.clear()
+        self.dispatch()
 
-        print(f"balance() took {time.time()-start} to process {len(self._send_buffer)} commands")
+    ''' True once every command sent so far has been confirmed. Only used in direct
+    mode: the frontends publish most commands, so the shared sent counter is
+    compared with the confirms.
+    '''
+    def workers_idle(self) -> bool:
+        return routing.commands_sent(self.redis_cache) - self._sent_base <= self.runtime_data.confirmed
+
+    ''' Hands the quote commands about to be sent to the prefetcher, so their
+    quotes are being fetched while the commands wait in the worker queues.
+    '''
+    def prefetch(self, commands):
+        if self.prefetcher is not None and commands:
+            self.prefetcher.submit(commands)
 
     ''' Removes users from user_ids list if they havent been seen for USER_TIMEOUT.
     Also prints current activity for all workers and users.
     '''
     def print_status(self):
-        print("Active: {:>10} | Total: {:>10} | TPS: {:>10} |".format(
+        print("Active: {:>10} | Total: {:>10} | TPS: {:>10} | Buffered: {:>8} | Unsent: {:>8} |".format(
             self.runtime_data.active_commands, 
             self._total_commands_seen,
-            (self._prev_active_commands-self.runtime_data.active_commands)/self._PRINT_PERIOD)
+            (self._prev_active_commands-self.runtime_data.active_commands)/self._PRINT_PERIOD,
+            len(self.communication),
+            len(self.publish_communication))
         )
 
         self._prev_active_commands = self.runtime_data.active_commands
 
+        if self.credits is not None:
+            for i, worker in enumerate(self.workers):
+                print("Worker: {:>16} | Credits: {:>8} | Outstanding: {:>8} | Held interactive: {:>8} | Held bulk: {:>8} |".format(
+                    worker.route_key, self.credits.credits(i), self.credits.outstanding(i),
+                    self.pending[i].lane_length(INTERACTIVE), self.pending[i].lane_length(BULK))
+                )
+            print("Consumer paused: {:>6} times | Buffer peak: {:>8} |".format(self.communication.high_count, self.communication.peak))
+            print("DUMPLOG barriers: {:>4} waiting | {:>4} released | Wait last: {:>8.3f}s | avg: {:>8.3f}s | max: {:>8.3f}s |".format(
+                len(self.barriers), self.barrier_stats.released, self.barrier_stats.last_wait,
+                self.barrier_stats.average(), self.barrier_stats.max_wait)
+            )
+
+        if ROUTING_MODE == 'direct':
+            print("Direct sent: {:>10} | Confirmed: {:>10} |".format(
+                routing.commands_sent(self.redis_cache) - self._sent_base,
+                self.runtime_data.confirmed)
+            )
+
+        if self.prefetcher is not None:
+            self.prefetcher.print_status()
+
         sys.stdout.flush()
 
         self._print_status_timer = Timer(
@@ -115,6 +328,26 @@ class Balancer():
 
         return True
 
+''' Copy of the frontend's properties with the worker sequence number added.
+The worker reports the highest number up to which it applied every command,
+counting from base (the numbers its previous sessions were sent).
+'''
+def with_sequence(properties, seq, base):
+    headers = dict(properties.headers) if properties is not None and properties.headers else {}
+    headers['seq'] = seq
+    headers['base'] = base
+    return pika.BasicProperties(
+        priority=properties.priority if properties is not None else None,
+        headers=headers
+    )
+
+''' Properties of the empty command sent to a restarted worker (see Balancer.fence_restarted). '''
+def fence(seq, base):
+    return pika.BasicProperties(
+        priority=BULK_PRIORITY,
+        headers={'seq': seq, 'base': base, 'fence': 1}
+    )
+
 ''' Decorator that caches result of function depending on args
 and returns result if its in the cache rather than running 
 the function again
@@ -132,6 +365,7 @@ def memo(f):
 
 @memo
 def calculate_worker_index(uid: str, NUM_WORKERS: int):
+    ''' Must match worker/src/bootstrap.py. '''
     worker_index = hashlib.sha256(uid.encode('utf-8')).digest()
     worker_index = int.from_bytes(worker_index, byteorder='big', signed=False) % NUM_WORKERS
     return worker_index
\ No newline at end of file
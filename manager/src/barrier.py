@@ -0,0 +1,52 @@
+import time
+
+
+class DumplogBarrier:
+    '''
+    A DUMPLOG waiting for the commands routed before it. Commands are numbered
+    when they are sent, so for each worker i it tracks the highest sequence
+    number (targets[i]) given to a command that arrived before the DUMPLOG
+    (arrival number up to arrivals[i]), and how many of those are still held
+    by the manager (held[i]). It can be sent once none are held and every
+    worker's applied watermark has reached its target. Commands routed after
+    it keep flowing in the meantime. A worker that restarts doesn't release
+    it, its target moves to the fence sent to the new session.
+    '''
+
+    def __init__(self, message, properties, targets, arrivals, held):
+        self.message = message
+        self.properties = properties
+        self.targets = list(targets)
+        self.arrivals = list(arrivals)
+        self.held = list(held)
+        self.started = time.time()
+
+    def sent(self, i, arrival, seq):
+        ''' Called for every command sent to worker i while the barrier waits. '''
+        if arrival <= self.arrivals[i]:
+            self.targets[i] = max(self.targets[i], seq)
+            self.held[i] -= 1
+
+    def restarted(self, i, fence):
+        ''' Worker i restarted. Its new session passes fence once what was left in its queue is applied. '''
+        self.targets[i] = max(self.targets[i], fence)
+
+    def reached(self, applied) -> bool:
+        return all(self.held[i] == 0 and applied[i] >= target for i, target in enumerate(self.targets))
+
+
+class BarrierStats:
+    def __init__(self):
+        self.released = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+
+    def record(self, wait):
+        self.released += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.last_wait = wait
+
+    def average(self) -> float:
+        return self.total_wait / self.released if self.released else 0.0
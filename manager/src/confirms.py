@@ -1,38 +1,67 @@
 from consumer import Consumer
+from transport import LocalConsumer
 import os
 import re
 from threading import Lock
 import sys
 
 class Confirms():
-    def __init__(self, workers, runtime_data):
+    def __init__(self, workers, runtime_data, broker=None):
         self.workers = workers
         self.runtime_data = runtime_data
+        self.broker = broker # LocalBroker when running in one process, RabbitMQ otherwise
 
-        self._recv_address = "rabbitmq"
+        self._recv_address = os.environ.get("RABBITMQ_HOST", "rabbitmq")
         self._consumer = None
 
     def connect(self):
+        if self.broker is not None:
+            self._consumer = LocalConsumer(
+                broker=self.broker,
+                call_on_callback=self.on_receive,
+                exchange_name=os.environ["CONFIRMS_EXCHANGE"],
+                exchange_type='fanout',
+                queue_name="confirm",
+                routing_key="",
+                with_properties=True
+            )
+            return
+
         self._consumer = Consumer(
             call_on_callback=self.on_receive,
             connection_param=self._recv_address,
             exchange_name=os.environ["CONFIRMS_EXCHANGE"],
             exchange_type='fanout',
             queue_name="confirm",
-            routing_key=""
+            routing_key="",
+            with_properties=True
         )
 
     def run(self):
-        self.connect()
+        if self._consumer is None:
+            self.connect()
         self._consumer.run()
 
-    def on_receive(self, message):
+    def on_receive(self, data):
+        message, properties = data
         #number = re.findall(".*?\[(.*)].*", message)
         #number = int(number[0])
 
+        # Auto buy/sell notifications aren't answers to commands that were sent to the workers.
+        if not is_routed(properties):
+            self.runtime_data.progress.set()
+            return
+
         with self.runtime_data.mutex:
+            self.runtime_data.confirmed += 1
             if self.runtime_data.active_commands > 0:
                 self.runtime_data.active_commands -= 1
+        self.runtime_data.progress.set()
 
         # worker_index = abs(hash(command.uid)) % self._NUM_WORKERS
         # self.workers[worker_index].remove(number)
+
+
+def is_routed(properties) -> bool:
+    ''' True for the confirm of a command taken from a worker queue (see the worker's Publisher). '''
+    return properties is not None and bool(properties.headers) and bool(properties.headers.get('routed'))
@@ -1,5 +1,4 @@
 import pika
-import time
 import functools
 
 ''' Encapsulates Rabbitmq interactions.
@@ -9,13 +8,19 @@ as that is the order they are called by Rabbitmq.
 
 '''
 class Consumer():
-    def __init__(self, connection_param, exchange_name, queue_name, routing_key, exchange_type='direct', communication=None, buffer_limit = 0, call_on_callback=None):
+    def __init__(self, connection_param, exchange_name, queue_name, routing_key, exchange_type='direct', communication=None, call_on_callback=None, prefetch=1000, queue_arguments=None, with_properties=False):
         self._connection = None
         self._channel = None
         self._stopping = False
+        self._consumer_tag = None
+        self._ready = False # Queue declared and bound, consuming can start.
+        self._paused = False
+        self.prefetch = prefetch # Unacked messages RabbitMQ sends before waiting for acks.
+        self.pauses = 0
+        self._queue_arguments = queue_arguments
+        self._with_properties = with_properties # Buffer (and call back with) (body, properties) instead of the body
         self.communication = communication
         self._exchange_type = exchange_type
-        self._MAX_BUFFER_LENGTH = buffer_limit
         self._connection_param = connection_param
         self._exchange_name = exchange_name
         self._queue_name = queue_name
@@ -71,6 +76,8 @@ class Consumer():
     def on_channel_closed(self, channel, reason):
         print(f"Connection closed: {reason}")
         self._channel = None
+        self._ready = False
+        self._consumer_tag = None
         # self._connection.close()
 
     def on_exchange_declareok(self, _unused_frame, userdata):
@@ -79,6 +86,7 @@ class Consumer():
         self._channel.queue_declare(
             queue=self._queue_name,
             # arguments={"x-queue-mode": "lazy"},
+            arguments=self._queue_arguments,
             callback=cb
         )
 
@@ -95,32 +103,63 @@ class Consumer():
     def on_bindok(self, _unused_frame, userdata):
         print(f"{self._connection_param}: on_bindok")
         self._channel.basic_qos(
-            prefetch_count=1, callback=self.on_basic_qos_ok
+            prefetch_count=self.prefetch, callback=self.on_basic_qos_ok
         )
 
     def on_basic_qos_ok(self, _unused_frame):
         print(f"{self._connection_param}: on_basic_qos_ok")
-        self._channel.basic_consume(
+        self._ready = True
+        if not self._paused:
+            self.start_consuming()
+
+    def start_consuming(self):
+        self._consumer_tag = self._channel.basic_consume(
             queue=self._queue_name,
             on_message_callback=self.queue_callback,
-            auto_ack=True
+            auto_ack=False
         )
 
     ''' Gets called when queue has a message '''
     def queue_callback(self, ch, method, properties, body):
         data = body.decode()
         if self.communication is not None:
-            while(self.communication.length >= self._MAX_BUFFER_LENGTH):
-                time.sleep(0.5)
-
-            with self.communication.mutex:
-                self.communication.buffer.append(data)
-                self.communication.length += 1
+            # Only blocks if more than prefetch messages arrive after pause().
+            self.communication.put((data, properties) if self._with_properties else data)
 
         if self._call_on_callback is not None:
-            self._call_on_callback(data)
+            self._call_on_callback((data, properties) if self._with_properties else data)
 
-        # self._channel.basic_ack(delivery_tag=method.delivery_tag)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    ''' Stops RabbitMQ from delivering messages, so they wait in the queue
+    instead of in this process. Can be called from any thread.
+    '''
+    def pause(self):
+        self._call_threadsafe(self._pause)
+
+    def resume(self):
+        self._call_threadsafe(self._resume)
+
+    def _call_threadsafe(self, callback):
+        connection = self._connection
+        if connection is not None:
+            connection.ioloop.add_callback_threadsafe(callback)
+
+    def _pause(self):
+        if self._paused:
+            return
+        self._paused = True
+        self.pauses += 1
+        if self._channel is not None and self._consumer_tag is not None:
+            self._channel.basic_cancel(self._consumer_tag)
+            self._consumer_tag = None
+
+    def _resume(self):
+        if not self._paused:
+            return
+        self._paused = False
+        if self._ready and self._consumer_tag is None:
+            self.start_consuming()
     
     def stop(self):
         self._stopping = True
@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+
+CREDIT_FLOW = os.environ.get('CREDIT_FLOW', 'true').lower() in ('1', 'true', 'yes')
+WORKER_CREDITS = int(os.environ.get('WORKER_CREDITS', 1000)) # Used until a worker advertises its own capacity
+MAX_BACKLOG = int(os.environ.get('MANAGER_BACKLOG', 20000)) # Commands held for workers without credits before consuming stops
+
+# Must match worker/src/credits.py
+KEY_PREFIX = 'credits:'
+
+
+class CreditTracker:
+    '''
+    Every worker advertises in the Redis hash credits:<route key> how many commands
+    it can hold (capacity), how many it has finished (completed) and its applied
+    watermark (every command up to that sequence number has been applied). The
+    manager counts what it sent to each worker, so a worker has
+    capacity - (sent - completed) credits and, when enforce is set, nothing is
+    sent to it past that.
+
+    The counters are cumulative, so a lost or late report only delays credits.
+    A new session means the worker restarted and whatever it held is gone.
+    '''
+    REFRESH_PERIOD = 0.01 # Seconds, Redis is read at most this often
+
+    def __init__(self, redis_cache, route_keys, capacity=WORKER_CREDITS, enforce=CREDIT_FLOW):
+        self.redis_cache = redis_cache
+        self.route_keys = route_keys
+        self.enforce = enforce
+        self.sent = [0] * len(route_keys)
+        self.completed = [0] * len(route_keys)
+        self.capacity = [capacity] * len(route_keys)
+        self.sessions = [None] * len(route_keys)
+        self.applied = [0] * len(route_keys)
+        self.restarts = [0] * len(route_keys)
+        self._last_refresh = 0.0
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_refresh < self.REFRESH_PERIOD:
+            return
+        self._last_refresh = now
+
+        pipe = self.redis_cache.pipeline(transaction=False)
+        for route_key in self.route_keys:
+            pipe.hmget(KEY_PREFIX + route_key, 'session', 'completed', 'capacity', 'applied')
+
+        for i, (session, completed, capacity, applied) in enumerate(pipe.execute()):
+            if session is None:
+                continue # Not reporting yet.
+            if session != self.sessions[i]:
+                if self.sessions[i] is not None:
+                    print(f"{self.route_keys[i]} restarted, resetting its credits")
+                    self.sent[i] = 0
+                    self.restarts[i] += 1
+                self.sessions[i] = session
+            self.completed[i] = int(completed)
+            self.capacity[i] = int(capacity)
+            self.applied[i] = int(applied or 0)
+
+    def outstanding(self, i) -> int:
+        return max(self.sent[i] - self.completed[i], 0)
+
+    def credits(self, i) -> int:
+        if not self.enforce:
+            return sys.maxsize
+        return max(self.capacity[i] - self.outstanding(i), 0)
+
+    def take(self, i, count):
+        self.sent[i] += count
@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import threading
 
 @dataclass
@@ -16,12 +16,8 @@ class Worker:
 class RuntimeData:
     active_commands: int
     mutex: threading.Lock
-
-@dataclass
-class ThreadCommunication:
-    buffer: list
-    length: int
-    mutex: threading.Lock
+    confirmed: int = 0 # Confirms of commands taken from the worker queues, used by the DUMPLOG barrier in direct routing mode.
+    progress: threading.Event = field(default_factory=threading.Event) # Set on every confirm, wakes the balancer waiting for credits.
 
 # @dataclass
 # class UserIds:
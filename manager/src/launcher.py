@@ -0,0 +1,198 @@
+import os
+import abc
+import sys
+import time
+import threading
+import subprocess
+from dataclassesfile import Worker
+
+try:
+    import docker
+except ImportError:
+    docker = None
+
+# docker starts every worker as a container through the Docker socket.
+# process starts them as python processes on this host (the worker's
+# dependencies have to be installed and the service hostnames resolvable here).
+WORKER_LAUNCHER = os.environ.get('WORKER_LAUNCHER', 'docker')
+WORKER_SRC = os.environ.get('WORKER_SRC', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'worker', 'src'))
+# Cores the worker processes are pinned to (ex. 2-15 or 0,2,4), split evenly between the workers. Empty means no pinning.
+WORKER_CORES = os.environ.get('WORKER_CORES', '')
+
+
+def worker_environment(i: int) -> dict:
+    ''' Settings every worker gets, however it is started. '''
+    return {
+        "ROUTE_KEY": f"worker_queue_{i}",
+        "SERVER_NAME": f"worker_{i}",
+        "BACKEND_EXCHANGE": os.environ["BACKEND_EXCHANGE"],
+        "CONFIRMS_EXCHANGE": os.environ["CONFIRMS_EXCHANGE"],
+        "RABBITMQ_HOST": os.environ.get("RABBITMQ_HOST", "rabbitmq"),
+        "REDIS_HOST": os.environ.get("REDIS_HOST", "redishost"),
+        "QUOTE_SERVER_PORT": os.environ["QUOTE_SERVER_PORT"],
+        "QUOTE_SERVER_HOST": os.environ.get("QUOTE_SERVER_HOST", "192.168.4.2"),
+        "MONGODB_DATABASE": os.environ["MONGODB_DATABASE"],
+        "MONGODB_USERNAME": os.environ["MONGODB_USERNAME"],
+        "MONGODB_PASSWORD": os.environ["MONGODB_PASSWORD"],
+        "MONGODB_HOSTNAME": os.environ["MONGODB_HOSTNAME"],
+        "NUM_LANES": os.environ.get("NUM_LANES", "4"),
+        "ACCOUNT_LAYOUT": os.environ.get("ACCOUNT_LAYOUT", "list"),
+        "STORAGE": os.environ.get("STORAGE", "mongo"),
+        "LOG_STORE": os.environ.get("LOG_STORE", "split"),
+        "WRITE_CONCERNS": os.environ.get("WRITE_CONCERNS", ""),
+        "DEBUG_LEVEL": os.environ.get("DEBUG_LEVEL", "info"),
+        "DEBUG_SAMPLE_RATE": os.environ.get("DEBUG_SAMPLE_RATE", "1.0"),
+        "MONGO_MAX_POOL_SIZE": os.environ.get("MONGO_MAX_POOL_SIZE", "100"),
+        "MONGO_MIN_POOL_SIZE": os.environ.get("MONGO_MIN_POOL_SIZE", "8"),
+        "MONGO_COMPRESSORS": os.environ.get("MONGO_COMPRESSORS", "zstd,snappy,zlib"),
+        "MONGO_SEPARATE_LOGS_CLIENT": os.environ.get("MONGO_SEPARATE_LOGS_CLIENT", "false"),
+        "QUOTE_BUS": os.environ.get("QUOTE_BUS", "true"),
+        "QUOTE_TTL": os.environ.get("QUOTE_TTL", "60"),
+        "QUOTE_PREFETCH": os.environ.get("QUOTE_PREFETCH", "true"),
+        "WORKER_CREDITS": os.environ.get("WORKER_CREDITS", "1000"),
+        "INTERACTIVE_WEIGHT": os.environ.get("INTERACTIVE_WEIGHT", "8"),
+        "REFRESH_AHEAD": os.environ.get("REFRESH_AHEAD", "true"),
+        "REFRESH_AHEAD_BUDGET": os.environ.get("REFRESH_AHEAD_BUDGET", "5"),
+        "NUM_WORKERS": os.environ["NUM_WORKERS"],
+        "WORKER_INDEX": str(i)
+    }
+
+def parse_cores(cores: str) -> list:
+    ''' "0-3,8" -> [0, 1, 2, 3, 8] '''
+    result = []
+    for part in filter(None, (part.strip() for part in cores.split(','))):
+        if '-' in part:
+            first, last = part.split('-', 1)
+            result.extend(range(int(first), int(last) + 1))
+        else:
+            result.append(int(part))
+    return result
+
+
+class Launcher(abc.ABC):
+    ''' Starts and stops the workers. start() fills workers[i] and is called from one thread per worker. '''
+
+    def prepare(self):
+        pass
+
+    @abc.abstractmethod
+    def start(self, i: int, workers: list):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def stop(self, worker: Worker):
+        raise NotImplementedError
+
+    def start_all(self, count: int) -> list:
+        start = time.time()
+        workers = [None for _ in range(count)]
+        threads = [threading.Thread(target=self.start, args=(i, workers)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        print(f"Started {count} workers in {time.time()-start:.3f}s")
+        sys.stdout.flush()
+        return workers
+
+
+class DockerLauncher(Launcher):
+    def __init__(self):
+        self.client = docker.DockerClient(base_url='unix://var/run/docker.sock')
+
+    def prepare(self):
+        ''' Stopping worker created by docker-compose since it dosent work well
+        having it in out system. This wouldent have to be done if Docker
+        would implement delayed startup in docker-compose
+        '''
+        init_worker_container = self.client.containers.get("worker")
+        init_worker_container.stop()
+
+    def start(self, i: int, workers: list):
+        environment = worker_environment(i)
+        result = self.client.containers.run(
+            image="csc468-group3_worker",
+            name=environment["SERVER_NAME"],
+            detach=True,
+            auto_remove=True,
+            extra_hosts={"quoteserver.seng.uvic.ca":"192.168.4.2"},
+            ports={f"{4444+i}":f"{4444+i}"},
+            network="csc468-group3_custom_network",
+            environment=environment
+        )
+
+        print(f"Started worker container...\n\tID: {result.id}\n\tName: {result.name}")
+        sys.stdout.flush()
+
+        workers[i] = Worker(
+            container_id=result.id,
+            commands=[],
+            route_key=environment["ROUTE_KEY"]
+        )
+
+    def stop(self, worker: Worker):
+        worker_container = self.client.containers.get(worker.container_id)
+        worker_container.stop()
+
+
+class ProcessLauncher(Launcher):
+    '''
+    Runs each worker's main.py as a child process with the same settings the
+    containers get. With WORKER_CORES each process is pinned to its share of
+    the cores (Linux only). The workers print to this process's output.
+    '''
+    STOP_TIMEOUT = 10 # Seconds a worker gets to exit after SIGTERM
+
+    def __init__(self, source=WORKER_SRC, cores=WORKER_CORES, python=sys.executable):
+        self.source = os.path.abspath(source)
+        self.cores = parse_cores(cores)
+        self.python = python
+        self._processes = {} # container_id -> Popen
+
+        unavailable = sorted(set(self.cores) - os.sched_getaffinity(0)) if self.cores else []
+        if unavailable:
+            raise ValueError(f"WORKER_CORES includes cores this host can't run on: {unavailable}")
+
+    def cores_for(self, i: int, count: int) -> set:
+        if not self.cores:
+            return set()
+        share = max(len(self.cores) // count, 1)
+        return {self.cores[(i * share + j) % len(self.cores)] for j in range(share)}
+
+    def start(self, i: int, workers: list):
+        environment = dict(os.environ, **worker_environment(i))
+        process = subprocess.Popen([self.python, "main.py"], cwd=self.source, env=environment)
+
+        # Threads the worker starts from now on inherit the affinity.
+        cores = self.cores_for(i, len(workers))
+        if cores:
+            os.sched_setaffinity(process.pid, cores)
+
+        print(f"Started worker process...\n\tPID: {process.pid}\n\tName: {environment['SERVER_NAME']}\n\tCores: {sorted(cores) or 'any'}")
+        sys.stdout.flush()
+
+        container_id = f"pid-{process.pid}"
+        self._processes[container_id] = process
+        workers[i] = Worker(
+            container_id=container_id,
+            commands=[],
+            route_key=environment["ROUTE_KEY"]
+        )
+
+    def stop(self, worker: Worker):
+        process = self._processes.pop(worker.container_id)
+        process.terminate()
+        try:
+            process.wait(timeout=self.STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def create_launcher(kind=WORKER_LAUNCHER) -> Launcher:
+    if kind == 'process':
+        return ProcessLauncher()
+    if docker is None:
+        raise RuntimeError("The docker package is needed to start workers with WORKER_LAUNCHER=docker")
+    return DockerLauncher()
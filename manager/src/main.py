@@ -1,16 +1,16 @@
 import signal
 import sys
 import os
-import docker
 from multiprocessing import Process, Queue
 import threading
 import time
 from consumer import Consumer
 from balancer import Balancer
 from confirms import Confirms
-from dataclassesfile import Worker
 from dataclassesfile import RuntimeData
-from dataclassesfile import ThreadCommunication
+from launcher import create_launcher
+from ring_buffer import RingBuffer
+from priority import QUEUE_ARGUMENTS
 
 
 # Handles exiting when SIGTERM (sent by ^C input) is received 
@@ -23,50 +23,8 @@ def exit_gracefully(self, signum, frame):
 signal.signal(signal.SIGINT, exit_gracefully)
 signal.signal(signal.SIGTERM, exit_gracefully)
 
-def create_worker_thread(client, i: int, workers: list):
-    route_key = f"worker_queue_{i}"
-    server_name = f"worker_{i}"
-    result = client.containers.run(
-        image="csc468-group3_worker",
-        name=server_name,
-        detach=True,
-        auto_remove=True,
-        extra_hosts={"quoteserver.seng.uvic.ca":"192.168.4.2"},
-        ports={f"{4444+i}":f"{4444+i}"},
-        network="csc468-group3_custom_network",
-        environment={
-            "ROUTE_KEY": route_key,
-            "SERVER_NAME": server_name,
-            "BACKEND_EXCHANGE": os.environ["BACKEND_EXCHANGE"],
-            "CONFIRMS_EXCHANGE": os.environ["CONFIRMS_EXCHANGE"],
-            "QUOTE_SERVER_PORT": os.environ["QUOTE_SERVER_PORT"],
-            "MONGODB_DATABASE": os.environ["MONGODB_DATABASE"],
-            "MONGODB_USERNAME": os.environ["MONGODB_USERNAME"],
-            "MONGODB_PASSWORD": os.environ["MONGODB_PASSWORD"],
-            "MONGODB_HOSTNAME": os.environ["MONGODB_HOSTNAME"]
-        }
-    )
-    
-    print(f"Started worker container...\n\tID: {result.id}\n\tName: {result.name}")
-    sys.stdout.flush()
-
-    workers[i] = Worker(
-        container_id=result.id,
-        commands=[],
-        route_key=route_key
-    )
-
-
-def balancer_consume_thread(communication):
-    consumer = Consumer(
-        communication=communication,
-        buffer_limit=50000,
-        connection_param="rabbitmq",
-        exchange_name=os.environ["FRONTEND_EXCHANGE"],
-        queue_name="frontend",
-        routing_key="frontend"
-    )
-    consumer.run() 
+def balancer_consume_thread(consumer):
+    consumer.run()
 
 def confirms_thread(workers, runtime_data):
     confirms = Confirms(
@@ -76,38 +34,39 @@ def confirms_thread(workers, runtime_data):
     confirms.run()
 
 def main():
-    client = docker.DockerClient(base_url='unix://var/run/docker.sock')
+    # Containers by default, local processes with WORKER_LAUNCHER=process.
+    launcher = create_launcher()
     WANTED_WORKERS = int(os.environ["NUM_WORKERS"])
-    workers = [None for _ in range(WANTED_WORKERS)]
+    launcher.prepare()
+    workers = launcher.start_all(WANTED_WORKERS)
 
-    ''' Stopping worker created by docker-compose since it dosent work well
-    having it in out system. This wouldent have to be done if Docker
-    would implement delayed startup in docker-compose
-    '''
-    init_worker_container = client.containers.get("worker")
-    init_worker_container.stop()
-
-    t_workers = []
-    for i in range(0, WANTED_WORKERS):
-        t_workers.append(threading.Thread(target=create_worker_thread, args=(client, i, workers)))
-    
-    for w in t_workers:
-        w.start()
-
-    for w in t_workers:
-        w.join()
-
-    communication = ThreadCommunication(
-        buffer=[],
-        length=0,
-        mutex=threading.Lock()
+    # Consuming from the frontend queue pauses while the buffer is above its high watermark,
+    # so a backlog stays in RabbitMQ. Room is left for the messages already prefetched.
+    capacity = int(os.environ.get("CONSUMER_BUFFER", 50000))
+    prefetch = min(int(os.environ.get("CONSUMER_PREFETCH", 1000)), capacity // 2)
+    consumer = Consumer(
+        connection_param=os.environ.get("RABBITMQ_HOST", "rabbitmq"),
+        exchange_name=os.environ["FRONTEND_EXCHANGE"],
+        queue_name="frontend",
+        routing_key="frontend",
+        prefetch=prefetch,
+        queue_arguments=QUEUE_ARGUMENTS,
+        with_properties=True
     )
+    communication = RingBuffer(
+        capacity=capacity,
+        high_watermark=capacity - prefetch,
+        low_watermark=(capacity - prefetch) // 2,
+        on_high=consumer.pause,
+        on_low=consumer.resume
+    )
+    consumer.communication = communication
     runtime_data = RuntimeData(
         active_commands=0,
         mutex=threading.Lock()
     )
 
-    t_balancer_consume = threading.Thread(target=balancer_consume_thread, args=(communication,))
+    t_balancer_consume = threading.Thread(target=balancer_consume_thread, args=(consumer,))
     t_confirms = threading.Thread(target=confirms_thread, args=(workers, runtime_data))
     t_balancer_consume.start()
     t_confirms.start()
@@ -121,16 +80,11 @@ def main():
 
     global EXIT_PROGRAM
     while not EXIT_PROGRAM:
-        if communication.length > 0:
-            balancer.balance()
-        # else:
-        time.sleep(2.0)
-
+        balancer.step()
         sys.stdout.flush()
         
     for worker in workers:
-        worker_container = client.containers.get(worker.container_id)
-        worker_container.stop()
+        launcher.stop(worker)
 
     t_balancer_consume.join()
     t_confirms.join()
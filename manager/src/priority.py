@@ -0,0 +1,64 @@
+import os
+from collections import deque
+
+# Commands from the web frontend are tagged INTERACTIVE_PRIORITY, workload files BULK_PRIORITY.
+# The frontend and worker queues are priority queues up to MAX_PRIORITY, so RabbitMQ
+# delivers waiting interactive commands first. Must match worker/src/priority.py.
+MAX_PRIORITY = 5
+INTERACTIVE_PRIORITY = 5
+BULK_PRIORITY = 0
+QUEUE_ARGUMENTS = {"x-max-priority": MAX_PRIORITY}
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+# Commands taken from each lane per round when both have commands waiting.
+# At least 1, a lane with no quantum would never be popped.
+WEIGHTS = {
+    INTERACTIVE: max(1, int(os.environ.get('INTERACTIVE_WEIGHT', 8))),
+    BULK: 1
+}
+
+
+def lane_of(properties) -> str:
+    if properties is not None and (properties.priority or 0) >= INTERACTIVE_PRIORITY:
+        return INTERACTIVE
+    return BULK
+
+
+class WeightedFairQueue:
+    '''
+    One FIFO per priority lane, popped by weighted round robin: up to
+    weights[lane] items are taken from a lane before moving to the next one
+    that has items. Bulk commands keep moving while interactive ones jump ahead.
+    '''
+
+    def __init__(self, weights=WEIGHTS):
+        self._weights = weights
+        self._order = list(weights)
+        self._queues = {lane: deque() for lane in self._order}
+        self._current = 0
+        self._quantum = weights[self._order[0]]
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def lane_length(self, lane) -> int:
+        return len(self._queues[lane])
+
+    def append(self, lane, item):
+        self._queues[lane].append(item)
+        self._size += 1
+
+    def popleft(self):
+        if self._size == 0:
+            raise IndexError("pop from an empty WeightedFairQueue")
+
+        while True:
+            queue = self._queues[self._order[self._current]]
+            if queue and self._quantum > 0:
+                self._quantum -= 1
+                self._size -= 1
+                return queue.popleft()
+            self._current = (self._current + 1) % len(self._order)
+            self._quantum = self._weights[self._order[self._current]]
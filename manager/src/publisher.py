@@ -3,8 +3,7 @@ import functools
 import sys
 
 class Publisher():
-    QUICK_SEND = 0.01
-    SLOW_SEND = 2.0
+    PUBLISH_BATCH = 1000 # Max messages published per ioloop callback
 
     def __init__(self, connection_param, exchange_name, communication):
         self._connection = None
@@ -67,7 +66,8 @@ class Publisher():
         """
         print(f"{self._connection_param}: Issuing consumer related RPC commands")
         # self._channel.confirm_delivery(self.on_delivery_confirmation)
-        self.schedule_next_message(self.SLOW_SEND)
+        # Send whatever was buffered while the channel was down.
+        self.publish_message()
 
     def on_delivery_confirmation(self, method_frame):
         conf_message = self._deliveries.get(method_frame.method.delivery_tag)
@@ -80,37 +80,39 @@ class Publisher():
             sys.stdout.flush()
             self._nacked += 1
 
-    def schedule_next_message(self, publish_interval):
-        #self._connection.ioloop.call_soon(self.publish_message)
-        self._connection.ioloop.call_later(publish_interval, self.publish_message)
+    def wake(self):
+        """Called from the sending thread when the buffer stops being empty.
+        Publishing is scheduled on the ioloop thread.
+        """
+        connection = self._connection
+        if connection is not None:
+            connection.ioloop.add_callback_threadsafe(self.publish_message)
 
     def publish_message(self):
-        if self._channel is None or self.communication.length <= 0:
-            self.schedule_next_message(self.SLOW_SEND)
-        else:
-            with self.communication.mutex:
-                self._publish_buffer = self.communication.buffer
-                self.communication.buffer = []
-                self.communication.length = 0
-
-            for data in self._publish_buffer:
-                routing_key = data[0]
-                message = data[1]
-
-                self._channel.basic_publish(
-                    exchange=self._exchange,
-                    routing_key=routing_key,
-                    body=message,
-                    properties=pika.BasicProperties(),
-                    mandatory=True
-                )
-
-                # self._message_number += 1
-                # self._deliveries.update({self._message_number: message})
-
-            self.schedule_next_message(self.QUICK_SEND)
-
-
+        if self._channel is None:
+            return
+
+        self._publish_buffer = self.communication.get_batch(max_items=self.PUBLISH_BATCH, timeout=0)
+        for data in self._publish_buffer:
+            routing_key = data[0]
+            message = data[1]
+            # The frontend's properties (priority, ingress time) are passed on to the worker.
+            properties = data[2] if len(data) > 2 and data[2] is not None else pika.BasicProperties()
+
+            self._channel.basic_publish(
+                exchange=self._exchange,
+                routing_key=routing_key,
+                body=message,
+                properties=properties,
+                mandatory=True
+            )
+
+            # self._message_number += 1
+            # self._deliveries.update({self._message_number: message})
+
+        # Let the ioloop handle other events before sending the rest.
+        if len(self.communication) > 0:
+            self._connection.ioloop.add_callback_threadsafe(self.publish_message)
 
     def run(self):
         """Run the example code by connecting and then starting the IOLoop.
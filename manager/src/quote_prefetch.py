@@ -0,0 +1,214 @@
+import os
+import sys
+import time
+import socket
+import threading
+from collections import deque
+import redis
+
+QUOTE_TTL = int(os.environ.get('QUOTE_TTL', 60)) # seconds
+QUOTE_BUS = os.environ.get('QUOTE_BUS', 'true').lower() in ('1', 'true', 'yes')
+# Workers only learn the details of a prefetched quote (for its quoteServer log) from
+# the quote bus, so without it nothing is prefetched.
+QUOTE_PREFETCH = QUOTE_BUS and os.environ.get('QUOTE_PREFETCH', 'true').lower() in ('1', 'true', 'yes')
+BATCH_SIZE = int(os.environ.get('QUOTE_PREFETCH_BATCH', 64)) # Symbols per MGET
+# Quote requests sent before reading their responses. The quote gateway answers pipelined
+# requests in order, how the legacy quote server handles them is unknown, so 1 unless
+# QUOTE_SERVER_HOST is the gateway (like the gateway's own UPSTREAM_PIPELINE).
+PIPELINE = int(os.environ.get('QUOTE_PREFETCH_PIPELINE', 1))
+
+# Must match worker/src/legacy/quote_cache.py
+CHANNEL = 'quotes'
+SERVER_NAME = 'manager'
+MARKER_PREFIX = 'prefetched:' # Set for every quote the manager fetched, deleted by the worker that uses it.
+STATS_KEY = 'prefetch:stats' # Hash of counters the workers add to (hits, misses).
+
+# Commands that need a quote; the symbol is the first parameter.
+QUOTE_COMMANDS = {"BUY", "SELL", "QUOTE"}
+
+
+class QuotePrefetcher(threading.Thread):
+    '''
+    Fetches quotes for the symbols of queued BUY/SELL/QUOTE commands before the
+    workers get to them. The balancer submits the symbols of every drained batch,
+    symbols already in the shared cache are skipped, and the rest are requested
+    from the quote server (or gateway), pipelined up to PIPELINE requests. The quotes are put in
+    the shared cache and on the quote bus, so the workers' get_quote calls are hits.
+
+    Each fetched quote gets a prefetched:<symbol> marker. The worker that uses the
+    quote deletes it and logs the quote server hit for its command; markers still
+    there when the quote expires are counted as wasted fetches.
+    '''
+    _PRINT_PERIOD = 10.0 # Seconds
+
+    def __init__(self, redis_cache, quote_host, quote_port, ttl=QUOTE_TTL, batch_size=BATCH_SIZE, pipeline=PIPELINE):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.redis_cache = redis_cache
+        self.quote_address = (quote_host, quote_port)
+        self.ttl = ttl
+        self.batch_size = max(batch_size, 1)
+        self.pipeline = max(pipeline, 1)
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pending = {} # symbol -> user id of the first command that needs it
+        self._valid_until = {} # symbol -> expiry of the quote this thread last fetched
+        self._outstanding = deque() # (expiry, symbol) of fetched quotes, oldest first
+        self._socket = None
+        self._reader = None
+
+        # Stats
+        self.requested = 0 # Distinct symbols submitted.
+        self.recent = 0 # Skipped, this thread fetched the quote and it is still valid.
+        self.cached = 0 # Skipped, a worker had already cached the quote.
+        self.fetched = 0
+        self.gateway_cached = 0 # Answered from the gateway's cache, nothing new was fetched.
+        self.wasted = 0
+        self.errors = 0
+        self._prev_fetched = 0
+
+    def submit(self, commands):
+        ''' Queues the symbols of the given parsed commands. Never blocks on the quote server. '''
+        with self._lock:
+            for command in commands:
+                if command.command in QUOTE_COMMANDS and command.params:
+                    self._pending.setdefault(command.params[0], command.uid)
+        if self._pending:
+            self._wake.set()
+
+    def run(self):
+        while True:
+            # Also wakes when idle so expired prefetches are still counted.
+            self._wake.wait(timeout=self._PRINT_PERIOD)
+            self._wake.clear()
+            with self._lock:
+                requests, self._pending = self._pending, {}
+
+            try:
+                self.count_wasted()
+                self.prefetch(requests)
+            except Exception as e:
+                self.errors += 1
+                self.close()
+                print(f"Error: Quote prefetch failed. {e}")
+                sys.stdout.flush()
+
+    def prefetch(self, requests):
+        self.requested += len(requests)
+        now = time.time()
+        symbols = [symbol for symbol in requests if self._valid_until.get(symbol, 0) <= now]
+        self.recent += len(requests) - len(symbols)
+
+        for start in range(0, len(symbols), self.batch_size):
+            batch = symbols[start:start + self.batch_size]
+            missing = [symbol for symbol, price in zip(batch, self.redis_cache.mget(batch)) if price is None]
+            self.cached += len(batch) - len(missing)
+            if not missing:
+                continue
+
+            lines = self.fetch([(symbol, requests[symbol]) for symbol in missing])
+
+            now = time.time()
+            pipe = self.redis_cache.pipeline(transaction=False)
+            for symbol, line in zip(missing, lines):
+                fields = [field.strip() for field in line.split(',')]
+                if len(fields) < 5 or not is_float(fields[0]):
+                    self.errors += 1
+                    continue
+
+                pipe.set(symbol, float(fields[0]), ex=self.ttl)
+                if len(fields) > 5 and fields[5] == 'C':
+                    self.gateway_cached += 1 # Already logged by the worker that caused the fetch.
+                else:
+                    self.fetched += 1
+                    # Kept past the quote's expiry so count_wasted can still see it.
+                    pipe.set(MARKER_PREFIX + symbol, 1, ex=2 * self.ttl)
+                    self._outstanding.append((now + self.ttl, symbol))
+                pipe.publish(CHANNEL, f"{symbol},{float(fields[0])},{fields[3]},{fields[4]},{SERVER_NAME}")
+                self._valid_until[symbol] = now + self.ttl
+            pipe.execute()
+
+    def fetch(self, requests) -> list:
+        ''' requests: [(symbol, user_id)]. Sends up to pipeline requests at a time and returns the response lines in order. '''
+        if self._socket is None:
+            self._socket = socket.create_connection(self.quote_address, timeout=5)
+            self._reader = self._socket.makefile('rb')
+
+        lines = []
+        for start in range(0, len(requests), self.pipeline):
+            chunk = requests[start:start + self.pipeline]
+            self._socket.sendall(''.join(f"{symbol}, {user_id}\n" for symbol, user_id in chunk).encode('utf-8'))
+            for _ in chunk:
+                line = self._reader.readline()
+                if not line:
+                    raise ConnectionError("Quote server closed the connection")
+                lines.append(line.decode('utf-8'))
+        return lines
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+        self._socket = None
+        self._reader = None
+
+    def count_wasted(self):
+        ''' Counts the expired prefetched quotes no worker used. '''
+        now = time.time()
+        expired = []
+        while self._outstanding and self._outstanding[0][0] <= now:
+            expired.append(self._outstanding.popleft()[1])
+        for symbol in expired:
+            if self._valid_until.get(symbol, 0) <= now:
+                self._valid_until.pop(symbol, None)
+        if not expired:
+            return
+
+        pipe = self.redis_cache.pipeline(transaction=False)
+        for symbol in expired:
+            pipe.delete(MARKER_PREFIX + symbol)
+        self.wasted += sum(pipe.execute())
+
+    def stats(self) -> dict:
+        worker_stats = {key.decode('utf-8'): int(value) for key, value in self.redis_cache.hgetall(STATS_KEY).items()}
+        hits = worker_stats.get('hits', 0)
+        misses = worker_stats.get('misses', 0)
+        return {
+            'requested': self.requested,
+            'recent': self.recent,
+            'cached': self.cached,
+            'fetched': self.fetched,
+            'gateway_cached': self.gateway_cached,
+            'hits': hits, # Prefetched quotes used by a command.
+            'misses': misses, # Commands that still had to wait on the quote server.
+            'hit_rate': (hits / (hits + misses)) if hits + misses else 0.0,
+            'wasted': self.wasted,
+            'errors': self.errors
+        }
+
+    def print_status(self):
+        try:
+            stats = self.stats()
+        except redis.RedisError as e:
+            print(f"Error: Could not read prefetch stats. {e}")
+            return
+
+        print("Prefetched: {:>8} | Fetch/s: {:>8.1f} | Already cached: {:>8} | Prefetch hits: {:>8} | Misses: {:>8} | Hit rate: {:>6.1%} | Wasted: {:>8} | Errors: {:>6} |".format(
+            stats['fetched'],
+            (stats['fetched'] - self._prev_fetched) / self._PRINT_PERIOD,
+            stats['cached'] + stats['recent'] + stats['gateway_cached'],
+            stats['hits'],
+            stats['misses'],
+            stats['hit_rate'],
+            stats['wasted'],
+            stats['errors'])
+        )
+        self._prev_fetched = stats['fetched']
+
+
+def is_float(value: str) -> bool:
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
@@ -0,0 +1,35 @@
+import os
+import json
+import time
+
+# balancer: every command goes through the manager (frontend exchange -> Balancer -> worker queue).
+# direct: the manager publishes the ring below and the frontends publish straight to the worker
+# queues. The manager only sees DUMPLOGs and commands from frontends that can't read the ring.
+ROUTING_MODE = os.environ.get('ROUTING_MODE', 'balancer')
+
+# {"version": ..., "exchange": ..., "route_keys": [...]}. A user's commands go to
+# route_keys[sha256(uid) % len(route_keys)], the same hashing the balancer uses.
+RING_KEY = 'routing:ring'
+# Number of commands published to the worker queues, by the frontends and the manager.
+# Every command gets one confirm, so the workers are idle once the manager has seen that many.
+SENT_KEY = 'routing:sent'
+
+
+def publish_ring(redis_cache, workers, exchange) -> dict:
+    ring = {
+        'version': int(time.time() * 1000),
+        'exchange': exchange,
+        'route_keys': [worker.route_key for worker in workers]
+    }
+    redis_cache.set(RING_KEY, json.dumps(ring))
+    return ring
+
+def clear_ring(redis_cache):
+    ''' Sends the frontends back to the frontend exchange. '''
+    redis_cache.delete(RING_KEY)
+
+def commands_sent(redis_cache) -> int:
+    return int(redis_cache.get(SENT_KEY) or 0)
+
+def add_sent(redis_cache, count):
+    redis_cache.incrby(SENT_KEY, count)
@@ -0,0 +1,229 @@
+import sys
+import time
+import asyncio
+
+
+class RateLimiter:
+    ''' Token bucket shared by every upstream connection. A rate of 0 disables the limit. '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1.0)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self.waits = 0
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return
+            self.waits += 1
+            await asyncio.sleep((1.0 - self._tokens) / self.rate)
+
+
+class UpstreamConnection:
+    ''' One connection to the legacy quote server. Requests are pipelined up to the batch size. '''
+
+    def __init__(self, host, port, timeout):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+
+    async def fetch(self, requests) -> list:
+        ''' requests: [(symbol, user_id)]. Returns the response lines in the same order. '''
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+
+        try:
+            self.writer.write(''.join(f"{symbol}, {user_id}\n" for symbol, user_id in requests).encode('utf-8'))
+            await self.writer.drain()
+            lines = []
+            for _ in requests:
+                line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+                if not line:
+                    raise ConnectionError("Quote server closed the connection")
+                lines.append(line.decode('utf-8').strip())
+            return lines
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+
+class QuoteGateway:
+    '''
+    Owns every connection to the legacy quote server. Workers connect with the
+    quote server's own protocol ("SYM, userid\\n" -> "price,SYM,userid,time,cryptokey\\n").
+
+    Quotes are cached for cache_ttl seconds. Requests for a symbol that is already
+    being fetched wait for that fetch instead of making their own, and the
+    upstream connections share one rate limit. Responses get a sixth field: F when
+    the quote was fetched for this request, C when it came from the cache or
+    another request's fetch (the worker logs those like its own cache hits).
+    '''
+    _PRINT_PERIOD = 10.0 # Seconds
+    _RETRIES = 3
+
+    def __init__(self, upstream_host, upstream_port, connections=4, rate=0.0, pipeline=1, timeout=5.0, cache_ttl=60.0):
+        self.upstream = [UpstreamConnection(upstream_host, upstream_port, timeout) for _ in range(connections)]
+        self.limiter = RateLimiter(rate)
+        self.pipeline = max(pipeline, 1)
+        self.cache_ttl = cache_ttl
+
+        self.cache = {} # symbol -> (response fields, expiry time)
+        self.inflight = {} # symbol -> future of the response fields
+        self.pending = None # Queue of (symbol, user_id, future), created on the loop.
+
+        # Stats
+        self.clients = 0
+        self.requests = 0
+        self.hits = 0
+        self.joined = 0 # Requests that waited on another request's fetch.
+        self.fetched = 0
+        self.errors = 0
+        self._prev_requests = 0
+
+    async def start(self, host, port):
+        self.pending = asyncio.Queue()
+        for connection in self.upstream:
+            asyncio.ensure_future(self.upstream_worker(connection))
+        asyncio.ensure_future(self.print_status())
+        return await asyncio.start_server(self.handle_client, host, port)
+
+    async def get(self, symbol, user_id):
+        ''' Returns (response fields, cached). '''
+        self.requests += 1
+        entry = self.cache.get(symbol)
+        if entry is not None and entry[1] > time.time():
+            self.hits += 1
+            return entry[0], True
+
+        future = self.inflight.get(symbol)
+        if future is not None:
+            self.joined += 1
+            return await asyncio.shield(future), True
+
+        future = asyncio.get_event_loop().create_future()
+        self.inflight[symbol] = future
+        await self.pending.put((symbol, user_id, future))
+        try:
+            return await asyncio.shield(future), False
+        finally:
+            if self.inflight.get(symbol) is future:
+                del self.inflight[symbol]
+
+    async def upstream_worker(self, connection):
+        while True:
+            batch = [await self.pending.get()]
+            while len(batch) < self.pipeline and not self.pending.empty():
+                batch.append(self.pending.get_nowait())
+
+            for _ in batch:
+                await self.limiter.acquire()
+
+            requests = [(symbol, user_id) for symbol, user_id, _ in batch]
+            for attempt in range(self._RETRIES):
+                try:
+                    lines = await connection.fetch(requests)
+                    break
+                except Exception as e:
+                    self.errors += 1
+                    print(f"Error: Quote server request failed (attempt {attempt+1}). {e}")
+                    sys.stdout.flush()
+                    await asyncio.sleep(0.1 * (attempt + 1))
+            else:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(ConnectionError("Quote server unavailable"))
+                continue
+
+            now = time.time()
+            for (symbol, _, future), line in zip(batch, lines):
+                fields = line.split(',')
+                self.fetched += 1
+                if len(fields) >= 5 and is_float(fields[0]):
+                    self.cache[symbol] = (fields, now + self.cache_ttl)
+                if not future.done():
+                    future.set_result(fields)
+
+    async def handle_client(self, reader, writer):
+        self.clients += 1
+        responses = asyncio.Queue() # Response tasks, written in request order.
+        sender = asyncio.ensure_future(self.send_responses(writer, responses))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                tokens = [t.strip() for t in line.decode('utf-8', errors='replace').split(',')]
+                if not tokens[0]:
+                    continue
+                user_id = tokens[1] if len(tokens) > 1 else ''
+                await responses.put(asyncio.ensure_future(self.respond(tokens[0], user_id)))
+        except ConnectionError:
+            pass
+        finally:
+            await responses.put(None)
+            await sender
+            writer.close()
+            self.clients -= 1
+
+    async def respond(self, symbol, user_id) -> bytes:
+        try:
+            fields, cached = await self.get(symbol, user_id)
+        except Exception:
+            return b'\n' # The worker reconnects and asks again.
+        if len(fields) < 5:
+            return b'\n'
+        fields = list(fields)
+        fields[1:3] = [symbol, user_id]
+        return (','.join(fields[:5]) + (',C\n' if cached else ',F\n')).encode('utf-8')
+
+    async def send_responses(self, writer, responses):
+        while True:
+            task = await responses.get()
+            if task is None:
+                return
+            try:
+                writer.write(await task)
+                await writer.drain()
+            except ConnectionError:
+                return
+
+    async def print_status(self):
+        while True:
+            await asyncio.sleep(self._PRINT_PERIOD)
+            print("Clients: {:>5} | Requests: {:>10} | Req/s: {:>8.1f} | Hits: {:>10} | Joined: {:>8} | Fetched: {:>8} | Rate limited: {:>8} | Errors: {:>6} | Cached: {:>6} |".format(
+                self.clients,
+                self.requests,
+                (self.requests - self._prev_requests) / self._PRINT_PERIOD,
+                self.hits,
+                self.joined,
+                self.fetched,
+                self.limiter.waits,
+                self.errors,
+                len(self.cache))
+            )
+            sys.stdout.flush()
+            self._prev_requests = self.requests
+
+
+def is_float(value: str) -> bool:
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
@@ -0,0 +1,36 @@
+import os
+import sys
+import signal
+import asyncio
+from gateway import QuoteGateway
+
+
+def main():
+    gateway = QuoteGateway(
+        upstream_host=os.environ.get("UPSTREAM_HOST", "192.168.4.2"),
+        upstream_port=int(os.environ.get("UPSTREAM_PORT", 4444)),
+        connections=int(os.environ.get("UPSTREAM_CONNECTIONS", 4)),
+        rate=float(os.environ.get("UPSTREAM_RATE", 0)),
+        pipeline=int(os.environ.get("UPSTREAM_PIPELINE", 1)),
+        timeout=float(os.environ.get("UPSTREAM_TIMEOUT", 5)),
+        cache_ttl=float(os.environ.get("GATEWAY_CACHE_TTL", 60))
+    )
+
+    loop = asyncio.get_event_loop()
+    port = int(os.environ.get("GATEWAY_PORT", 4444))
+    server = loop.run_until_complete(gateway.start("0.0.0.0", port))
+    print(f"Quote gateway listening on port {port}, upstream {gateway.upstream[0].host}:{gateway.upstream[0].port}")
+    sys.stdout.flush()
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        for connection in gateway.upstream:
+            connection.close()
+
+if __name__ == "__main__":
+    main()
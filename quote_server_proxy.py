@@ -1,101 +1,356 @@
-''' Most of code taken from
-https://github.com/pricheal/python-client-server/blob/master/server.py
+''' Local stand-in for the legacy quote server, used for testing and load testing.
 
-Added quote server capabilities on top of socket code
+A single selectors based event loop serves every connection so thousands of
+clients can be connected at once. Requests are newline terminated
+("SYM, userid\\n") and may be pipelined; responses follow the legacy format
+"Quote,Stock Symbol,USER NAME,QuoteServerTime,CryptoKey\\n".
+Response latency, jitter, error injection and the price model are configurable.
 '''
 
+from argparse import ArgumentParser
+import selectors
 import socket
-import threading
+import signal
 import random
+import heapq
+import time
+import math
+import sys
 
-#Variables for holding information about connections
-connections = []
-total_connections = 0
+parser = ArgumentParser(
+    description='Stand-in for the legacy quote server'
+)
+parser.add_argument('--host',
+    dest='host', default='localhost',
+    help='Address to listen on'
+)
+parser.add_argument('-p', '--port',
+    dest='port', type=int, default=4444,
+    help='Port to listen on'
+)
+parser.add_argument('--latency',
+    dest='latency', default='none', choices=['none', 'fixed', 'uniform', 'exponential', 'lognormal'],
+    help='Distribution of the response latency'
+)
+parser.add_argument('--latency-ms',
+    dest='latency_ms', type=float, default=0.0,
+    help='Mean response latency in milliseconds'
+)
+parser.add_argument('--jitter-ms',
+    dest='jitter_ms', type=float, default=0.0,
+    help='Uniform jitter (+/-) added to every response latency in milliseconds'
+)
+parser.add_argument('--error-rate',
+    dest='error_rate', type=float, default=0.0,
+    help='Fraction of requests that get an error instead of a quote'
+)
+parser.add_argument('--error-mode',
+    dest='error_mode', default='close', choices=['close', 'empty', 'garbage'],
+    help='Injected error: close the connection, send an empty line or send an unparsable quote'
+)
+parser.add_argument('--price-model',
+    dest='price_model', default='random', choices=['random', 'walk', 'static'],
+    help='random: new price every update, walk: random walk from the last price, static: never changes'
+)
+parser.add_argument('--update-interval',
+    dest='update_interval', type=float, default=60.0,
+    help='Seconds between price updates for a stock'
+)
+parser.add_argument('--volatility',
+    dest='volatility', type=float, default=0.02,
+    help='Standard deviation of each random walk step (fraction of the price)'
+)
+parser.add_argument('--stats-period',
+    dest='stats_period', type=float, default=10.0,
+    help='Seconds between printed stats (0 to disable)'
+)
+parser.add_argument('-v', '--verbose',
+    action='store_true', dest='verbose', default=False,
+    help='Print every request and per-connection stats on disconnect'
+)
 
-stocks = {}
+CRYPTOKEY = 'IRrR7UeTO35kSWUgG0QJKmB35sL27FKM7AVhP5qpjCgmWQeXFJs35g=='
 
-#Client class, new instance created for each connected client
-#Each instance has the socket and address that is associated with items
-#Along with an assigned ID and a name chosen by the client
-class Client(threading.Thread):
-    def __init__(self, socket, address, id, name, signal):
-        threading.Thread.__init__(self)
-        self.socket = socket
+
+class PriceModel():
+    ''' Prices are updated lazily when a stock is requested after its update time. '''
+
+    def __init__(self, model, update_interval, volatility):
+        self.model = model
+        self.update_interval = update_interval
+        self.volatility = volatility
+        self.stocks = {} # symbol -> [price, next update time]
+
+    def get(self, symbol, now) -> float:
+        stock = self.stocks.get(symbol)
+        if stock is None:
+            stock = [round(random.uniform(1, 5000), 2), now + self.update_interval]
+            self.stocks[symbol] = stock
+        elif self.model != 'static' and now >= stock[1]:
+            if self.model == 'walk':
+                stock[0] = max(0.01, round(stock[0] * math.exp(random.gauss(0, self.volatility)), 2))
+            else:
+                stock[0] = round(random.uniform(1, 5000), 2)
+            stock[1] = now + self.update_interval
+
+        return stock[0]
+
+
+class Latency():
+    def __init__(self, distribution, mean_ms, jitter_ms):
+        self.distribution = distribution
+        self.mean = mean_ms / 1000
+        self.jitter = jitter_ms / 1000
+
+    def sample(self) -> float:
+        ''' Returns a response delay in seconds. '''
+        if self.distribution == 'fixed':
+            delay = self.mean
+        elif self.distribution == 'uniform':
+            delay = random.uniform(0, 2 * self.mean)
+        elif self.distribution == 'exponential':
+            delay = random.expovariate(1 / self.mean) if self.mean > 0 else 0.0
+        elif self.distribution == 'lognormal':
+            # Median of mean/2 with a long tail.
+            delay = random.lognormvariate(math.log(self.mean / 2), 1.0) if self.mean > 0 else 0.0
+        else:
+            delay = 0.0
+
+        if self.jitter > 0:
+            delay += random.uniform(-self.jitter, self.jitter)
+        return max(delay, 0.0)
+
+
+class Connection():
+    def __init__(self, sock, address, id):
+        self.sock = sock
         self.address = address
         self.id = id
-        self.name = name
-        self.signal = signal
-    
+        self.in_buffer = bytearray()
+        self.out_buffer = bytearray()
+        self.closed = False
+        self.close_after_write = False
+        self.last_due = 0.0 # Responses on a connection are sent in request order
+
+        # Stats
+        self.connected_at = time.time()
+        self.requests = 0
+        self.responses = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.total_delay = 0.0
+
     def __str__(self):
-        return str(self.id) + " " + str(self.address)
-    
+        duration = time.time() - self.connected_at
+        avg_delay = (self.total_delay / self.responses * 1000) if self.responses else 0.0
+        return (f"Connection {self.id} {self.address}: {self.requests} requests, {self.responses} responses, "
+                f"{self.errors} errors, {self.bytes_in}B in, {self.bytes_out}B out, "
+                f"avg delay {avg_delay:.2f}ms, {self.requests/max(duration, 1e-9):.1f} req/s over {duration:.1f}s")
+
+
+class QuoteServer():
+    def __init__(self, args):
+        self.args = args
+        self.selector = selectors.DefaultSelector()
+        self.prices = PriceModel(args.price_model, args.update_interval, args.volatility)
+        self.latency = Latency(args.latency, args.latency_ms, args.jitter_ms)
+
+        self.connections = {}
+        self.total_connections = 0
+        self.total_requests = 0
+        self._prev_requests = 0
+
+        self._delayed = [] # Heap of (due time, sequence, connection, response)
+        self._sequence = 0
+        self._stopping = False
+        self._next_stats = time.time() + args.stats_period
+
     def run(self):
-        while self.signal:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.args.host, self.args.port))
+        listener.listen(4096)
+        listener.setblocking(False)
+        self.selector.register(listener, selectors.EVENT_READ, None)
+        print(f"Quote server listening on {self.args.host}:{self.args.port}")
+
+        while not self._stopping:
+            timeout = 1.0
+            if self._delayed:
+                timeout = min(timeout, max(self._delayed[0][0] - time.time(), 0.0))
+
+            for key, mask in self.selector.select(timeout):
+                if key.data is None:
+                    self.accept(key.fileobj)
+                else:
+                    connection = key.data
+                    if mask & selectors.EVENT_READ:
+                        self.read(connection)
+                    if mask & selectors.EVENT_WRITE and not connection.closed:
+                        self.write(connection)
+
+            self.send_due_responses()
+
+            if self.args.stats_period > 0 and time.time() >= self._next_stats:
+                self.print_stats()
+
+        for connection in list(self.connections.values()):
+            print(connection)
+            self.close(connection)
+        self.selector.close()
+        listener.close()
+
+    def stop(self):
+        self._stopping = True
+
+    def accept(self, listener):
+        while True:
             try:
-                data = self.socket.recv(32)
-                print(f"Received {data.decode('utf-8').rstrip()} from {str(self.address)}")
-            except:
-                print("Client " + str(self.address) + " has disconnected")
-                self.signal = False
-                connections.remove(self)
+                sock, address = listener.accept()
+            except BlockingIOError:
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            connection = Connection(sock, address, self.total_connections)
+            self.total_connections += 1
+            self.connections[connection.id] = connection
+            self.selector.register(sock, selectors.EVENT_READ, connection)
+            if self.args.verbose:
+                print(f"New connection at ID {connection.id} {address}")
+
+    def read(self, connection):
+        try:
+            data = connection.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+
+        if not data:
+            self.close(connection)
+            return
+
+        connection.bytes_in += len(data)
+        connection.in_buffer += data
+
+        # Handle every complete (possibly pipelined) request.
+        now = time.time()
+        while True:
+            end = connection.in_buffer.find(b'\n')
+            if end < 0:
                 break
-            if data != "":
-                data = data.decode("utf-8").rstrip()
+            line = bytes(connection.in_buffer[:end]).decode('utf-8', errors='replace').strip()
+            del connection.in_buffer[:end+1]
+            if line:
+                self.handle_request(connection, line, now)
+
+    def handle_request(self, connection, line, now):
+        connection.requests += 1
+        self.total_requests += 1
+        if self.args.verbose:
+            print(f"Received {line} from {connection.address}")
 
-                tokens = data.split(',')
-                if len(tokens) != 0:
-                    quote = self.get_quote(tokens[0])
-                    return_string = f"{quote},{tokens[0]},{tokens[1]},abcdefghijklmnopqrstuvwxyz\n"
+        tokens = [t.strip() for t in line.split(',')]
+        symbol = tokens[0]
+        user_id = tokens[1] if len(tokens) > 1 else ''
 
-                    self.socket.sendall(return_string.encode("utf-8"))
-                    print(f"Sent {return_string.rstrip()} to {str(self.address)}")
+        if self.args.error_rate > 0 and random.random() < self.args.error_rate:
+            connection.errors += 1
+            if self.args.error_mode == 'close':
+                response = None
+            elif self.args.error_mode == 'empty':
+                response = b'\n'
+            else:
+                response = f"ERROR,{symbol},{user_id},{int(now*1000)},{CRYPTOKEY}\n".encode('utf-8')
+        else:
+            price = self.prices.get(symbol, now)
+            response = f"{price:.2f},{symbol},{user_id},{int(now*1000)},{CRYPTOKEY}\n".encode('utf-8')
 
+        delay = self.latency.sample()
+        connection.total_delay += delay
+        due = max(now + delay, connection.last_due)
+        if delay <= 0 and due <= now:
+            self.respond(connection, response)
+        else:
+            connection.last_due = due
+            self._sequence += 1
+            heapq.heappush(self._delayed, (due, self._sequence, connection, response))
 
+    def send_due_responses(self):
+        now = time.time()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, connection, response = heapq.heappop(self._delayed)
+            if not connection.closed:
+                self.respond(connection, response)
 
-    def get_quote(self, stock_name):
-        global stocks
+    def respond(self, connection, response):
+        if response is None:
+            # Injected error: drop the connection once pending responses are sent.
+            connection.close_after_write = True
+            if not connection.out_buffer:
+                self.close(connection)
+            return
 
-        if stock_name not in stocks.keys():
-            self.update_stock(stock_name=stock_name)
+        connection.responses += 1
+        was_empty = not connection.out_buffer
+        connection.out_buffer += response
+        if was_empty:
+            self.write(connection)
 
-        return stocks.get(stock_name)
+    def write(self, connection):
+        try:
+            sent = connection.sock.send(connection.out_buffer)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.close(connection)
+            return
 
-    def update_stock(self, stock_name):
-        global stocks
+        connection.bytes_out += sent
+        del connection.out_buffer[:sent]
 
-        value = random.randrange(1, 5000)
-        stocks.update({stock_name: value})
-        print(f"Updated stock {stock_name} with value {value}")
+        if connection.out_buffer:
+            self.selector.modify(connection.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, connection)
+        else:
+            self.selector.modify(connection.sock, selectors.EVENT_READ, connection)
+            if connection.close_after_write:
+                self.close(connection)
 
-        threading.Timer(
-            interval=random.randrange(30, 120),
-            function=self.update_stock,
-            args=(stock_name,)
-        ).start()
+    def close(self, connection):
+        if connection.closed:
+            return
+        connection.closed = True
+        self.connections.pop(connection.id, None)
+        try:
+            self.selector.unregister(connection.sock)
+        except (KeyError, ValueError):
+            pass
+        connection.sock.close()
+        if self.args.verbose:
+            print(f"Client {connection.address} has disconnected\n\t{connection}")
 
+    def print_stats(self):
+        period = self.args.stats_period + (time.time() - self._next_stats)
+        print("Connections: {:>6} | Total connections: {:>8} | Requests: {:>10} | Req/s: {:>10.1f} | Delayed: {:>6} | Stocks: {:>6} |".format(
+            len(self.connections),
+            self.total_connections,
+            self.total_requests,
+            (self.total_requests - self._prev_requests) / period,
+            len(self._delayed),
+            len(self.prices.stocks))
+        )
+        sys.stdout.flush()
+        self._prev_requests = self.total_requests
+        self._next_stats = time.time() + self.args.stats_period
 
-#Wait for new connections
-def newConnections(socket):
-    while True:
-        sock, address = socket.accept()
-        global total_connections
-        connections.append(Client(sock, address, total_connections, "Name", True))
-        connections[len(connections) - 1].start()
-        print("New connection at ID " + str(connections[len(connections) - 1]))
-        total_connections += 1
 
 def main():
-    host = 'localhost'
-    port = 4444
-
-    #Create new server socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind((host, port))
-    sock.listen(5)
-
-    #Create new thread to wait for connections
-    newConnectionsThread = threading.Thread(target = newConnections, args = (sock,))
-    newConnectionsThread.start()
-    
-main()
\ No newline at end of file
+    server = QuoteServer(parser.parse_args())
+    signal.signal(signal.SIGINT, lambda signum, frame: server.stop())
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    server.run()
+
+if __name__ == "__main__":
+    main()
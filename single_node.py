@@ -0,0 +1,295 @@
+''' Runs the manager and the workers in one process, for throughput tests and profiling.
+
+Commands from a workload file are published to an in-process broker
+(transport.LocalBroker) instead of RabbitMQ, routed by the manager's Balancer
+and handled by the workers' CMDHandlers, with the same buffers, credits and
+priority lanes as the containers. Mongo, Redis and a quote server are still
+needed (quote_server_proxy.py can stand in for the quote server), except with
+--storage memory where accounts and logs are kept in the process instead of
+Mongo. Settings are read from .env like docker-compose does, the flags below
+override the hosts.
+
+Profiling:
+    python single_node.py -f workload.txt --profile single_node.prof
+profiles every thread and writes the combined stats. For sampling instead:
+    py-spy record -o single_node.svg -- python single_node.py -f workload.txt
+With --workers 1 --lanes 1 commands are handled in workload order.
+'''
+
+from argparse import ArgumentParser
+import importlib
+import threading
+import cProfile
+import pstats
+import gzip
+import time
+import sys
+import os
+
+parser = ArgumentParser(
+    description='Run the manager and workers in one process without RabbitMQ'
+)
+parser.add_argument('-f', '--file',
+    dest='filename', required=True,
+    help='Workload file (plain or .gz)',
+    metavar='FILE'
+)
+parser.add_argument('--workers',
+    dest='workers', type=int, default=1,
+    help='Number of workers'
+)
+parser.add_argument('--lanes',
+    dest='lanes', type=int, default=None,
+    help='Lanes per worker (NUM_LANES by default)'
+)
+parser.add_argument('--env-file',
+    dest='env_file', default='.env',
+    help='Settings used when they are not set in the environment'
+)
+parser.add_argument('--redis-host',
+    dest='redis_host', default='localhost',
+    help='Redis address'
+)
+parser.add_argument('--mongo-host',
+    dest='mongo_host', default='localhost',
+    help='Mongo address'
+)
+parser.add_argument('--quote-host',
+    dest='quote_host', default='localhost',
+    help='Quote server address'
+)
+parser.add_argument('--storage',
+    dest='storage', default=None, choices=['mongo', 'memory'],
+    help='Where accounts and logs are kept (STORAGE by default)'
+)
+parser.add_argument('--profile',
+    dest='profile', default=None,
+    help='Profile every thread with cProfile and write the stats to this file',
+    metavar='FILE'
+)
+args = parser.parse_args()
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# Top level module names the manager and the worker both have.
+SHARED_MODULES = ('credits', 'priority')
+
+def load_env(filename):
+    if not os.path.exists(filename):
+        return
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#') and '=' in line:
+                key, value = line.split('=', 1)
+                os.environ.setdefault(key, value)
+
+def import_service(src, names, keep_path=False):
+    ''' Imports modules from a service's src directory. Shared module names
+    imported by the previous service are dropped from sys.modules first, the
+    modules already holding references to them keep working.
+    '''
+    path = os.path.join(ROOT, src)
+    for name in SHARED_MODULES:
+        sys.modules.pop(name, None)
+    sys.path.insert(0, path)
+    try:
+        return [importlib.import_module(name) for name in names]
+    finally:
+        if not keep_path:
+            sys.path.remove(path)
+
+load_env(os.path.join(ROOT, args.env_file))
+os.environ["REDIS_HOST"] = args.redis_host
+os.environ["MONGODB_HOSTNAME"] = args.mongo_host
+os.environ["QUOTE_SERVER_HOST"] = args.quote_host
+os.environ["ROUTING_MODE"] = "balancer" # Nothing publishes straight to the workers here.
+os.environ["NUM_WORKERS"] = str(args.workers)
+os.environ.setdefault("SERVER_NAME", "single_node")
+if args.storage:
+    os.environ["STORAGE"] = args.storage
+NUM_LANES = args.lanes or int(os.environ.get("NUM_LANES", 4))
+
+# Profiles the threads started from here on, the main thread's profile is enabled in main().
+profiles = []
+def profile_thread(*_):
+    profile = cProfile.Profile()
+    profiles.append(profile)
+    profile.enable()
+if args.profile:
+    threading.setprofile(profile_thread)
+
+m_transport, m_balancer, m_confirms, m_dataclasses, m_ring_buffer, m_priority = import_service(
+    'manager/src', ['transport', 'balancer', 'confirms', 'dataclassesfile', 'ring_buffer', 'priority']
+)
+w_transport, w_publisher, w_ring_buffer, w_cmd_handler, w_executor, w_credits, w_bootstrap, w_pending_store, w_connection, w_accounts, w_account_repository, w_logs = import_service(
+    'worker/src', [
+        'rabbitmq.transport', 'rabbitmq.publisher', 'rabbitmq.ring_buffer', 'cmd_handler', 'executor', 'credits', 'bootstrap',
+        'database.pending_store', 'database.connection', 'database.accounts', 'database.account_repository', 'database.logs'
+    ],
+    keep_path=True
+)
+import pika
+import redis
+
+
+def start_manager(broker, workers):
+    ''' Same setup as manager/src/main.py, with the local broker in place of RabbitMQ. '''
+    capacity = int(os.environ.get("CONSUMER_BUFFER", 50000))
+    prefetch = min(int(os.environ.get("CONSUMER_PREFETCH", 1000)), capacity // 2)
+    consumer = m_transport.LocalConsumer(
+        broker=broker,
+        exchange_name=os.environ["FRONTEND_EXCHANGE"],
+        queue_name="frontend",
+        routing_key="frontend",
+        prefetch=prefetch,
+        queue_arguments=m_priority.QUEUE_ARGUMENTS,
+        with_properties=True
+    )
+    communication = m_ring_buffer.RingBuffer(
+        capacity=capacity,
+        high_watermark=capacity - prefetch,
+        low_watermark=(capacity - prefetch) // 2,
+        on_high=consumer.pause,
+        on_low=consumer.resume
+    )
+    consumer.communication = communication
+    runtime_data = m_dataclasses.RuntimeData(
+        active_commands=0,
+        mutex=threading.Lock()
+    )
+
+    confirms = m_confirms.Confirms(workers=workers, runtime_data=runtime_data, broker=broker)
+    confirms.connect() # Bound before any worker can confirm.
+    threading.Thread(target=consumer.run, daemon=True).start()
+    threading.Thread(target=confirms.run, daemon=True).start()
+
+    balancer = m_balancer.Balancer(
+        workers=workers,
+        communication=communication,
+        runtime_data=runtime_data,
+        broker=broker
+    )
+    balancer.setup()
+    return balancer, runtime_data
+
+def start_worker(broker, redis_cache, index):
+    ''' Same setup as worker/src/main.py, without replaying pending transactions. '''
+    route_key = f"worker_queue_{index}"
+    publisher = w_publisher.Publisher(broker=broker)
+    publisher.setup_communication()
+
+    capacity = int(os.environ.get("CONSUMER_BUFFER", 1000))
+    prefetch = min(int(os.environ.get("CONSUMER_PREFETCH", 100)), capacity // 2)
+    consumer = w_transport.LocalConsumer(
+        broker=broker,
+        exchange_name=os.environ["BACKEND_EXCHANGE"],
+        queue_name=route_key,
+        routing_key=route_key,
+        prefetch=prefetch,
+        queue_arguments=m_priority.QUEUE_ARGUMENTS,
+        with_properties=True
+    )
+    communication = w_ring_buffer.RingBuffer(
+        capacity=capacity,
+        high_watermark=capacity - prefetch,
+        low_watermark=(capacity - prefetch) // 2,
+        on_high=consumer.pause,
+        on_low=consumer.resume
+    )
+    consumer.communication = communication
+
+    pending_store = w_pending_store.PendingStore(redis_cache=redis_cache, route_key=route_key)
+    command_handlers = [w_cmd_handler.CMDHandler(response_publisher=publisher, redis_cache=redis_cache, pending_store=pending_store)]
+    for _ in range(1, NUM_LANES):
+        command_handlers.append(w_cmd_handler.CMDHandler(response_publisher=publisher, redis_cache=redis_cache, quote_polling=command_handlers[0].quote_polling, pending_store=pending_store))
+    executor = w_executor.LaneExecutor(command_handlers=command_handlers)
+
+    w_bootstrap.Bootstrap(
+        quote_polling=command_handlers[0].quote_polling,
+        redis_cache=redis_cache,
+        worker_index=index,
+        num_workers=args.workers,
+        batch_size=int(os.environ.get("BOOTSTRAP_BATCH_SIZE", 1000))
+    ).run()
+    executor.start()
+
+    w_credits.CreditReporter(
+        redis_cache=redis_cache,
+        route_key=route_key,
+        executor=executor,
+        capacity=int(os.environ.get("WORKER_CREDITS", capacity))
+    ).start()
+
+    def submit_commands():
+        while True:
+            for command, properties in communication.get_batch(timeout=1.0):
+                executor.submit(command, properties)
+
+    threading.Thread(target=consumer.run, daemon=True).start()
+    threading.Thread(target=submit_commands, daemon=True).start()
+    return m_dataclasses.Worker(container_id=f"single_node_{index}", commands=[], route_key=route_key)
+
+def read_workload(filename) -> list:
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as f:
+        return [line.strip() for line in f if line.strip()]
+
+def run_balancer(balancer, done):
+    while not done.is_set():
+        balancer.step()
+        sys.stdout.flush()
+
+def main():
+    if args.profile:
+        profile_thread()
+
+    broker = m_transport.LocalBroker()
+    redis_cache = redis.Redis(host=args.redis_host)
+
+    if w_connection.STORAGE != 'memory':
+        w_connection.wait_until_ready()
+        w_connection.prewarm(documents=[w_accounts.Accounts, *w_logs.EVENT_TYPES])
+        if w_logs.LOG_STORE == 'unified':
+            w_logs.events_collection()
+
+    # Workers first, so their queues are bound before the manager routes anything.
+    workers = [start_worker(broker, redis_cache, i) for i in range(args.workers)]
+    balancer, runtime_data = start_manager(broker, workers)
+    done = threading.Event()
+    t_balancer = threading.Thread(target=run_balancer, args=(balancer, done), daemon=True)
+    t_balancer.start()
+
+    # DUMPLOGs last, like frontend_proxy.py.
+    lines = read_workload(args.filename)
+    commands = [line for line in lines if b'DUMPLOG' not in line] + [line for line in lines if b'DUMPLOG' in line]
+    print(f"Publishing {len(commands)} commands to {args.workers} workers with {NUM_LANES} lanes each")
+    sys.stdout.flush()
+
+    start = time.time()
+    for line in commands:
+        properties = pika.BasicProperties(priority=m_priority.BULK_PRIORITY, headers={'ingress': time.time()})
+        broker.publish(os.environ["FRONTEND_EXCHANGE"], "frontend", line, properties)
+
+    # Every command is confirmed once handled (timed out BUYs and SELLs confirm again, so this can end early).
+    while runtime_data.confirmed < len(commands):
+        runtime_data.progress.wait(1.0)
+        runtime_data.progress.clear()
+    elapsed = time.time() - start
+    done.set()
+
+    print(f"Handled {len(commands)} commands in {elapsed:.3f}s ({len(commands) / elapsed:.1f} commands/s)")
+    if w_connection.STORAGE == 'memory':
+        print(f"In memory: {len(w_account_repository.account_repository)} accounts, {len(w_logs.event_log)} events")
+    if broker.dropped:
+        print(f"{broker.dropped} messages were not routed to any queue")
+
+    if args.profile:
+        pstats.Stats(*profiles).dump_stats(args.profile)
+        print(f"Wrote the profile of {len(profiles)} threads to {args.profile}")
+    sys.stdout.flush()
+
+    # The lanes, publishers and status timers never exit on their own.
+    os._exit(0)
+
+if __name__ == "__main__":
+    main()
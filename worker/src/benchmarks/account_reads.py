@@ -0,0 +1,111 @@
+''' Compares the mongoengine reads the handlers used to do with the raw pymongo
+account repository. Seeds synthetic accounts, times each query shape and removes
+the accounts again. Run from worker/src with the MONGODB_* variables set:
+
+    python3 -m benchmarks.account_reads --users 1000 --stocks 20 --iterations 5000
+'''
+
+from argparse import ArgumentParser
+import random
+import time
+import sys
+from database.accounts import Accounts
+from database.account_repository import ListAccountRepository
+
+parser = ArgumentParser(
+    description='Benchmark mongoengine vs raw pymongo account reads'
+)
+parser.add_argument('--users',
+    dest='users', type=int, default=1000,
+    help='Number of synthetic accounts to create'
+)
+parser.add_argument('--stocks',
+    dest='stocks', type=int, default=20,
+    help='Stocks and auto buys per account'
+)
+parser.add_argument('--iterations',
+    dest='iterations', type=int, default=5000,
+    help='Queries timed per query shape'
+)
+parser.add_argument('--prefix',
+    dest='prefix', default='bench_user_',
+    help='Prefix of the synthetic account ids'
+)
+
+def symbol(i):
+    return f"S{i:02d}"[:3]
+
+def seed(args):
+    documents = []
+    for u in range(args.users):
+        documents.append({
+            '_id': f"{args.prefix}{u}",
+            'account': 100000.0,
+            'available': 50000.0,
+            'stocks': [{'symbol': symbol(s), 'amount': 100, 'available': 50} for s in range(args.stocks)],
+            'auto_buy': [{'user_id': f"{args.prefix}{u}", 'symbol': symbol(s), 'amount': 10, 'trigger': 12.5} for s in range(args.stocks)],
+            'auto_sell': [{'user_id': f"{args.prefix}{u}", 'symbol': symbol(s), 'amount': 5, 'trigger': 40.0} for s in range(args.stocks)]
+        })
+    collection = Accounts._get_collection()
+    collection.delete_many({'_id': {'$regex': f"^{args.prefix}"}})
+    collection.insert_many(documents, ordered=False)
+
+def cleanup(args):
+    Accounts._get_collection().delete_many({'_id': {'$regex': f"^{args.prefix}"}})
+
+def timed(name, fn, args):
+    samples = []
+    for _ in range(args.iterations):
+        user_id = f"{args.prefix}{random.randrange(args.users)}"
+        stock_symbol = symbol(random.randrange(args.stocks))
+        start = time.perf_counter()
+        fn(user_id, stock_symbol)
+        samples.append(time.perf_counter() - start)
+
+    samples.sort()
+    total = sum(samples)
+    print("{:<32} | ops/s: {:>9.1f} | mean: {:>8.1f}us | p50: {:>8.1f}us | p99: {:>8.1f}us |".format(
+        name,
+        len(samples) / total,
+        total / len(samples) * 1e6,
+        samples[len(samples)//2] * 1e6,
+        samples[int(len(samples)*0.99)] * 1e6)
+    )
+    sys.stdout.flush()
+
+def main():
+    args = parser.parse_args()
+    repository = ListAccountRepository()
+
+    def me_available(user_id, stock_symbol):
+        return Accounts.objects(__raw__={'_id': user_id}).only('available').first().available
+
+    def me_stock(user_id, stock_symbol):
+        return Accounts.objects(__raw__={'_id': user_id}).only('stocks').first().stocks.get(symbol=stock_symbol)
+
+    def me_auto_buy(user_id, stock_symbol):
+        account = Accounts.objects(__raw__={'_id': user_id}).only('auto_buy', 'available').first()
+        return account.auto_buy.get(symbol=stock_symbol), account.available
+
+    def me_auto_with_stock(user_id, stock_symbol):
+        account = Accounts.objects(__raw__={'_id': user_id}).only('auto_sell', 'available', 'account', 'stocks').first()
+        return account.auto_sell.get(symbol=stock_symbol), account.stocks.get(symbol=stock_symbol)
+
+    shapes = [
+        ('available', me_available, lambda u, s: repository.get_available(u)),
+        ('stock', me_stock, repository.get_stock),
+        ('auto_buy + available', me_auto_buy, lambda u, s: repository.get_auto_buy(u, s, with_available=True)),
+        ('auto_sell + stock', me_auto_with_stock, lambda u, s: repository.get_auto_with_stock(repository.AUTO_SELL, u, s))
+    ]
+
+    print(f"Seeding {args.users} accounts with {args.stocks} stocks each")
+    seed(args)
+    try:
+        for name, me_fn, repo_fn in shapes:
+            timed(f"mongoengine {name}", me_fn, args)
+            timed(f"repository {name}", repo_fn, args)
+    finally:
+        cleanup(args)
+
+if __name__ == "__main__":
+    main()
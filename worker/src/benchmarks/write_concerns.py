@@ -0,0 +1,120 @@
+''' Measures the time each command spends on Mongo writes under different write
+concern policies. Every command is replayed as the writes its handler makes on the
+success path (logs and account updates, quotes assumed cached) against scratch
+collections, which are dropped afterwards. Run from worker/src with the MONGODB_*
+variables set:
+
+    python3 -m benchmarks.write_concerns --iterations 2000
+
+The "configured" profile is the worker's policy, including WRITE_CONCERNS overrides.
+'''
+
+from argparse import ArgumentParser
+import time
+import sys
+from database.accounts import Accounts
+from database.write_concern import POLICIES, with_write_concern
+
+parser = ArgumentParser(
+    description='Benchmark the per command latency of the write concern policies'
+)
+parser.add_argument('--iterations',
+    dest='iterations', type=int, default=2000,
+    help='Times each command is replayed per profile'
+)
+parser.add_argument('--prefix',
+    dest='prefix', default='bench_wc_',
+    help='Prefix of the scratch collections'
+)
+
+# Writes made by each handler on its success path, in order.
+COMMANDS = {
+    'ADD': ['userCommand', 'debugEvent', 'accounts', 'accountTransaction'],
+    'QUOTE': ['userCommand', 'systemEvent'],
+    'BUY': ['userCommand', 'systemEvent', 'debugEvent', 'debugEvent', 'accounts'],
+    'COMMIT_BUY': ['userCommand', 'accounts', 'accountTransaction', 'debugEvent'],
+    'SELL': ['userCommand', 'systemEvent', 'debugEvent', 'debugEvent', 'accounts'],
+    'SET_BUY_AMOUNT': ['userCommand', 'debugEvent', 'debugEvent', 'debugEvent', 'accounts'],
+    'SET_SELL_TRIGGER': ['userCommand', 'debugEvent', 'debugEvent', 'debugEvent', 'accounts']
+}
+
+PROFILES = {
+    'acknowledged': {name: {'w': 1} for name in POLICIES},
+    'configured': POLICIES,
+    'journaled': {name: {'w': 1, 'j': True} for name in POLICIES}
+}
+
+BENCH_USER = 'bench_wc_user'
+
+def log_document(name, n) -> dict:
+    return {
+        'timestamp': round(time.time()*1000),
+        'server': 'bench',
+        'transactionNum': n,
+        'command': name,
+        'username': BENCH_USER,
+        'stockSymbol': 'ABC',
+        'funds': 100.0,
+        'debugMessage': 'New BUY timer started'
+    }
+
+def run_profile(db, policies, args) -> dict:
+    ''' Returns command -> sorted per command latencies in seconds. '''
+    collections = {
+        name: with_write_concern(db[f"{args.prefix}{name}"], policy)
+        for name, policy in policies.items()
+    }
+    collections['accounts'].replace_one({'_id': BENCH_USER}, {'_id': BENCH_USER, 'account': 0.0, 'available': 0.0}, upsert=True)
+
+    results = {}
+    n = 0
+    for command, writes in COMMANDS.items():
+        samples = []
+        for _ in range(args.iterations):
+            n += 1
+            start = time.perf_counter()
+            for name in writes:
+                if name == 'accounts':
+                    collections[name].update_one({'_id': BENCH_USER}, {'$inc': {'account': 1.0, 'available': 1.0}})
+                else:
+                    collections[name].insert_one(log_document(name, n))
+            samples.append(time.perf_counter() - start)
+        samples.sort()
+        results[command] = samples
+    return results
+
+def cleanup(db, args):
+    for name in POLICIES:
+        db[f"{args.prefix}{name}"].drop()
+
+def main():
+    args = parser.parse_args()
+    db = Accounts._get_db()
+
+    results = {}
+    try:
+        for profile, policies in PROFILES.items():
+            print(f"Running {profile}: {policies}")
+            sys.stdout.flush()
+            results[profile] = run_profile(db, policies, args)
+            cleanup(db, args)
+    finally:
+        cleanup(db, args)
+
+    baseline = results['acknowledged']
+    for command in COMMANDS:
+        base_mean = sum(baseline[command]) / len(baseline[command])
+        for profile, samples in results.items():
+            mean = sum(samples) / len(samples)
+            print("{:<17} | {:<12} | mean: {:>8.1f}us | p50: {:>8.1f}us | p99: {:>8.1f}us | delta: {:>+8.1f}us |".format(
+                command,
+                profile,
+                mean * 1e6,
+                samples[len(samples)//2] * 1e6,
+                samples[int(len(samples)*0.99)] * 1e6,
+                (mean - base_mean) * 1e6)
+            )
+    sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
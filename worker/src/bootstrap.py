@@ -0,0 +1,118 @@
+import sys
+import time
+import hashlib
+import threading
+from database.accounts import Accounts
+from database.account_repository import auto_entries
+from database import user_cache
+from database.connection import STORAGE
+
+# Only the fields needed to rebuild the polling structures are read (from either account layout).
+PROJECTION = {
+    '_id': 1,
+    'layout': 1,
+    'auto_buy.symbol': 1,
+    'auto_buy.trigger': 1,
+    'auto_buy.transactionNum': 1,
+    'auto_sell.symbol': 1,
+    'auto_sell.trigger': 1,
+    'auto_sell.transactionNum': 1,
+    'auto_buy_map': 1,
+    'auto_sell_map': 1
+}
+
+
+def calculate_worker_index(uid: str, NUM_WORKERS: int):
+    ''' Same hashing the manager uses to route a user to a worker. Must match manager/src/balancer.py. '''
+    worker_index = hashlib.sha256(uid.encode('utf-8')).digest()
+    worker_index = int.from_bytes(worker_index, byteorder='big', signed=False) % NUM_WORKERS
+    return worker_index
+
+
+class Bootstrap:
+    '''
+    Loads this worker's users and their auto buy/sell triggers from Mongo on startup so
+    triggers set before a restart are polled again and user lookups start warm.
+    Eager mode streams every account with one batched cursor before commands are consumed.
+    Lazy mode pages through the accounts by _id on a background thread instead.
+    With STORAGE=memory nothing outlives the process, so there is nothing to load.
+    '''
+
+    def __init__(self, quote_polling, redis_cache, worker_index, num_workers, batch_size=1000):
+        self.quote_polling = quote_polling
+        self.redis_cache = redis_cache
+        self.worker_index = worker_index
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+
+        # Stats
+        self.accounts_scanned = 0
+        self.users_loaded = 0
+        self.auto_buys_loaded = 0
+        self.auto_sells_loaded = 0
+        self.load_time = 0.0
+
+        self.thread = None
+
+    def run(self):
+        ''' Loads every account using one batched cursor. '''
+        start = time.time()
+        if STORAGE != 'memory':
+            cursor = Accounts._get_collection().find({}, PROJECTION, batch_size=self.batch_size)
+            self._load_documents(cursor)
+        self.load_time = time.time() - start
+        self.print_status()
+
+    def run_lazy(self):
+        ''' Loads the accounts a page at a time on a background thread. Returns immediately. '''
+        self.thread = threading.Thread(target=self._run_paged)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _run_paged(self):
+        start = time.time()
+        collection = Accounts._get_collection() if STORAGE != 'memory' else None
+        last_id = None
+        while collection is not None:
+            query = {} if last_id is None else {'_id': {'$gt': last_id}}
+            page = list(collection.find(query, PROJECTION).sort('_id', 1).limit(self.batch_size))
+            if not page:
+                break
+            self._load_documents(page)
+            last_id = page[-1]['_id']
+
+        self.load_time = time.time() - start
+        self.print_status()
+
+    def _load_documents(self, documents):
+        user_ids = []
+        for document in documents:
+            self.accounts_scanned += 1
+            user_id = document['_id']
+            if calculate_worker_index(user_id, self.num_workers) != self.worker_index:
+                continue
+
+            user_ids.append(user_id)
+            if len(user_ids) >= self.batch_size:
+                self.users_loaded += user_cache.add_users(user_ids, redis_cache=self.redis_cache, batch_size=self.batch_size)
+                user_ids = []
+
+            for auto_buy in auto_entries(document, 'auto_buy'):
+                # A trigger of 0 means SET_BUY_TRIGGER has not been issued yet.
+                if auto_buy.get('trigger', 0) > 0:
+                    self.quote_polling.add_user_autobuy(user_id, auto_buy['symbol'], auto_buy.get('transactionNum', 0), "SET_BUY_TRIGGER", persist=False)
+                    self.auto_buys_loaded += 1
+
+            for auto_sell in auto_entries(document, 'auto_sell'):
+                # Same for SET_SELL_TRIGGER.
+                if auto_sell.get('trigger', 0) > 0:
+                    self.quote_polling.add_user_autosell(user_id, auto_sell['symbol'], auto_sell.get('transactionNum', 0), "SET_SELL_TRIGGER", persist=False)
+                    self.auto_sells_loaded += 1
+
+        if user_ids:
+            self.users_loaded += user_cache.add_users(user_ids, redis_cache=self.redis_cache, batch_size=self.batch_size)
+
+    def print_status(self):
+        print(f"Bootstrap loaded {self.users_loaded} users, {self.auto_buys_loaded} auto buys and "
+              f"{self.auto_sells_loaded} auto sells from {self.accounts_scanned} accounts in {self.load_time:.3f}s")
+        sys.stdout.flush()
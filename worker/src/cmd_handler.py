@@ -1,11 +1,15 @@
-from database.accounts import Accounts, Stocks, AutoTransaction
-from database.logs import get_logs, AccountTransactionType, UserCommandType, SystemEventType, ErrorEventType, DebugType
+from database.account_repository import account_repository
+from database.logs import get_logs, begin_batch, flush_batch, AccountTransactionType, UserCommandType, SystemEventType, ErrorEventType, DebugType
+from database.debug_config import VERBOSE
 from database.user_cache import add_user
-from mongoengine import DoesNotExist
+from database.pending_store import PendingStore
 from rabbitmq.publisher import Publisher
 from threading import Timer
 from math import floor
-from legacy import quote, quote_cache, quote_polling
+from legacy import quote, quote_cache
+from legacy import quote_polling as quote_polling_module
+from legacy.quote_bus import QuoteSubscriber
+from legacy import refresh_ahead
 from LogFile import log_handler
 import time
 import decimal
@@ -17,13 +21,16 @@ import traceback
 
 class CMDHandler:
 
-    def __init__(self, response_publisher : Publisher, redis_cache):
+    def __init__(self, response_publisher : Publisher, redis_cache, quote_polling=None, pending_store=None):
         # Response publisher.
         self.response_publisher = response_publisher
 
         # Redis cache
         self.redis_cache = redis_cache
 
+        # Persists the pending transactions below so they survive a restart (optional).
+        self.pending_store = pending_store
+
         # Auto-buy.
         self.uncommitted_buys = {} # which users have a pending buy, and the transaction info
         self.uncommitted_buy_timers = {} # the timer for each pending buy
@@ -34,11 +41,63 @@ class CMDHandler:
         self.pending_sell_triggers = {} # Holds pending auto sells until a sell trigger is given.
 
         # Quote polling for auto buy/sell.
+        # Handlers running in the same worker share one set of polling stocks and polling thread.
         self.POLLING_RATE = 120 # 120 seconds
-        self.quote_polling = quote_polling.UserPollingStocks()
-        self.polling_thread = quote_polling.QuotePollingThread(quote_polling = self.quote_polling, polling_rate = self.POLLING_RATE, response_publisher = response_publisher, redis_cache = redis_cache)
-        self.polling_thread.setDaemon(True) # Will be cleaned up on exit.
-        self.polling_thread.start()
+        if quote_polling is not None:
+            self.quote_polling = quote_polling
+            self.polling_thread = None
+            self.quote_subscriber = None
+            self.refresh_thread = None
+        else:
+            self.quote_polling = quote_polling_module.UserPollingStocks(pending_store=pending_store)
+            self.polling_thread = quote_polling_module.QuotePollingThread(quote_polling = self.quote_polling, polling_rate = self.POLLING_RATE, response_publisher = response_publisher, redis_cache = redis_cache)
+            self.polling_thread.setDaemon(True) # Will be cleaned up on exit.
+            self.polling_thread.start()
+
+            # Quotes fetched by the other workers.
+            self.quote_subscriber = QuoteSubscriber(redis_cache=redis_cache) if quote_cache.QUOTE_BUS else None
+            if self.quote_subscriber is not None:
+                self.quote_subscriber.start()
+
+            # Refreshes quotes that are in demand before they expire.
+            self.refresh_thread = refresh_ahead.RefreshAheadThread(quote_polling=self.quote_polling, redis_cache=redis_cache) if refresh_ahead.REFRESH_AHEAD else None
+            if self.refresh_thread is not None:
+                self.refresh_thread.start()
+
+    def persist_pending(self, kind, user_id, value, stock_symbol=None):
+        if self.pending_store is not None:
+            self.pending_store.put(kind, user_id, value, stock_symbol)
+
+    def remove_pending(self, kind, user_id, stock_symbol=None):
+        if self.pending_store is not None:
+            self.pending_store.remove(kind, user_id, stock_symbol)
+
+    def restore_pending(self, kind, user_id, stock_symbol, value):
+        '''
+        Rebuilds a pending transaction replayed from the pending store.
+        Commit timers are restarted with the time they had left; ones that expired
+        while the worker was down fire right away and release the reserved funds/stocks.
+        '''
+        if kind == PendingStore.SELL_TRIGGER:
+            self.pending_sell_triggers[(user_id, stock_symbol)] = {'sell_amount': value['sell_amount']}
+            return
+
+        if kind == PendingStore.BUY:
+            uncommitted, timers, cancel, committed = self.uncommitted_buys, self.uncommitted_buy_timers, self.cancel_buy, account_repository.BUY
+        elif kind == PendingStore.SELL:
+            uncommitted, timers, cancel, committed = self.uncommitted_sells, self.uncommitted_sell_timers, self.cancel_sell, account_repository.SELL
+        else:
+            return
+
+        # Committed before the worker went down but not yet removed from the store.
+        if account_repository.last_commit(user_id, committed) == value['transactionNum']:
+            self.remove_pending(kind, user_id)
+            return
+
+        uncommitted[user_id] = {'stock': value['stock'], 'num_stocks': value['num_stocks'], 'quote': value['quote'], 'amount': value['amount'], 'transactionNum': value['transactionNum']}
+        commit_timer = Timer(max(value['deadline'] - time.time(), 0.0), cancel, [value['transactionNum'], [user_id]])
+        commit_timer.start()
+        timers[user_id] = commit_timer
 
     # params: user_id, amount
     def add(self, transactionNum, params) -> str:
@@ -49,17 +108,10 @@ class CMDHandler:
         # Get the user
         # Note: user.account will return a 'float' if the user
         # has not been created, and 'decimal.Decimal` if they have been.
-        if Accounts().user_exists(user_id=user_id, redis_cache=self.redis_cache):
+        if account_repository.user_exists(user_id, self.redis_cache):
             
             # Update the account.
-            update = {
-                'inc__account': decimal.Decimal(amount),
-                'inc__available': decimal.Decimal(amount)
-            }
-            ret = Accounts.objects(pk=user_id).update_one(**update)
-
-            # Check the update succeeded.
-            if ret != 1:
+            if not account_repository.add_funds(user_id, amount):
                 err_msg = f"[{transactionNum}] Error: Failed to update account {user_id}."
                 # print(err_msg)
                 ErrorEventType().log(transactionNum=transactionNum, command="ADD", username=user_id, errorMessage=err_msg)
@@ -68,10 +120,7 @@ class CMDHandler:
         else:
             
             # Create the user if they don't exist.
-            user = Accounts(user_id=user_id)
-            user.account = user.account + amount
-            user.available = user.available + amount
-            user.save()
+            account_repository.create_account(user_id, amount)
 
             # Add to cache
             add_user(user_id=user_id, redis_cache=self.redis_cache)
@@ -95,14 +144,15 @@ class CMDHandler:
 
         UserCommandType().log(transactionNum=transactionNum, command="QUOTE", username=user_id, stockSymbol=stock_symbol)
 
-        if not Accounts().user_exists(user_id=user_id, redis_cache=self.redis_cache):
+        user_exists, cached_quote = account_repository.user_exists_with_quote(user_id, stock_symbol, self.redis_cache)
+        if not user_exists:
             # Invalid command.
             err_msg = f"[{transactionNum}] Error: User {user_id} does not exist."
             ErrorEventType().log(transactionNum=transactionNum, command="QUOTE", errorMessage=err_msg)
             return err_msg
 
         # Get the quote from the stock server
-        value = quote.get_quote(user_id, stock_symbol, transactionNum, "QUOTE", self.redis_cache)
+        value = quote.get_quote(user_id, stock_symbol, transactionNum, "QUOTE", self.redis_cache, cached_quote=cached_quote)
 
         # Forward the quote to the frontend so the user can see it
         ok_msg = f"[{transactionNum}] {stock_symbol} has value ${value:.2f}."
@@ -120,14 +170,15 @@ class CMDHandler:
         UserCommandType().log(transactionNum=transactionNum, command="BUY", username=user_id, stockSymbol=stock_symbol, funds=max_debt)
 
         # Check if the user exists.
-        if not Accounts().user_exists(user_id=user_id, redis_cache=self.redis_cache):
+        user_exists, cached_quote = account_repository.user_exists_with_quote(user_id, stock_symbol, self.redis_cache)
+        if not user_exists:
             # Invalid command.
             err_msg = f"[{transactionNum}] Error: User {user_id} does not exist."
             ErrorEventType().log(transactionNum=transactionNum, command="BUY", errorMessage=err_msg)
             return err_msg
 
         # Get a quote for the stock the user wants to buy
-        value = quote.get_quote(user_id, stock_symbol, transactionNum, "BUY", self.redis_cache)
+        value = quote.get_quote(user_id, stock_symbol, transactionNum, "BUY", self.redis_cache, cached_quote=cached_quote)
 
         # Find the number of stocks the user can buy
         num_stocks = floor(max_debt/value) # Ex. max_dept=$100,value=$15per/stock-> num_stocks=6
@@ -138,30 +189,26 @@ class CMDHandler:
             ErrorEventType().log(transactionNum=transactionNum, command="BUY", username=user_id, stockSymbol=stock_symbol, errorMessage=err_msg)
             return err_msg
         
-        # Check if the user has enough money available
+        # Decrement the amount of available funds until a COMMIT or CANCEL happens. This is essentially reserving the funds.
+        # Only succeeds if the user has enough money available.
         trans_price = value*num_stocks
-        users_account = Accounts.objects(__raw__={"_id": user_id}).only('available').first()
-        if users_account is not None and trans_price > users_account.available:
+        if account_repository.reserve_funds(user_id, trans_price) is None:
+            if account_repository.get_available(user_id) is None:
+                err_msg = f"[{transactionNum}] Error: Failed to update account {user_id}."
+                #print(err_msg)
+                ErrorEventType().log(transactionNum=transactionNum, command="BUY", username=user_id, errorMessage=err_msg)
+                return err_msg
+
             # Notify the user they don't have enough available funds.
             err_msg = f"[{transactionNum}] Error: (Buy) Insufficient funds to purchase stock {stock_symbol}."
             #print(err_msg)
             ErrorEventType().log(transactionNum=transactionNum, command="BUY", username=user_id, stockSymbol=stock_symbol, errorMessage=err_msg)
             return err_msg
-
-        else:
-            # Decrement the amount of available funds until a COMMIT or CANCEL happens. This is essentially reserving the funds.
-            ret = Accounts.objects(pk=user_id).update_one(inc__available=-decimal.Decimal(trans_price))
-
-            # Check the update succeeded.
-            if ret != 1:
-                err_msg = f"[{transactionNum}] Error: Failed to update account {user_id}."
-                #print(err_msg)
-                ErrorEventType().log(transactionNum=transactionNum, command="BUY", username=user_id, errorMessage=err_msg)
-                return err_msg
         
         # Add the uncommitted buy to the list.
-        uncommitted_buy = {user_id: {'stock': stock_symbol, 'num_stocks': num_stocks, 'quote': value, 'amount': max_debt}}
+        uncommitted_buy = {user_id: {'stock': stock_symbol, 'num_stocks': num_stocks, 'quote': value, 'amount': max_debt, 'transactionNum': transactionNum}}
         self.uncommitted_buys.update(uncommitted_buy)
+        self.persist_pending(PendingStore.BUY, user_id, dict(uncommitted_buy[user_id], deadline=time.time() + 60.0))
         
         # Cancel any previous timers for this user. There can only be one pending buy at a time.
         previous_timer = self.uncommitted_buy_timers.pop(user_id, None)
@@ -189,7 +236,7 @@ class CMDHandler:
         UserCommandType().log(transactionNum=transactionNum, command="COMMIT_BUY", username=user_id)
 
         # Check if the user exists.
-        if not Accounts().user_exists(user_id=user_id, redis_cache=self.redis_cache):
+        if not account_repository.user_exists(user_id, self.redis_cache):
             # Invalid command.
             err_msg = f"[{transactionNum}] Error: User {user_id} does not exist."
             ErrorEventType().log(transactionNum=transactionNum, command="COMMIT_BUY", errorMessage=err_msg)
@@ -212,32 +259,17 @@ class CMDHandler:
 
         # Complete the transaction. Note: the amount has already been deducted from the available funds.
         cost = decimal.Decimal(users_buy['num_stocks'] * users_buy['quote'])
-        user_account = Accounts.objects(__raw__={"_id": user_id}).only('stocks', 'account').first()
-        try:
-            users_stock = user_account.stocks.get(symbol=users_buy['stock'])
-        except DoesNotExist:
-            # Create a new stock. Deduct the cost of the stock.
-            new_stock = Stocks(symbol=users_buy['stock'], amount=users_buy['num_stocks'], available=users_buy['num_stocks'])   
-            update = {
-                'inc__account': -cost,
-                'push__stocks': new_stock
-            }
-            ret = Accounts.objects(pk=user_id).update_one(**update)
-        else:
-            # Increment the existing stock. Deduct the cost of the stock.
-            update = {
-                'inc__account': -cost,
-                'inc__stocks__S__amount': users_buy['num_stocks'],
-                'inc__stocks__S__available': users_buy['num_stocks']
-            }
-            ret = Accounts.objects(pk=user_id, stocks__symbol=users_buy['stock']).update_one(**update)
-
+        # Add the stock (created if new) and deduct the cost of the stock.
         # Check the update succeeded.
-        if ret != 1:
+        # The BUY's transactionNum is recorded with the update so a replay after a crash
+        # below knows the funds were spent and doesn't start a timer that refunds them.
+        if not account_repository.buy_stock(user_id, users_buy['stock'], users_buy['num_stocks'], cost, transaction_num=users_buy['transactionNum']):
             err_msg = f"[{transactionNum}] Error: (CommitBuy) Failed to update account {user_id}."
             #print(err_msg)
             ErrorEventType().log(transactionNum=transactionNum, command="COMMIT_BUY", username=user_id, errorMessage=err_msg)
             return err_msg
+        # Kept until the account is updated, so a restart before that still releases the reserved funds.
+        self.remove_pending(PendingStore.BUY, user_id)
 
         # Notify the user.
         AccountTransactionType().log(transactionNum=transactionNum, action="remove", username=user_id, funds=cost)
@@ -254,7 +286,7 @@ class CMDHandler:
         UserCommandType().log(transactionNum=transactionNum, command="CANCEL_BUY", username=user_id)
 
         # Check if the user exists.
-        if not Accounts().user_exists(user_id=user_id, redis_cache=self.redis_cache):
+        if not account_repository.user_exists(user_id, self.redis_cache):
             # Invalid command.
             err_msg = f"[{transactionNum}] Error: User {user_id} does not exist."
             #print(err_msg)
@@ -275,11 +307,10 @@ class CMDHandler:
             #print(err_msg)
             ErrorEventType().log(transactionNum=transactionNum, command="CANCEL_BUY", username=user_id, errorMessage=err_msg)
             return err_msg
+        self.remove_pending(PendingStore.BUY, user_id)
 
-        # Free the reserved funds.
-        ret = Accounts.objects(pk=user_id).update_one(inc__available=decimal.Decimal(users_buy['num_stocks'] * users_buy['quote']))
-        # Check the update succeeded.
-        if ret != 1:
+        # Free the reserved funds and check the update succeeded.
+        if not account_repository.add_funds(user_id, users_buy['num_stocks'] * users_buy['quote'], to_account=False):
             err_msg = f"[{transactionNum}] Error: Failed to update account {user_id}."
             #print(err_msg)
             ErrorEventType().log(transactionNum=transactionNum, command="CANCEL_BUY", username=user_id, errorMessage=err_msg)
@@ -301,7 +332,8 @@ class CMDHandler:
         UserCommandType().log(transactionNum=transactionNum, command="SELL", username=user_id, stockSymbol=stock_symbol, funds=sell_amount)
 
         # Check if the user exists.
-        if not Accounts().user_exists(user_id=user_id, redis_cache=self.redis_cache):
+        user_exists, cached_quote = account_repository.user_exists_with_quote(user_id, stock_symbol, self.redis_cache)
+        if not user_exists:
             # Invalid command.
             err_msg = f"[{transactionNum}] Error: User {user_id} does not exist."
             ErrorEventType().log(transactionNum=transactionNum, command="SELL", errorMessage=err_msg)
@@ -309,31 +341,28 @@ class CMDHandler:
             return err_msg
 
         # Get a quote for the stock the user wants to sell
-        value = quote.get_quote(user_id, stock_symbol, transactionNum, "SELL", self.redis_cache)
+        value = quote.get_quote(user_id, stock_symbol, transactionNum, "SELL", self.redis_cache, cached_quote=cached_quote)
+
+        # Set aside the needed number of stocks. Only succeeds if the user has enough of the given stock.
+        num_to_sell = floor( sell_amount / value )
+        if account_repository.reserve_stock(user_id, stock_symbol, num_to_sell) is None:
+            # Find out why the stocks could not be reserved.
+            users_stock = account_repository.get_stock(user_id, stock_symbol)
+            if users_stock is None:
+                # The user does not own any of the stock they want to sell.
+                err_msg = f"[{transactionNum}] Error: Invalid SELL command. The stock {stock_symbol} is not owned."
+                #print(err_msg)
+                ErrorEventType().log(transactionNum=transactionNum, command="SELL", username=user_id, stockSymbol=stock_symbol, errorMessage=err_msg)
+                return err_msg
 
-        # Find the number of stocks the user owns.
-        users_account = Accounts.objects(__raw__={'_id': user_id}).only('stocks').first()
-        try:
-            users_stock = users_account.stocks.get(symbol=stock_symbol)
             if users_stock.amount == 0: # Remove this stock since it's empty.
-                ret = Accounts.objects(pk=user_id).update_one(pull__stocks__symbol=stock_symbol)
-                if ret != 1:
+                if not account_repository.remove_empty_stock(user_id, stock_symbol):
                     # Failed to update account.
                     err_msg = f"[{transactionNum}] Error: (Sell) Could not remove empty stock from account {user_id}."
                     #print(err_msg)
                     ErrorEventType().log(transactionNum=transactionNum, command="SELL", username=user_id, stockSymbol=stock_symbol, funds=sell_amount, errorMessage=err_msg)
                     return err_msg
 
-        except DoesNotExist:
-            # The user does not own any of the stock they want to sell.
-            err_msg = f"[{transactionNum}] Error: Invalid SELL command. The stock {stock_symbol} is not owned."
-            #print(err_msg)
-            ErrorEventType().log(transactionNum=transactionNum, command="SELL", username=user_id, stockSymbol=stock_symbol, errorMessage=err_msg)
-            return err_msg
-        
-        # Check if the user has enough of the given stock.
-        num_to_sell = floor( sell_amount / value )
-        if num_to_sell > users_stock.available:
             # The user does not own enough of this stock
             err_msg = f"[{transactionNum}] Error: Insufficient number of stocks owned. Stocks needed ({num_to_sell}), stocks available ({users_stock.available})."
             #print(err_msg)
@@ -341,17 +370,9 @@ class CMDHandler:
             return err_msg
 
         # Add the uncommitted sell to the list.
-        uncommitted_sell = {user_id: {'stock': stock_symbol, 'num_stocks': num_to_sell, 'quote': value, 'amount': sell_amount}}
+        uncommitted_sell = {user_id: {'stock': stock_symbol, 'num_stocks': num_to_sell, 'quote': value, 'amount': sell_amount, 'transactionNum': transactionNum}}
         self.uncommitted_sells.update(uncommitted_sell)
-
-        # Set aside the needed number of stocks.
-        ret = Accounts.objects(pk=user_id, stocks__symbol=stock_symbol).update_one(inc__stocks__S__available=-decimal.Decimal(num_to_sell))
-        # Check the update succeeded.
-        if ret != 1:
-            err_msg = f"[{transactionNum}] Error: Failed to update account {user_id}."
-            #print(err_msg)
-            ErrorEventType().log(transactionNum=transactionNum, command="SELL", username=user_id, errorMessage=err_msg)
-            return err_msg
+        self.persist_pending(PendingStore.SELL, user_id, dict(uncommitted_sell[user_id], deadline=time.time() + 60.0))
 
         # Cancel any previous timers for this user. There can only be one pending sell at a time.
         previous_timer = self.uncommitted_sell_timers.pop(user_id, None)
@@ -382,7 +403,7 @@ class CMDHandler:
         UserCommandType().log(transactionNum=transactionNum, command="COMMIT_SELL", username=user_id)
 
         # Check if the user exists.
-        if not Accounts().user_exists(user_id=user_id, redis_cache=self.redis_cache):
+        if not account_repository.user_exists(user_id, self.redis_cache):
             # Invalid command.
             err_msg = f"[{transactionNum}] Error: User {user_id} does not exist."
             ErrorEventType().log(transactionNum=transactionNum, command="COMMIT_SELL", errorMessage=err_msg)
@@ -406,18 +427,15 @@ class CMDHandler:
 
         # Complete the transaction.
         profit = decimal.Decimal(users_sell['num_stocks'] * users_sell['quote'])
-        update = {
-            'inc__stocks__S__amount': -users_sell['num_stocks'],
-            'inc__account': profit,
-            'inc__available': profit
-        }
-        ret = Accounts.objects(pk=user_id, stocks__symbol=users_sell['stock']).update_one(**update)
         # Check if the account updated.
-        if ret != 1:
+        # Recorded with the update, like in commit_buy, so a replay can't release the sold shares.
+        if not account_repository.sell_stock(user_id, users_sell['stock'], users_sell['num_stocks'], profit, transaction_num=users_sell['transactionNum']):
             err_msg = f"[{transactionNum}] Error: (CommitSell) Failed to update account {user_id}."
             #print(err_msg)
             ErrorEventType().log(transactionNum=transactionNum, command="COMMIT_SELL", username=user_id, errorMessage=err_msg)
             return err_msg
+        # Kept until the account is updated, so a restart before that still releases the reserved stock.
+        self.remove_pending(PendingStore.SELL, user_id)
 
         AccountTransactionType().log(transactionNum=transactionNum, action="add", username=user_id, funds=profit)
 
@@ -435,7 +453,7 @@ class CMDHandler:
         UserCommandType().log(transactionNum=transactionNum, command="CANCEL_SELL", username=user_id)
 
         # Check if the user exists.
-        if not Accounts().user_exists(user_id=user_id, redis_cache=self.redis_cache):
+        if not account_repository.user_exists(user_id, self.redis_cache):
             # Invalid command.
             err_msg = f"[{transactionNum}] Error: User {user_id} does not exist."
             ErrorEventType().log(transactionNum=transactionNum, command="CANCEL_SELL", errorMessage=err_msg)
@@ -456,11 +474,11 @@ class CMDHandler:
             #print(err_msg)
             ErrorEventType().log(transactionNum=transactionNum, command="CANCEL_SELL", username=user_id, errorMessage=err_msg)
             return err_msg
+        self.remove_pending(PendingStore.SELL, user_id)
 
         # Free the reserved stocks.
-        ret = Accounts.objects(pk=user_id, stocks__symbol=users_sell['stock']).update_one(inc__stocks__S__available=decimal.Decimal(users_sell['num_stocks']))
         # Check if the update worked.
-        if ret != 1:
+        if not account_repository.release_stock(user_id, users_sell['stock'], users_sell['num_stocks']):
             err_msg = f"[{transactionNum}] Error: (CancelSell) Failed to update account {user_id}."
             #print(err_msg)
             ErrorEventType().log(transactionNum=transactionNum, command="CANCEL_SELL", username=user_id, errorMessage=err_msg)
@@ -483,7 +501,7 @@ class CMDHandler:
         UserCommandType().log(transactionNum=transactionNum, command="SET_BUY_AMOUNT", username=user_id, stockSymbol=stock_symbol, funds=decimal.Decimal(buy_amount))
 
         # Check if the user exists.
-        if not Accounts().user_exists(user_id=user_id, redis_cache=self.redis_cache):
+        if not account_repository.user_exists(user_id, self.redis_cache):
             # Invalid command.
             err_msg = f"[{transactionNum}] Error: User {user_id} does not exist."
             ErrorEventType().log(transactionNum=transactionNum, command="SET_BUY_AMOUNT", errorMessage=err_msg)
@@ -491,41 +509,27 @@ class CMDHandler:
             return err_msg
 
         # Add the stock and amount to the user's auto_buy list
-        users_account = Accounts.objects(__raw__={'_id': user_id}).only('auto_buy').first()
+        # Check if an auto buy already exists for this stock
+        users_auto_buy = account_repository.get_auto_buy(user_id, stock_symbol)
 
         DebugType().log(transactionNum=transactionNum,
                         command="SET_BUY_AMOUNT",
                         username=user_id,
                         stockSymbol=stock_symbol,
-                        debugMessage=f"Users Account (pre-new_auto_buy): {users_account.to_json()}")
-
-        try:
-            # Check if an auto buy already exists for this stock
-            users_auto_buy = users_account.auto_buy.get(symbol=stock_symbol)
-        except DoesNotExist:
-            # Create the auto_buy embedded document for this stock.
-            new_auto_buy = AutoTransaction(user_id=user_id, symbol=stock_symbol, amount=buy_amount)
+                        debugMessage=lambda: f"Users Auto Buy (pre-new_auto_buy): {users_auto_buy}",
+                        level=VERBOSE)
 
+        if users_auto_buy is None:
             DebugType().log(transactionNum=transactionNum, 
                             command="SET_BUY_AMOUNT", 
                             username=user_id, 
                             stockSymbol=stock_symbol, 
-                            debugMessage=f"Inserting New Auto Buy: {new_auto_buy.to_json()}")
-
-            update = {
-                'push__auto_buy': new_auto_buy
-            }
-            ret = Accounts.objects(pk=user_id).update_one(**update)
-        else:
-            # Update the auto buy amount, reset the buy trigger.
-            update = {
-                'set__auto_buy__S__amount': buy_amount,
-                'set__auto_buy__S__trigger': 0.00
-            }
-            ret = Accounts.objects(pk=user_id, auto_buy__symbol=stock_symbol).update_one(**update)
+                            debugMessage=lambda: f"Inserting New Auto Buy: {stock_symbol} x {buy_amount}",
+                            level=VERBOSE)
 
+        # Create the auto buy for this stock, or update the auto buy amount and reset the buy trigger.
         # Check the update succeeded.
-        if ret != 1:
+        if not account_repository.set_auto_buy_amount(user_id, stock_symbol, buy_amount, exists=users_auto_buy is not None):
             err_msg = f"[{transactionNum}] Error: (SetBuyAmount) Failed to update account {user_id}."
             #print(err_msg)
             ErrorEventType().log(transactionNum=transactionNum, command="SET_BUY_AMOUNT", username=user_id, errorMessage=err_msg)
@@ -549,7 +553,7 @@ class CMDHandler:
         UserCommandType().log(transactionNum=transactionNum, command="SET_BUY_TRIGGER", username=user_id, stockSymbol=stock_symbol, funds=buy_trigger)
 
         # Check if the user exists.
-        if not Accounts().user_exists(user_id=user_id, redis_cache=self.redis_cache):
+        if not account_repository.user_exists(user_id, self.redis_cache):
             # Invalid command.
             err_msg = f"[{transactionNum}] Error: User {user_id} does not exist."
             ErrorEventType().log(transactionNum=transactionNum, command="SET_BUY_TRIGGER", errorMessage=err_msg)
@@ -557,10 +561,8 @@ class CMDHandler:
             return err_msg
 
         # Check the user has issued a SET_BUY_AMOUNT for the given stock.
-        users_account = Accounts.objects(__raw__={'_id': user_id}).only('auto_buy', 'available').first()
-        try:
-            users_auto_buy = users_account.auto_buy.get(symbol=stock_symbol)
-        except DoesNotExist:
+        users_auto_buy, available = account_repository.get_auto_buy(user_id, stock_symbol, with_available=True)
+        if users_auto_buy is None:
             # No SET_BUY_AMOUNT issued.
             err_msg = f"[{transactionNum}] Error: Invalid command. A SET_BUY_AMOUNT must be issued for stock {stock_symbol} before a trigger can be set."
             #print(err_msg)
@@ -569,22 +571,16 @@ class CMDHandler:
 
         # Check the user's account has enough money available.
         transaction_price = round(buy_trigger * users_auto_buy.amount, 2)
-        if transaction_price > users_account.available:
+        if transaction_price > available:
             # Insufficient funds.
-            err_msg = f"[{transactionNum}] Error: Invalid buy trigger. Insufficient funds for an auto buy. Funds available (${users_account.available:.2f}), auto buy cost (${transaction_price:.2f})."
+            err_msg = f"[{transactionNum}] Error: Invalid buy trigger. Insufficient funds for an auto buy. Funds available (${available:.2f}), auto buy cost (${transaction_price:.2f})."
             #print(err_msg)
             ErrorEventType().log(transactionNum=transactionNum, command="SET_BUY_TRIGGER", username=user_id, stockSymbol=stock_symbol, funds=buy_trigger, errorMessage=err_msg)
             return err_msg
 
         # Set the auto buy trigger, deduct money from the available account.
-        update = {
-            'set__auto_buy__S__trigger': buy_trigger,
-            'inc__available': -decimal.Decimal(transaction_price)
-        }
-
-        ret = Accounts.objects(pk=user_id, auto_buy__symbol=stock_symbol).update_one(**update)
-        # Check that the update succeeded.
-        if ret != 1:
+        # The update is guarded on the funds still being available.
+        if account_repository.reserve_auto_buy(user_id, stock_symbol, buy_trigger, transaction_price, transaction_num=transactionNum) is None:
             err_msg = f"[{transactionNum}] Error: (SetBuyTrigger) Failed to update account {user_id}."
             #print(err_msg)
             ErrorEventType().log(transactionNum=transactionNum, command="SET_BUY_TRIGGER", username=user_id, errorMessage=err_msg)
@@ -609,7 +605,7 @@ class CMDHandler:
         UserCommandType().log(transactionNum=transactionNum, command="CANCEL_SET_BUY", username=user_id, stockSymbol=stock_symbol)
 
         # Check if the user exists.
-        if not Accounts().user_exists(user_id=user_id, redis_cache=self.redis_cache):
+        if not account_repository.user_exists(user_id, self.redis_cache):
             # Invalid command.
             err_msg = f"[{transactionNum}] Error: User {user_id} does not exist."
             ErrorEventType().log(transactionNum=transactionNum, command="CANCEL_SET_BUY", errorMessage=err_msg)
@@ -617,10 +613,8 @@ class CMDHandler:
             return err_msg
 
         # Check to see if the user has an auto buy for this stock.
-        users_account = Accounts.objects(__raw__={'_id': user_id}).only('auto_buy', 'available').first()
-        try:
-            users_auto_buy = users_account.auto_buy.get(symbol=stock_symbol)
-        except DoesNotExist:
+        users_auto_buy = account_repository.get_auto_buy(user_id, stock_symbol)
+        if users_auto_buy is None:
             # User hasn't set up and auto buy.
             err_msg = f"[{transactionNum}] Error: (CancelSetBuy) Invalid command. No auto-buy setup for stock {stock_symbol}."
             #print(err_msg)
@@ -628,14 +622,8 @@ class CMDHandler:
             return err_msg
 
         # Remove the auto buy. Add the reserved funds.
-        update = {
-            'inc__available': decimal.Decimal(users_auto_buy.amount * users_auto_buy.trigger),
-            'pull__auto_buy__symbol': stock_symbol
-        }
-        ret = Accounts.objects(pk=user_id).update_one(**update)
-
         # Check the update succeeded.
-        if ret != 1:
+        if not account_repository.cancel_auto_buy(user_id, stock_symbol, users_auto_buy.amount * users_auto_buy.trigger):
             err_msg = f"[{transactionNum}] Error: (CancelSetBuy) Failed to update account {user_id}."
             #print(err_msg)
             ErrorEventType().log(transactionNum=transactionNum, command="CancelSetBuy", username=user_id, errorMessage=err_msg)
@@ -663,43 +651,33 @@ class CMDHandler:
         UserCommandType().log(transactionNum=transactionNum, command="SET_SELL_AMOUNT", username=user_id, stockSymbol=stock_symbol, funds=decimal.Decimal(sell_amount))
 
         # Check if the user exists.
-        if not Accounts().user_exists(user_id=user_id, redis_cache=self.redis_cache):
+        if not account_repository.user_exists(user_id, self.redis_cache):
             # Invalid command.
             err_msg = f"[{transactionNum}] Error: User {user_id} does not exist."
             ErrorEventType().log(transactionNum=transactionNum, command="SET_SELL_AMOUNT", errorMessage=err_msg)
             #print(err_msg)
             return err_msg
 
-        # Verify the user owns enough shares of the given stock.
-        users_account = Accounts.objects(__raw__={'_id': user_id}).only('stocks').first()
-        try:
-            users_stock = users_account.stocks.get(symbol=stock_symbol)
-        except DoesNotExist:
-            # The user does not own any of the stock they want to sell.
-            err_msg = f"[{transactionNum}] Error: Invalid command. The stock {stock_symbol} is not owned."
-            #print(err_msg)
-            ErrorEventType().log(transactionNum=transactionNum, command="SET_SELL_AMOUNT", username=user_id, stockSymbol=stock_symbol, funds=decimal.Decimal(sell_amount), errorMessage=err_msg)
-            return err_msg
+        # Decrement the number of available shares. Only succeeds if the user owns enough shares of the given stock.
+        if account_repository.reserve_stock(user_id, stock_symbol, sell_amount) is None:
+            # Find out why the shares could not be reserved.
+            users_stock = account_repository.get_stock(user_id, stock_symbol)
+            if users_stock is None:
+                # The user does not own any of the stock they want to sell.
+                err_msg = f"[{transactionNum}] Error: Invalid command. The stock {stock_symbol} is not owned."
+                #print(err_msg)
+                ErrorEventType().log(transactionNum=transactionNum, command="SET_SELL_AMOUNT", username=user_id, stockSymbol=stock_symbol, funds=decimal.Decimal(sell_amount), errorMessage=err_msg)
+                return err_msg
 
-        if users_stock.available < sell_amount:
             err_msg = f"[{transactionNum}] Error: Invalid command. Number of available stocks for {stock_symbol} is {users_stock.available} and is less than the amount set to sell {sell_amount}."
             #print(err_msg)
             ErrorEventType().log(transactionNum=transactionNum, command="SET_SELL_AMOUNT", username=user_id, stockSymbol=stock_symbol, funds=decimal.Decimal(sell_amount), errorMessage=err_msg)
             return err_msg
 
-        # Decrement the number of available shares.
-        ret = Accounts.objects(pk=user_id, stocks__symbol=stock_symbol).update_one(inc__stocks__S__available= -decimal.Decimal(sell_amount))
-
-        # Check the update succeeded.
-        if ret != 1:
-            err_msg = f"[{transactionNum}] Error: (SetSellAmount) Failed to update account {user_id}."
-            #print(err_msg)
-            ErrorEventType().log(transactionNum=transactionNum, command="SET_SELL_AMOUNT", username=user_id, errorMessage=err_msg)
-            return err_msg
-
         # Add the auto sell to the dictionary until the SET_SELL_TRIGGER is received.
         pending_auto_sell = {(user_id,stock_symbol): {'sell_amount': sell_amount}}
         self.pending_sell_triggers.update(pending_auto_sell)
+        self.persist_pending(PendingStore.SELL_TRIGGER, user_id, {'sell_amount': sell_amount}, stock_symbol)
 
         # Notify the user.
         ok_msg = f"[{transactionNum}] Successfully set to sell {sell_amount} stocks of {stock_symbol} automatically. Please issue SET_SELL_TRIGGER to set the trigger price."
@@ -718,7 +696,7 @@ class CMDHandler:
         UserCommandType().log(transactionNum=transactionNum, command="SET_SELL_TRIGGER", username=user_id, stockSymbol=stock_symbol)
 
         # Check if the user exists.
-        if not Accounts().user_exists(user_id=user_id, redis_cache=self.redis_cache):
+        if not account_repository.user_exists(user_id, self.redis_cache):
             # Invalid command.
             err_msg = f"[{transactionNum}] Error: User {user_id} does not exist."
             ErrorEventType().log(transactionNum=transactionNum, command="SET_SELL_TRIGGER", errorMessage=err_msg)
@@ -727,6 +705,8 @@ class CMDHandler:
 
         # Check the user has issued a SET_SELL_AMOUNT
         pending_auto_sell = self.pending_sell_triggers.pop((user_id,stock_symbol), None)
+        if pending_auto_sell is not None:
+            self.remove_pending(PendingStore.SELL_TRIGGER, user_id, stock_symbol)
         if pending_auto_sell is None:
             err_msg = f"[{transactionNum}] Error: Invalid command. Issue a SET_SELL_AMOUNT for this stock before setting the trigger price."
             #print(err_msg)
@@ -734,34 +714,24 @@ class CMDHandler:
             return err_msg
 
         # Create the auto_sell
-        users_account = Accounts.objects(__raw__={'_id': user_id}).only('auto_sell').first()
+        # Check to see if one exists for this stock
+        users_auto_sell = account_repository.get_auto_sell(user_id, stock_symbol)
 
-        debug_msg = f"Users Account (pre-new_auto_sell): {users_account.to_json()}"
-        DebugType().log(transactionNum=transactionNum, command="SET_SELL_TRIGGER", username=user_id, stockSymbol=stock_symbol, debugMessage=debug_msg)
+        debug_msg = lambda: f"Users Auto Sell (pre-new_auto_sell): {users_auto_sell}"
+        DebugType().log(transactionNum=transactionNum, command="SET_SELL_TRIGGER", username=user_id, stockSymbol=stock_symbol, debugMessage=debug_msg, level=VERBOSE)
 
-        try:
-            # Check to see if one exists for this stock
-            users_auto_sell = users_account.auto_sell.get(symbol=stock_symbol)
-        except DoesNotExist:
+        if users_auto_sell is None:
             # Create a new auto sell.
-            new_auto_sell = AutoTransaction(user_id=user_id, symbol=stock_symbol, amount=pending_auto_sell['sell_amount'], trigger=sell_trigger)
-            
-            debug_msg = f"Inserting New Auto Sell: {new_auto_sell.to_json()}"
-            DebugType().log(transactionNum=transactionNum, command="SET_SELL_TRIGGER", username=user_id, stockSymbol=stock_symbol, debugMessage=debug_msg)
-            
-            ret = Accounts.objects(pk=user_id).update_one(push__auto_sell=new_auto_sell)
+            debug_msg = lambda: f"Inserting New Auto Sell: {stock_symbol} x {pending_auto_sell['sell_amount']} at {sell_trigger}"
+            DebugType().log(transactionNum=transactionNum, command="SET_SELL_TRIGGER", username=user_id, stockSymbol=stock_symbol, debugMessage=debug_msg, level=VERBOSE)
+            previous_amount = None
         else:
             # Auto sell has already been setup for this stock.
             # Update the auto sell and adjust the amount of reserved stocks
-            update = {
-                'set__auto_sell__S__amount': pending_auto_sell['sell_amount'],
-                'set__auto_sell__S__trigger': sell_trigger,
-                'inc__stocks__S__available': users_auto_sell.amount - pending_auto_sell['sell_amount'] # add previous amount back and remove the new amount 
-            }  
-            ret = Accounts.objects(pk=user_id, auto_sell__symbol=stock_symbol, stocks__symbol=stock_symbol).update_one(**update)
+            previous_amount = users_auto_sell.amount
 
         # Check if the update worked.
-        if ret != 1:
+        if not account_repository.set_auto_sell(user_id, stock_symbol, pending_auto_sell['sell_amount'], sell_trigger, previous_amount=previous_amount, transaction_num=transactionNum):
             err_msg = f"[{transactionNum}] Error: (SetSellTrigger) Failed to update account {user_id}."
             #print(err_msg)
             ErrorEventType().log(transactionNum=transactionNum, command="SET_SELL_TRIGGER", username=user_id, errorMessage=err_msg)
@@ -786,7 +756,7 @@ class CMDHandler:
         UserCommandType().log(transactionNum=transactionNum, command="CANCEL_SET_SELL", username=user_id, stockSymbol=stock_symbol)
 
         # Check if the user exists.
-        if not Accounts().user_exists(user_id=user_id, redis_cache=self.redis_cache):
+        if not account_repository.user_exists(user_id, self.redis_cache):
             # Invalid command.
             err_msg = f"[{transactionNum}] Error: User {user_id} does not exist."
             ErrorEventType().log(transactionNum=transactionNum, command="CANCEL_SET_SELL", errorMessage=err_msg)
@@ -796,31 +766,22 @@ class CMDHandler:
         # Flag to check if this command is invalid (i.e. No SET_SELL_AMOUNT OR TRIGGER has been given for this stock)
         bad_cmd = True
 
-        #print(f"In cancel_set_sell:\n\t user_id: {user_id}")
-        users_account = Accounts.objects(__raw__={'_id': user_id}).only('auto_sell')
-        #print(f"\tusers_account (.only): {users_account.to_json()}")
-        users_account = users_account.first()
-        #print(f"\tusers_account (.first): {users_account.to_json()}")
-        
-        update = {}
+        remove_auto = False
 
         # Check if just a SET_SELL_AMOUNT has been issued.
         pending_auto_sell = self.pending_sell_triggers.pop((user_id,stock_symbol), None)
+        if pending_auto_sell is not None:
+            self.remove_pending(PendingStore.SELL_TRIGGER, user_id, stock_symbol)
         if pending_auto_sell is not None:
             reserved_amount = pending_auto_sell['sell_amount']
             bad_cmd = False
 
         if bad_cmd == True:
             # Check if a SET_SELL_AMOUNT and SET_SELL_TRIGGER has been issued.
-            users_auto_sell = None
-            try:
-                users_auto_sell = users_account.auto_sell.get(symbol=stock_symbol)
-            except:
-                # No auto sell.
-                pass
-            else:
-                # Remove the auto sell (add this command to the update dictionary)
-                update['pull__auto_sell__symbol'] = stock_symbol
+            users_auto_sell = account_repository.get_auto_sell(user_id, stock_symbol)
+            if users_auto_sell is not None:
+                # Remove the auto sell along with releasing the stocks
+                remove_auto = True
 
                 DebugType().log(transactionNum=transactionNum, command="CANCEL_SET_SELL", username=user_id, stockSymbol=stock_symbol, debugMessage="AUTO SELL is removed for this user")
                 reserved_amount = users_auto_sell.amount
@@ -834,13 +795,8 @@ class CMDHandler:
             return err_msg
 
         # Release the reserved stocks.
-        update['inc__stocks__S__available'] = reserved_amount
-
-        # Update the user's document
-        ret = Accounts.objects(pk=user_id, stocks__symbol=stock_symbol).update_one(**update)
-        
         # Check if the update worked.
-        if ret != 1:
+        if not account_repository.cancel_auto_sell(user_id, stock_symbol, reserved_amount, remove_auto):
             err_msg = f"[{transactionNum}] Error: (CancelSetSell) Failed to update account {user_id}."
             #print(err_msg)
             ErrorEventType().log(transactionNum=transactionNum, command="CANCEL_SET_SELL", username=user_id, errorMessage=err_msg)
@@ -861,6 +817,8 @@ class CMDHandler:
         user_id = params[1] if ((len(params))>1) else None
         UserCommandType().log(transactionNum=transactionNum, command="DUMPLOG", username=user_id, filename=filename)
 
+        # Write this command's batched events first so the DUMPLOG is in its own log.
+        flush_batch()
         json_data = get_logs(user_id) #this will be logs we get from the database
         log_handler.convertLogFile(json_data, filename)
 
@@ -876,7 +834,7 @@ class CMDHandler:
         UserCommandType().log(transactionNum=transactionNum, command="DISPLAY_SUMMARY", username=user_id)
 
         try:
-            user_account = Accounts.objects(pk=user_id)
+            user_account = account_repository.account_summary(user_id)
         except:
             err_msg = f"[{transactionNum}] Error: User {user_id} does not exist."
             #print(err_msg)
@@ -885,7 +843,7 @@ class CMDHandler:
 
         ok_msg = (
             f"[{transactionNum}] User Account Summary:\n"
-            f"{user_account.to_json()}"
+            f"{user_account}"
         )
         #print(ok_msg)
         return ok_msg
@@ -931,7 +889,8 @@ class CMDHandler:
         # Get the function
         func = switch.get(cmd, self.unknown_cmd)
         
-        # Handle the command.
+        # Handle the command. With LOG_STORE=unified the command's events are written together afterwards.
+        begin_batch()
         try:
             if func == self.unknown_cmd:
                 response = self.unknown_cmd(transactionNum=transactionNum, cmd=cmd)
@@ -942,6 +901,11 @@ class CMDHandler:
             print(response)
             print(f"Traceback:\n{traceback.format_exc()}")
             ErrorEventType().log(transactionNum=transactionNum, command="UNKNOWN_COMMAND", errorMessage=response)
+        finally:
+            try:
+                flush_batch()
+            except Exception as e:
+                print(f"[{transactionNum}] Error: Failed to write the logs for {cmd}. {e}")
 
         # Send the response back.
-        self.response_publisher.send(response)
\ No newline at end of file
+        self.response_publisher.send(response, routed=True)
\ No newline at end of file
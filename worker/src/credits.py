@@ -0,0 +1,101 @@
+import os
+import sys
+import time
+import threading
+import redis
+
+# Read by the manager (manager/src/credits.py) to decide how many commands it can send this worker
+# and when a DUMPLOG's barrier has been reached.
+KEY_PREFIX = 'credits:'
+REPORT_PERIOD = float(os.environ.get('CREDIT_REPORT_PERIOD', 0.02)) # Seconds
+
+
+class AppliedWatermark:
+    '''
+    The manager numbers the commands it sends to this worker (the seq header,
+    from 1). Lanes finish them out of order and the priority queue delivers them
+    out of order, so the watermark is the highest number up to which every
+    command has been applied. It starts at 0, or at the base header: the numbers
+    sent to this worker's previous sessions, some of which were lost with them.
+    Commands of previous sessions that were still queued are delivered to this
+    one, so current() stays below any command received and not applied yet.
+    '''
+
+    def __init__(self):
+        self.value = 0
+        self._done = set() # Applied numbers above the watermark
+        self._received = set() # Received numbers not applied yet
+        self._mutex = threading.Lock()
+
+    def received(self, seq, base):
+        ''' Called with the seq and base headers of every delivered command. '''
+        if seq is None:
+            return # Not routed by the manager (direct routing).
+        with self._mutex:
+            self._received.add(seq)
+            if base is not None and base > self.value:
+                self.value = base
+                self._done = {done for done in self._done if done > base}
+                self._advance()
+
+    def applied(self, seq):
+        if seq is None:
+            return
+        with self._mutex:
+            self._received.discard(seq)
+            if seq <= self.value:
+                return
+            self._done.add(seq)
+            self._advance()
+
+    def current(self) -> int:
+        ''' The watermark as reported to the manager. '''
+        with self._mutex:
+            if self._received:
+                return min(self.value, min(self._received) - 1)
+            return self.value
+
+    def _advance(self):
+        while self.value + 1 in self._done:
+            self.value += 1
+            self._done.discard(self.value)
+
+
+class CreditReporter(threading.Thread):
+    '''
+    Advertises this worker's capacity, the number of commands it has finished and
+    its applied watermark in the Redis hash credits:<route key>. The manager keeps
+    at most capacity commands outstanding, so the worker's buffers never have to
+    hold more. The hash is written when a value changes and at least once a second.
+    '''
+    _HEARTBEAT = 1.0 # Seconds
+
+    def __init__(self, redis_cache, route_key, executor, capacity):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.redis_cache = redis_cache
+        self.key = KEY_PREFIX + route_key
+        self.executor = executor
+        self.capacity = capacity
+        self.session = f"{time.time():.6f}" # Tells the manager this worker restarted.
+
+    def run(self):
+        reported = None
+        next_heartbeat = 0.0
+        while True:
+            status = (self.executor.completed(), self.executor.watermark.current())
+            now = time.time()
+            if status != reported or now >= next_heartbeat:
+                try:
+                    self.redis_cache.hset(self.key, mapping={
+                        'session': self.session,
+                        'completed': status[0],
+                        'capacity': self.capacity,
+                        'applied': status[1]
+                    })
+                    reported = status
+                    next_heartbeat = now + self._HEARTBEAT
+                except redis.RedisError as e:
+                    print(f"Error: Could not report credits. {e}")
+                    sys.stdout.flush()
+            time.sleep(REPORT_PERIOD)
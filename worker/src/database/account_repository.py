@@ -0,0 +1,940 @@
+import os
+import abc
+import json
+import decimal
+import threading
+from pymongo import ReturnDocument
+from legacy import quote_cache
+from .accounts import Accounts, Stocks, AutoTransaction
+from .connection import STORAGE
+from .write_concern import write_concern, with_write_concern
+
+TWO_PLACES = decimal.Decimal('0.01')
+ACCOUNTS_WRITE_CONCERN = write_concern('accounts')
+
+# Account layouts. List accounts keep stocks/auto_buy/auto_sell as arrays of embedded
+# documents, map accounts keep them in stock_map/auto_buy_map/auto_sell_map keyed by symbol.
+LIST_LAYOUT = 1
+MAP_LAYOUT = 2
+LIST_FIELDS = ('stocks', 'auto_buy', 'auto_sell')
+MAP_FIELDS = {'stocks': 'stock_map', 'auto_buy': 'auto_buy_map', 'auto_sell': 'auto_sell_map'}
+
+def _money(value) -> float:
+    ''' Rounds money the way mongoengine's DecimalField(precision=2) stores it. '''
+    return float(decimal.Decimal(str(value)).quantize(TWO_PLACES, rounding=decimal.ROUND_HALF_UP))
+
+
+class StockRecord:
+    __slots__ = ('symbol', 'amount', 'available')
+
+    def __init__(self, symbol, amount, available):
+        self.symbol = symbol
+        self.amount = amount
+        self.available = available
+
+    def __repr__(self) -> str:
+        return f"StockRecord(symbol={self.symbol}, amount={self.amount}, available={self.available})"
+
+
+class AutoRecord:
+    __slots__ = ('symbol', 'amount', 'trigger')
+
+    def __init__(self, symbol, amount, trigger):
+        self.symbol = symbol
+        self.amount = amount
+        self.trigger = trigger
+
+    def __repr__(self) -> str:
+        return f"AutoRecord(symbol={self.symbol}, amount={self.amount}, trigger={self.trigger})"
+
+
+def _stock_record(stock):
+    if not stock:
+        return None
+    return StockRecord(stock['symbol'], stock.get('amount', 0), stock.get('available', 0))
+
+def _auto_record(auto):
+    if not auto:
+        return None
+    return AutoRecord(auto['symbol'], auto.get('amount', 0), auto.get('trigger', 0.0))
+
+def _first(document, field):
+    ''' First element of an $elemMatch projected array, or None. '''
+    values = document.get(field) if document else None
+    return values[0] if values else None
+
+def _entry(document, field, stock_symbol):
+    ''' Entry of a symbol keyed map, or None. '''
+    values = document.get(field) if document else None
+    return values.get(stock_symbol) if values else None
+
+
+def auto_entries(document, kind) -> list:
+    ''' Returns the auto buy/sell (kind) entries of a raw account document in either layout. '''
+    if document.get('layout') == MAP_LAYOUT:
+        return list(document.get(MAP_FIELDS[kind], {}).values())
+    return document.get(kind, [])
+
+def to_map_layout(document) -> dict:
+    ''' Builds the map layout fields of a list layout account document. '''
+    stock_map = {}
+    for stock in document.get('stocks', []):
+        # Merge duplicate entries rather than dropping shares.
+        entry = stock_map.setdefault(stock['symbol'], {'symbol': stock['symbol'], 'amount': 0, 'available': 0})
+        entry['amount'] += stock.get('amount', 0)
+        entry['available'] += stock.get('available', 0)
+
+    fields = {'stock_map': stock_map, 'layout': MAP_LAYOUT}
+    for kind in ('auto_buy', 'auto_sell'):
+        fields[MAP_FIELDS[kind]] = {
+            auto['symbol']: {
+                'user_id': auto.get('user_id', document['_id']),
+                'symbol': auto['symbol'],
+                'amount': auto.get('amount', 0),
+                'trigger': auto.get('trigger', 0.0),
+                'transactionNum': auto.get('transactionNum', 0)
+            } for auto in document.get(kind, [])
+        }
+    return fields
+
+def migration_update(document) -> tuple:
+    '''
+    Returns (filter, update) converting one list layout account to the map layout.
+    The filter is guarded on the arrays being unchanged since the document was read,
+    so a concurrent command is never lost; nothing is updated if they changed.
+    '''
+    guard = {'_id': document['_id'], 'layout': {'$ne': MAP_LAYOUT}}
+    for field in LIST_FIELDS:
+        guard[field] = document[field] if field in document else {'$exists': False}
+
+    return guard, {
+        '$set': to_map_layout(document),
+        '$unset': {field: '' for field in LIST_FIELDS}
+    }
+
+def migrate_document(collection, document) -> bool:
+    ''' Converts one account. Returns False if it changed since it was read (re-read and retry). '''
+    guard, update = migration_update(document)
+    return collection.update_one(guard, update).modified_count == 1
+
+
+class AccountRepository(abc.ABC):
+    '''
+    Reads from the accounts collection with raw pymongo instead of mongoengine.
+    Only the requested fields are returned: a single stock or auto transaction is
+    selected on the server with a projection, so no embedded documents are hydrated
+    or scanned in Python. Money fields are returned as the floats mongoengine stores
+    them as.
+
+    Reservations are single conditional updates: the guard (enough funds or shares
+    available) is part of the filter, so the check and the decrement happen in one
+    round trip and two commands can never reserve the same funds.
+
+    Stock and auto transaction reads/writes depend on the account layout and are
+    implemented by ListAccountRepository and MapAccountRepository.
+    MemoryAccountRepository implements the whole interface without Mongo.
+    '''
+    AUTO_BUY = 'auto_buy'
+    AUTO_SELL = 'auto_sell'
+    BUY = 'buy'
+    SELL = 'sell'
+
+    def __init__(self, collection=None):
+        self._collection = collection
+
+    @property
+    def collection(self):
+        # Resolved lazily so the repository can be created before the connection is up.
+        if self._collection is None:
+            self._collection = with_write_concern(Accounts._get_collection(), ACCOUNTS_WRITE_CONCERN)
+        return self._collection
+
+    def user_exists(self, user_id, redis_cache) -> bool:
+        ''' Checks the user cache, then the accounts. '''
+        return Accounts.user_exists(user_id=user_id, redis_cache=redis_cache)
+
+    def user_exists_with_quote(self, user_id, stock_symbol, redis_cache):
+        ''' Returns a tuple (user exists, cached stock price or None). '''
+        return Accounts.user_exists_with_quote(user_id=user_id, stock_symbol=stock_symbol, redis_cache=redis_cache)
+
+    def add_funds(self, user_id, amount, to_account=True) -> bool:
+        '''
+        Adds amount to the available funds and, unless to_account is False
+        (reserved funds being returned), to the account.
+        '''
+        update = {'inc__available': decimal.Decimal(amount)}
+        if to_account:
+            update['inc__account'] = decimal.Decimal(amount)
+        return Accounts.objects(pk=user_id).update_one(write_concern=ACCOUNTS_WRITE_CONCERN, **update) == 1
+
+    def account_summary(self, user_id) -> str:
+        ''' The account as a json list, empty if it does not exist. '''
+        return Accounts.objects(pk=user_id).to_json()
+
+    def get_available(self, user_id):
+        ''' Returns the user's available funds, or None if the account does not exist. '''
+        document = self.collection.find_one({'_id': user_id}, {'available': 1})
+        if document is None:
+            return None
+        return document.get('available', 0.0)
+
+    def last_commit(self, user_id, kind):
+        ''' Returns the transactionNum of the user's last committed BUY/SELL (kind), or None. '''
+        document = self.collection.find_one({'_id': user_id}, {'_id': 0, f'commits.{kind}': 1})
+        if document is None:
+            return None
+        return document.get('commits', {}).get(kind)
+
+    def get_auto_buy(self, user_id, stock_symbol, with_available=False):
+        return self.get_auto(self.AUTO_BUY, user_id, stock_symbol, with_available)
+
+    def get_auto_sell(self, user_id, stock_symbol):
+        return self.get_auto(self.AUTO_SELL, user_id, stock_symbol)
+
+    def reserve_funds(self, user_id, amount):
+        '''
+        Takes amount from the user's available funds if at least that much is available.
+        Returns the available funds after the update, or None if the account does not
+        exist or has insufficient funds.
+        '''
+        amount = _money(amount)
+        document = self.collection.find_one_and_update(
+            {'_id': user_id, 'available': {'$gte': amount}},
+            {'$inc': {'available': -amount}},
+            projection={'_id': 0, 'available': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if document is None:
+            return None
+        return document.get('available', 0.0)
+
+    @abc.abstractmethod
+    def get_stock(self, user_id, stock_symbol):
+        ''' Returns a StockRecord for the given stock, or None if the user does not own it. '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_auto(self, kind, user_id, stock_symbol, with_available=False):
+        '''
+        Returns an AutoRecord for the user's auto buy/sell (kind) of the given stock or None.
+        With with_available the user's available funds are read in the same query and
+        a tuple (AutoRecord or None, available or None) is returned.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_auto_with_stock(self, kind, user_id, stock_symbol):
+        ''' Returns (AutoRecord or None, StockRecord or None) for the stock in one query. '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_triggered_users(self, kind, user_ids, stock_symbol, value) -> list:
+        '''
+        Returns the ids of the given users whose auto buy (trigger <= value) or
+        auto sell (trigger >= value) of the stock has been triggered.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def create_account(self, user_id, amount) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def reserve_stock(self, user_id, stock_symbol, num_stocks):
+        '''
+        Takes num_stocks from the available shares of the user's stock if enough are available.
+        Returns a StockRecord with the stock after the update, or None if the stock is
+        not owned or not enough shares are available.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def remove_empty_stock(self, user_id, stock_symbol) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def buy_stock(self, user_id, stock_symbol, num_stocks, cost, transaction_num=None) -> bool:
+        '''
+        Adds the shares (creating the stock if needed) and takes the cost from the account.
+        transaction_num (of the BUY) is recorded as the last commit in the same update.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def sell_stock(self, user_id, stock_symbol, num_stocks, profit, transaction_num=None) -> bool:
+        '''
+        Removes reserved shares and adds the profit to the account and available funds.
+        transaction_num (of the SELL) is recorded as the last commit in the same update.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def release_stock(self, user_id, stock_symbol, num_stocks) -> bool:
+        ''' Returns reserved shares to the available shares. '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_auto_buy_amount(self, user_id, stock_symbol, amount, exists) -> bool:
+        ''' Creates the auto buy, or sets its amount and resets its trigger. '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def reserve_auto_buy(self, user_id, stock_symbol, trigger, cost, transaction_num=0):
+        '''
+        Sets the trigger of the user's auto buy and takes its cost from the available funds,
+        only if the auto buy exists and enough funds are available. transaction_num (the
+        SET_BUY_TRIGGER's) is kept with the trigger for the logs of a restarted worker.
+        Returns the available funds after the update, or None if nothing was updated.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def cancel_auto_buy(self, user_id, stock_symbol, refund) -> bool:
+        ''' Removes the auto buy and returns its reserved funds. '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_auto_sell(self, user_id, stock_symbol, amount, trigger, previous_amount=None, transaction_num=0) -> bool:
+        '''
+        Creates the auto sell, or updates it when previous_amount (the shares it
+        reserved so far) is given and adjusts the available shares by the difference.
+        transaction_num is the SET_SELL_TRIGGER's, like reserve_auto_buy's.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def cancel_auto_sell(self, user_id, stock_symbol, reserved_amount, remove_auto) -> bool:
+        ''' Returns reserved shares and removes the auto sell when remove_auto is set. '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def complete_auto_buy(self, user_id, stock_symbol, num_stocks, reserved, cost, has_stock) -> bool:
+        ''' Removes the triggered auto buy, adds the shares and settles the reserved funds. '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def complete_auto_sell(self, user_id, stock_symbol, num_stocks, profit, remove_stock) -> bool:
+        ''' Removes the triggered auto sell and its shares and adds the profit. '''
+        raise NotImplementedError
+
+
+class ListAccountRepository(AccountRepository):
+    ''' Accounts with stocks/auto_buy/auto_sell as arrays of embedded documents. '''
+
+    def get_stock(self, user_id, stock_symbol):
+        document = self.collection.find_one(
+            {'_id': user_id},
+            {'_id': 0, 'stocks': {'$elemMatch': {'symbol': stock_symbol}}}
+        )
+        return _stock_record(_first(document, 'stocks'))
+
+    def get_auto(self, kind, user_id, stock_symbol, with_available=False):
+        projection = {'_id': 0, kind: {'$elemMatch': {'symbol': stock_symbol}}}
+        if with_available:
+            projection['available'] = 1
+
+        document = self.collection.find_one({'_id': user_id}, projection)
+        record = _auto_record(_first(document, kind))
+        if with_available:
+            return record, (document.get('available', 0.0) if document else None)
+        return record
+
+    def get_auto_with_stock(self, kind, user_id, stock_symbol):
+        document = self.collection.find_one(
+            {'_id': user_id},
+            {'_id': 0, kind: {'$elemMatch': {'symbol': stock_symbol}}, 'stocks': {'$elemMatch': {'symbol': stock_symbol}}}
+        )
+        return _auto_record(_first(document, kind)), _stock_record(_first(document, 'stocks'))
+
+    def get_triggered_users(self, kind, user_ids, stock_symbol, value) -> list:
+        condition = '$lte' if kind == self.AUTO_BUY else '$gte'
+        cursor = self.collection.find(
+            {'_id': {'$in': list(user_ids)}, kind: {'$elemMatch': {'symbol': stock_symbol, 'trigger': {condition: value}}}},
+            {'_id': 1}
+        )
+        return [document['_id'] for document in cursor]
+
+    def create_account(self, user_id, amount) -> bool:
+        user = Accounts(user_id=user_id)
+        user.account = user.account + amount
+        user.available = user.available + amount
+        user.save(write_concern=ACCOUNTS_WRITE_CONCERN)
+        return True
+
+    def reserve_stock(self, user_id, stock_symbol, num_stocks):
+        document = self.collection.find_one_and_update(
+            {'_id': user_id, 'stocks': {'$elemMatch': {'symbol': stock_symbol, 'available': {'$gte': num_stocks}}}},
+            {'$inc': {'stocks.$.available': -int(num_stocks)}},
+            projection={'_id': 0, 'stocks': {'$elemMatch': {'symbol': stock_symbol}}},
+            return_document=ReturnDocument.AFTER
+        )
+        return _stock_record(_first(document, 'stocks'))
+
+    def remove_empty_stock(self, user_id, stock_symbol) -> bool:
+        ret = Accounts.objects(__raw__={'_id': user_id, 'stocks': {'$elemMatch': {'symbol': stock_symbol, 'amount': 0}}}).update_one(write_concern=ACCOUNTS_WRITE_CONCERN, pull__stocks__symbol=stock_symbol)
+        return ret == 1
+
+    def buy_stock(self, user_id, stock_symbol, num_stocks, cost, transaction_num=None) -> bool:
+        commit = {} if transaction_num is None else {f'set__commits__{self.BUY}': int(transaction_num)}
+        if self.get_stock(user_id, stock_symbol) is None:
+            # Create a new stock. Deduct the cost of the stock.
+            new_stock = Stocks(symbol=stock_symbol, amount=num_stocks, available=num_stocks)
+            update = {
+                'inc__account': -decimal.Decimal(cost),
+                'push__stocks': new_stock,
+                **commit
+            }
+            return Accounts.objects(pk=user_id).update_one(write_concern=ACCOUNTS_WRITE_CONCERN, **update) == 1
+
+        # Increment the existing stock. Deduct the cost of the stock.
+        update = {
+            'inc__account': -decimal.Decimal(cost),
+            'inc__stocks__S__amount': num_stocks,
+            'inc__stocks__S__available': num_stocks,
+            **commit
+        }
+        return Accounts.objects(pk=user_id, stocks__symbol=stock_symbol).update_one(write_concern=ACCOUNTS_WRITE_CONCERN, **update) == 1
+
+    def sell_stock(self, user_id, stock_symbol, num_stocks, profit, transaction_num=None) -> bool:
+        update = {
+            'inc__stocks__S__amount': -num_stocks,
+            'inc__account': decimal.Decimal(profit),
+            'inc__available': decimal.Decimal(profit)
+        }
+        if transaction_num is not None:
+            update[f'set__commits__{self.SELL}'] = int(transaction_num)
+        return Accounts.objects(pk=user_id, stocks__symbol=stock_symbol).update_one(write_concern=ACCOUNTS_WRITE_CONCERN, **update) == 1
+
+    def release_stock(self, user_id, stock_symbol, num_stocks) -> bool:
+        ret = Accounts.objects(pk=user_id, stocks__symbol=stock_symbol).update_one(write_concern=ACCOUNTS_WRITE_CONCERN, inc__stocks__S__available=decimal.Decimal(num_stocks))
+        return ret == 1
+
+    def set_auto_buy_amount(self, user_id, stock_symbol, amount, exists) -> bool:
+        if not exists:
+            # Create the auto_buy embedded document for this stock.
+            new_auto_buy = AutoTransaction(user_id=user_id, symbol=stock_symbol, amount=amount)
+            return Accounts.objects(pk=user_id).update_one(write_concern=ACCOUNTS_WRITE_CONCERN, push__auto_buy=new_auto_buy) == 1
+
+        # Update the auto buy amount, reset the buy trigger.
+        update = {
+            'set__auto_buy__S__amount': amount,
+            'set__auto_buy__S__trigger': 0.00
+        }
+        return Accounts.objects(pk=user_id, auto_buy__symbol=stock_symbol).update_one(write_concern=ACCOUNTS_WRITE_CONCERN, **update) == 1
+
+    def reserve_auto_buy(self, user_id, stock_symbol, trigger, cost, transaction_num=0):
+        cost = _money(cost)
+        document = self.collection.find_one_and_update(
+            {'_id': user_id, 'available': {'$gte': cost}, 'auto_buy.symbol': stock_symbol},
+            {'$set': {'auto_buy.$.trigger': _money(trigger), 'auto_buy.$.transactionNum': int(transaction_num)}, '$inc': {'available': -cost}},
+            projection={'_id': 0, 'available': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if document is None:
+            return None
+        return document.get('available', 0.0)
+
+    def cancel_auto_buy(self, user_id, stock_symbol, refund) -> bool:
+        update = {
+            'inc__available': decimal.Decimal(refund),
+            'pull__auto_buy__symbol': stock_symbol
+        }
+        return Accounts.objects(pk=user_id).update_one(write_concern=ACCOUNTS_WRITE_CONCERN, **update) == 1
+
+    def set_auto_sell(self, user_id, stock_symbol, amount, trigger, previous_amount=None, transaction_num=0) -> bool:
+        if previous_amount is None:
+            new_auto_sell = AutoTransaction(user_id=user_id, symbol=stock_symbol, amount=amount, trigger=trigger, transactionNum=transaction_num)
+            return Accounts.objects(pk=user_id).update_one(write_concern=ACCOUNTS_WRITE_CONCERN, push__auto_sell=new_auto_sell) == 1
+
+        # Update the auto sell and adjust the amount of reserved stocks
+        update = {
+            'set__auto_sell__S__amount': amount,
+            'set__auto_sell__S__trigger': trigger,
+            'set__auto_sell__S__transactionNum': transaction_num,
+            'inc__stocks__S__available': previous_amount - amount # add previous amount back and remove the new amount
+        }
+        return Accounts.objects(pk=user_id, auto_sell__symbol=stock_symbol, stocks__symbol=stock_symbol).update_one(write_concern=ACCOUNTS_WRITE_CONCERN, **update) == 1
+
+    def cancel_auto_sell(self, user_id, stock_symbol, reserved_amount, remove_auto) -> bool:
+        update = {'inc__stocks__S__available': reserved_amount}
+        if remove_auto:
+            update['pull__auto_sell__symbol'] = stock_symbol
+        return Accounts.objects(pk=user_id, stocks__symbol=stock_symbol).update_one(write_concern=ACCOUNTS_WRITE_CONCERN, **update) == 1
+
+    def complete_auto_buy(self, user_id, stock_symbol, num_stocks, reserved, cost, has_stock) -> bool:
+        update = {
+            'pull__auto_buy__symbol': stock_symbol, # Remove the auto buy transaction from the users list of auto buys
+            'inc__available': (decimal.Decimal(reserved) - decimal.Decimal(cost)), # Add the difference between the reserved amount and transaction cost to the amount available.
+            'inc__account': -decimal.Decimal(cost) # Deduct the transaction cost from the account.
+        }
+
+        if not has_stock:
+            # Create a new stock
+            update['push__stocks'] = Stocks(symbol=stock_symbol, amount=num_stocks, available=num_stocks)
+            return Accounts.objects(pk=user_id).update_one(write_concern=ACCOUNTS_WRITE_CONCERN, **update) == 1
+
+        # Increment the amount of stock
+        update['inc__stocks__S__amount'] = num_stocks
+        update['inc__stocks__S__available'] = num_stocks
+        return Accounts.objects(pk=user_id, stocks__symbol=stock_symbol).update_one(write_concern=ACCOUNTS_WRITE_CONCERN, **update) == 1
+
+    def complete_auto_sell(self, user_id, stock_symbol, num_stocks, profit, remove_stock) -> bool:
+        update = {
+            'pull__auto_sell__symbol': stock_symbol, # Remove the auto sell
+            'inc__account': decimal.Decimal(profit),
+            'inc__available': decimal.Decimal(profit)
+        }
+
+        if remove_stock:
+            update['pull__stocks__symbol'] = stock_symbol # Remove the stock if there is none remaining
+            return Accounts.objects(pk=user_id).update_one(write_concern=ACCOUNTS_WRITE_CONCERN, **update) == 1
+
+        update['inc__stocks__S__amount'] = -num_stocks # Decrement the number of the stock
+        return Accounts.objects(pk=user_id, stocks__symbol=stock_symbol).update_one(write_concern=ACCOUNTS_WRITE_CONCERN, **update) == 1
+
+
+class MapAccountRepository(AccountRepository):
+    '''
+    Accounts with stocks/auto transactions in maps keyed by symbol, e.g.
+        stock_map.ABC = {'symbol': 'ABC', 'amount': 10, 'available': 4}
+    Every read and update addresses the symbol by dotted path, so there is no array
+    scan and no positional operator; creating a stock is just an $inc of a missing path.
+
+    Accounts that have not been converted yet (layout != MAP_LAYOUT) are migrated the
+    first time they are touched, so this can run while database/migrate_accounts.py
+    converts the rest in the background.
+    '''
+
+    def _find_one(self, user_id, projection):
+        projection = dict(projection, layout=1)
+        document = self.collection.find_one({'_id': user_id}, projection)
+        if document is not None and document.get('layout') != MAP_LAYOUT and self.migrate_account(user_id):
+            document = self.collection.find_one({'_id': user_id}, projection)
+        return document
+
+    def _update(self, user_id, update, guard=None) -> bool:
+        query = {'_id': user_id, 'layout': MAP_LAYOUT}
+        if guard:
+            query.update(guard)
+
+        result = self.collection.update_one(query, update)
+        if result.matched_count == 0 and self.migrate_account(user_id):
+            result = self.collection.update_one(query, update)
+        return result.matched_count == 1
+
+    def _find_one_and_update(self, user_id, update, guard, projection):
+        query = dict(guard, _id=user_id, layout=MAP_LAYOUT)
+        document = self.collection.find_one_and_update(query, update, projection=projection, return_document=ReturnDocument.AFTER)
+        if document is None and self.migrate_account(user_id):
+            document = self.collection.find_one_and_update(query, update, projection=projection, return_document=ReturnDocument.AFTER)
+        return document
+
+    def migrate_account(self, user_id) -> bool:
+        '''
+        Converts the account if it still has the list layout.
+        Returns True if it was converted now, False if there was nothing to do.
+        '''
+        for _ in range(3):
+            document = self.collection.find_one({'_id': user_id, 'layout': {'$ne': MAP_LAYOUT}})
+            if document is None:
+                return False
+            if migrate_document(self.collection, document):
+                return True
+        return False
+
+    def get_stock(self, user_id, stock_symbol):
+        document = self._find_one(user_id, {'_id': 0, f'stock_map.{stock_symbol}': 1})
+        return _stock_record(_entry(document, 'stock_map', stock_symbol))
+
+    def get_auto(self, kind, user_id, stock_symbol, with_available=False):
+        field = MAP_FIELDS[kind]
+        projection = {'_id': 0, f'{field}.{stock_symbol}': 1}
+        if with_available:
+            projection['available'] = 1
+
+        document = self._find_one(user_id, projection)
+        record = _auto_record(_entry(document, field, stock_symbol))
+        if with_available:
+            return record, (document.get('available', 0.0) if document else None)
+        return record
+
+    def get_auto_with_stock(self, kind, user_id, stock_symbol):
+        field = MAP_FIELDS[kind]
+        document = self._find_one(user_id, {'_id': 0, f'{field}.{stock_symbol}': 1, f'stock_map.{stock_symbol}': 1})
+        return _auto_record(_entry(document, field, stock_symbol)), _stock_record(_entry(document, 'stock_map', stock_symbol))
+
+    def get_triggered_users(self, kind, user_ids, stock_symbol, value) -> list:
+        condition = '$lte' if kind == self.AUTO_BUY else '$gte'
+        # Accounts not migrated yet are matched by their list entries.
+        cursor = self.collection.find(
+            {'_id': {'$in': list(user_ids)}, '$or': [
+                {f'{MAP_FIELDS[kind]}.{stock_symbol}.trigger': {condition: value}},
+                {kind: {'$elemMatch': {'symbol': stock_symbol, 'trigger': {condition: value}}}}
+            ]},
+            {'_id': 1}
+        )
+        return [document['_id'] for document in cursor]
+
+    def create_account(self, user_id, amount) -> bool:
+        # Upserted, an account created (or migrated) since the existence check just gets the funds.
+        amount = _money(amount)
+        self.collection.update_one(
+            {'_id': user_id},
+            {
+                '$inc': {'account': amount, 'available': amount},
+                '$setOnInsert': {'layout': MAP_LAYOUT, 'stock_map': {}, 'auto_buy_map': {}, 'auto_sell_map': {}}
+            },
+            upsert=True
+        )
+        return True
+
+    def reserve_stock(self, user_id, stock_symbol, num_stocks):
+        path = f'stock_map.{stock_symbol}'
+        document = self._find_one_and_update(
+            user_id,
+            {'$inc': {f'{path}.available': -int(num_stocks)}},
+            {f'{path}.available': {'$gte': num_stocks}},
+            {'_id': 0, path: 1}
+        )
+        return _stock_record(_entry(document, 'stock_map', stock_symbol))
+
+    def remove_empty_stock(self, user_id, stock_symbol) -> bool:
+        path = f'stock_map.{stock_symbol}'
+        return self._update(user_id, {'$unset': {path: ''}}, guard={f'{path}.amount': 0})
+
+    def buy_stock(self, user_id, stock_symbol, num_stocks, cost, transaction_num=None) -> bool:
+        path = f'stock_map.{stock_symbol}'
+        update = {
+            '$inc': {'account': -_money(cost), f'{path}.amount': int(num_stocks), f'{path}.available': int(num_stocks)},
+            '$set': {f'{path}.symbol': stock_symbol}
+        }
+        if transaction_num is not None:
+            update['$set'][f'commits.{self.BUY}'] = int(transaction_num)
+        return self._update(user_id, update)
+
+    def sell_stock(self, user_id, stock_symbol, num_stocks, profit, transaction_num=None) -> bool:
+        path = f'stock_map.{stock_symbol}'
+        profit = _money(profit)
+        update = {'$inc': {f'{path}.amount': -int(num_stocks), 'account': profit, 'available': profit}}
+        if transaction_num is not None:
+            update['$set'] = {f'commits.{self.SELL}': int(transaction_num)}
+        return self._update(user_id, update, guard={path: {'$exists': True}})
+
+    def release_stock(self, user_id, stock_symbol, num_stocks) -> bool:
+        path = f'stock_map.{stock_symbol}'
+        return self._update(user_id, {'$inc': {f'{path}.available': int(num_stocks)}}, guard={path: {'$exists': True}})
+
+    def set_auto_buy_amount(self, user_id, stock_symbol, amount, exists) -> bool:
+        return self._update(user_id, {'$set': {f'auto_buy_map.{stock_symbol}': {
+            'user_id': user_id, 'symbol': stock_symbol, 'amount': amount, 'trigger': 0.0
+        }}})
+
+    def reserve_auto_buy(self, user_id, stock_symbol, trigger, cost, transaction_num=0):
+        cost = _money(cost)
+        path = f'auto_buy_map.{stock_symbol}'
+        document = self._find_one_and_update(
+            user_id,
+            {'$set': {f'{path}.trigger': _money(trigger), f'{path}.transactionNum': int(transaction_num)}, '$inc': {'available': -cost}},
+            {'available': {'$gte': cost}, path: {'$exists': True}},
+            {'_id': 0, 'available': 1}
+        )
+        if document is None:
+            return None
+        return document.get('available', 0.0)
+
+    def cancel_auto_buy(self, user_id, stock_symbol, refund) -> bool:
+        return self._update(user_id, {
+            '$inc': {'available': _money(refund)},
+            '$unset': {f'auto_buy_map.{stock_symbol}': ''}
+        })
+
+    def set_auto_sell(self, user_id, stock_symbol, amount, trigger, previous_amount=None, transaction_num=0) -> bool:
+        path = f'auto_sell_map.{stock_symbol}'
+        update = {'$set': {path: {'user_id': user_id, 'symbol': stock_symbol, 'amount': amount, 'trigger': _money(trigger), 'transactionNum': int(transaction_num)}}}
+        if previous_amount is None:
+            return self._update(user_id, update)
+
+        # Add previous amount back and remove the new amount
+        update['$inc'] = {f'stock_map.{stock_symbol}.available': previous_amount - amount}
+        return self._update(user_id, update, guard={path: {'$exists': True}, f'stock_map.{stock_symbol}': {'$exists': True}})
+
+    def cancel_auto_sell(self, user_id, stock_symbol, reserved_amount, remove_auto) -> bool:
+        update = {'$inc': {f'stock_map.{stock_symbol}.available': int(reserved_amount)}}
+        if remove_auto:
+            update['$unset'] = {f'auto_sell_map.{stock_symbol}': ''}
+        return self._update(user_id, update, guard={f'stock_map.{stock_symbol}': {'$exists': True}})
+
+    def complete_auto_buy(self, user_id, stock_symbol, num_stocks, reserved, cost, has_stock) -> bool:
+        path = f'stock_map.{stock_symbol}'
+        return self._update(user_id, {
+            '$unset': {f'auto_buy_map.{stock_symbol}': ''},
+            '$inc': {
+                'available': _money(decimal.Decimal(str(reserved)) - decimal.Decimal(str(cost))),
+                'account': -_money(cost),
+                f'{path}.amount': int(num_stocks),
+                f'{path}.available': int(num_stocks)
+            },
+            '$set': {f'{path}.symbol': stock_symbol}
+        })
+
+    def complete_auto_sell(self, user_id, stock_symbol, num_stocks, profit, remove_stock) -> bool:
+        path = f'stock_map.{stock_symbol}'
+        profit = _money(profit)
+        update = {
+            '$unset': {f'auto_sell_map.{stock_symbol}': ''},
+            '$inc': {'account': profit, 'available': profit}
+        }
+        if remove_stock:
+            update['$unset'][path] = ''
+        else:
+            update['$inc'][f'{path}.amount'] = -int(num_stocks)
+        return self._update(user_id, update, guard={path: {'$exists': True}})
+
+
+class MemoryAccountRepository(AccountRepository):
+    '''
+    Keeps the accounts in this process as map layout documents (STORAGE=memory),
+    so the command handlers can be benchmarked without a database. Results,
+    guards and money rounding are the same as MapAccountRepository's. Each
+    method holds one lock, like a single document update.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self._accounts = {} # user_id -> map layout document
+        self._mutex = threading.Lock()
+
+    def __len__(self):
+        return len(self._accounts)
+
+    def user_exists(self, user_id, redis_cache) -> bool:
+        return user_id in self._accounts
+
+    def user_exists_with_quote(self, user_id, stock_symbol, redis_cache):
+        return user_id in self._accounts, quote_cache.get(stock_symbol, redis_cache)
+
+    def add_funds(self, user_id, amount, to_account=True) -> bool:
+        amount = _money(amount)
+        with self._mutex:
+            account = self._accounts.get(user_id)
+            if account is None:
+                return False
+            account['available'] += amount
+            if to_account:
+                account['account'] += amount
+            return True
+
+    def account_summary(self, user_id) -> str:
+        with self._mutex:
+            account = self._accounts.get(user_id)
+            return json.dumps([account] if account is not None else [])
+
+    def get_available(self, user_id):
+        with self._mutex:
+            account = self._accounts.get(user_id)
+            return account['available'] if account is not None else None
+
+    def last_commit(self, user_id, kind):
+        with self._mutex:
+            account = self._accounts.get(user_id)
+            return account.get('commits', {}).get(kind) if account is not None else None
+
+    def reserve_funds(self, user_id, amount):
+        amount = _money(amount)
+        with self._mutex:
+            account = self._accounts.get(user_id)
+            if account is None or account['available'] < amount:
+                return None
+            account['available'] -= amount
+            return account['available']
+
+    def get_stock(self, user_id, stock_symbol):
+        with self._mutex:
+            return _stock_record(_entry(self._accounts.get(user_id), 'stock_map', stock_symbol))
+
+    def get_auto(self, kind, user_id, stock_symbol, with_available=False):
+        with self._mutex:
+            account = self._accounts.get(user_id)
+            record = _auto_record(_entry(account, MAP_FIELDS[kind], stock_symbol))
+            if with_available:
+                return record, (account['available'] if account is not None else None)
+            return record
+
+    def get_auto_with_stock(self, kind, user_id, stock_symbol):
+        with self._mutex:
+            account = self._accounts.get(user_id)
+            return _auto_record(_entry(account, MAP_FIELDS[kind], stock_symbol)), _stock_record(_entry(account, 'stock_map', stock_symbol))
+
+    def get_triggered_users(self, kind, user_ids, stock_symbol, value) -> list:
+        triggered = []
+        with self._mutex:
+            for user_id in user_ids:
+                auto = _entry(self._accounts.get(user_id), MAP_FIELDS[kind], stock_symbol)
+                if auto is not None and (auto['trigger'] <= value if kind == self.AUTO_BUY else auto['trigger'] >= value):
+                    triggered.append(user_id)
+        return triggered
+
+    def create_account(self, user_id, amount) -> bool:
+        amount = _money(amount)
+        with self._mutex:
+            account = self._accounts.setdefault(user_id, {
+                '_id': user_id,
+                'account': _money(0),
+                'available': _money(0),
+                'layout': MAP_LAYOUT,
+                'stock_map': {},
+                'auto_buy_map': {},
+                'auto_sell_map': {}
+            })
+            account['account'] += amount
+            account['available'] += amount
+        return True
+
+    def reserve_stock(self, user_id, stock_symbol, num_stocks):
+        with self._mutex:
+            stock = _entry(self._accounts.get(user_id), 'stock_map', stock_symbol)
+            if stock is None or stock['available'] < num_stocks:
+                return None
+            stock['available'] -= int(num_stocks)
+            return _stock_record(stock)
+
+    def remove_empty_stock(self, user_id, stock_symbol) -> bool:
+        with self._mutex:
+            account = self._accounts.get(user_id)
+            stock = _entry(account, 'stock_map', stock_symbol)
+            if stock is None or stock['amount'] != 0:
+                return False
+            del account['stock_map'][stock_symbol]
+            return True
+
+    def _add_stock(self, account, stock_symbol, num_stocks):
+        stock = account['stock_map'].setdefault(stock_symbol, {'symbol': stock_symbol, 'amount': 0, 'available': 0})
+        stock['amount'] += int(num_stocks)
+        stock['available'] += int(num_stocks)
+
+    def buy_stock(self, user_id, stock_symbol, num_stocks, cost, transaction_num=None) -> bool:
+        with self._mutex:
+            account = self._accounts.get(user_id)
+            if account is None:
+                return False
+            account['account'] -= _money(cost)
+            self._add_stock(account, stock_symbol, num_stocks)
+            if transaction_num is not None:
+                account.setdefault('commits', {})[self.BUY] = int(transaction_num)
+            return True
+
+    def sell_stock(self, user_id, stock_symbol, num_stocks, profit, transaction_num=None) -> bool:
+        profit = _money(profit)
+        with self._mutex:
+            account = self._accounts.get(user_id)
+            stock = _entry(account, 'stock_map', stock_symbol)
+            if stock is None:
+                return False
+            stock['amount'] -= int(num_stocks)
+            account['account'] += profit
+            account['available'] += profit
+            if transaction_num is not None:
+                account.setdefault('commits', {})[self.SELL] = int(transaction_num)
+            return True
+
+    def release_stock(self, user_id, stock_symbol, num_stocks) -> bool:
+        with self._mutex:
+            stock = _entry(self._accounts.get(user_id), 'stock_map', stock_symbol)
+            if stock is None:
+                return False
+            stock['available'] += int(num_stocks)
+            return True
+
+    def set_auto_buy_amount(self, user_id, stock_symbol, amount, exists) -> bool:
+        with self._mutex:
+            account = self._accounts.get(user_id)
+            if account is None:
+                return False
+            account['auto_buy_map'][stock_symbol] = {'user_id': user_id, 'symbol': stock_symbol, 'amount': amount, 'trigger': 0.0}
+            return True
+
+    def reserve_auto_buy(self, user_id, stock_symbol, trigger, cost, transaction_num=0):
+        cost = _money(cost)
+        with self._mutex:
+            account = self._accounts.get(user_id)
+            auto = _entry(account, 'auto_buy_map', stock_symbol)
+            if auto is None or account['available'] < cost:
+                return None
+            auto['trigger'] = _money(trigger)
+            auto['transactionNum'] = int(transaction_num)
+            account['available'] -= cost
+            return account['available']
+
+    def cancel_auto_buy(self, user_id, stock_symbol, refund) -> bool:
+        with self._mutex:
+            account = self._accounts.get(user_id)
+            if account is None:
+                return False
+            account['available'] += _money(refund)
+            account['auto_buy_map'].pop(stock_symbol, None)
+            return True
+
+    def set_auto_sell(self, user_id, stock_symbol, amount, trigger, previous_amount=None, transaction_num=0) -> bool:
+        with self._mutex:
+            account = self._accounts.get(user_id)
+            if account is None:
+                return False
+            if previous_amount is not None:
+                stock = _entry(account, 'stock_map', stock_symbol)
+                if stock is None or _entry(account, 'auto_sell_map', stock_symbol) is None:
+                    return False
+                # Add previous amount back and remove the new amount
+                stock['available'] += previous_amount - amount
+            account['auto_sell_map'][stock_symbol] = {'user_id': user_id, 'symbol': stock_symbol, 'amount': amount, 'trigger': _money(trigger), 'transactionNum': int(transaction_num)}
+            return True
+
+    def cancel_auto_sell(self, user_id, stock_symbol, reserved_amount, remove_auto) -> bool:
+        with self._mutex:
+            account = self._accounts.get(user_id)
+            stock = _entry(account, 'stock_map', stock_symbol)
+            if stock is None:
+                return False
+            stock['available'] += int(reserved_amount)
+            if remove_auto:
+                account['auto_sell_map'].pop(stock_symbol, None)
+            return True
+
+    def complete_auto_buy(self, user_id, stock_symbol, num_stocks, reserved, cost, has_stock) -> bool:
+        with self._mutex:
+            account = self._accounts.get(user_id)
+            if account is None:
+                return False
+            account['auto_buy_map'].pop(stock_symbol, None)
+            account['available'] += _money(decimal.Decimal(str(reserved)) - decimal.Decimal(str(cost)))
+            account['account'] -= _money(cost)
+            self._add_stock(account, stock_symbol, num_stocks)
+            return True
+
+    def complete_auto_sell(self, user_id, stock_symbol, num_stocks, profit, remove_stock) -> bool:
+        profit = _money(profit)
+        with self._mutex:
+            account = self._accounts.get(user_id)
+            stock = _entry(account, 'stock_map', stock_symbol)
+            if stock is None:
+                return False
+            account['auto_sell_map'].pop(stock_symbol, None)
+            account['account'] += profit
+            account['available'] += profit
+            if remove_stock:
+                del account['stock_map'][stock_symbol]
+            else:
+                stock['amount'] -= int(num_stocks)
+            return True
+
+
+def create_repository(layout=None) -> AccountRepository:
+    if STORAGE == 'memory':
+        return MemoryAccountRepository()
+    layout = layout or os.environ.get('ACCOUNT_LAYOUT', 'list')
+    if layout == 'map':
+        return MapAccountRepository()
+    return ListAccountRepository()
+
+
+# Shared by the command handlers and the polling thread. pymongo collections are thread safe.
+account_repository = create_repository()
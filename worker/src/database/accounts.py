@@ -1,9 +1,6 @@
-import os
 import mongoengine as me
 from . import user_cache
-
-MONGO_URI = 'mongodb://' + os.environ['MONGODB_USERNAME'] + ':' + os.environ['MONGODB_PASSWORD'] + '@' + os.environ['MONGODB_HOSTNAME'] + ':27017/' + os.environ['MONGODB_DATABASE']
-me.connect(host = MONGO_URI)
+from . import connection # Registers the Mongo connections.
 
 
 class Stocks(me.EmbeddedDocument):
@@ -17,6 +14,7 @@ class AutoTransaction(me.EmbeddedDocument):
     symbol = me.StringField(required=True, max_length=3)
     amount = me.IntField(required=True)
     trigger = me.DecimalField(default=0.00, precision=2)
+    transactionNum = me.IntField(default=0) # Of the command that set the trigger, logged when it fires.
 
 
 class Accounts(me.Document):
@@ -27,6 +25,17 @@ class Accounts(me.Document):
     auto_buy = me.EmbeddedDocumentListField(AutoTransaction, default=[])
     auto_sell = me.EmbeddedDocumentListField(AutoTransaction, default=[])
 
+    # Symbol keyed layout used with ACCOUNT_LAYOUT=map (see account_repository.py).
+    # Accounts are converted by migrate_accounts.py; layout is 2 once converted.
+    layout = me.IntField(default=1)
+    stock_map = me.MapField(me.EmbeddedDocumentField(Stocks))
+    auto_buy_map = me.MapField(me.EmbeddedDocumentField(AutoTransaction))
+    auto_sell_map = me.MapField(me.EmbeddedDocumentField(AutoTransaction))
+
+    # 'buy'/'sell' -> transactionNum of the last BUY/SELL committed, set in the same
+    # update as the shares and funds so a replayed pending entry can tell it was committed.
+    commits = me.MapField(me.IntField())
+
     @staticmethod
     def user_exists(user_id, redis_cache) -> bool:
         """Checks if the user is in the database."""
@@ -34,11 +43,31 @@ class Accounts(me.Document):
         if user_cache.user_exists(user_id=user_id, redis_cache=redis_cache):
             return True
         else:
-            # Check db.
-            if not Accounts.objects(__raw__={'_id': user_id}).only('user_id'):
-                return False
-            else:
-                return True
+            return Accounts.user_in_db(user_id=user_id, redis_cache=redis_cache)
+
+    @staticmethod
+    def user_exists_with_quote(user_id, stock_symbol, redis_cache):
+        """
+        Checks if the user is in the database and gets the cached quote for the stock.
+        Returns a tuple (user exists, cached stock price or None).
+        """
+        exists, stock_price = user_cache.user_exists_with_quote(user_id=user_id, stock_symbol=stock_symbol, redis_cache=redis_cache)
+        if not exists:
+            exists = Accounts.user_in_db(user_id=user_id, redis_cache=redis_cache)
+        return exists, stock_price
+
+    @staticmethod
+    def user_in_db(user_id, redis_cache) -> bool:
+        """Checks the db for the user, caching the result either way."""
+        if user_cache.is_missing(user_id):
+            return False
+
+        if not Accounts.objects(__raw__={'_id': user_id}).only('user_id'):
+            user_cache.mark_missing(user_id)
+            return False
+        else:
+            user_cache.add_user(user_id=user_id, redis_cache=redis_cache)
+            return True
 
 
 # Test function.
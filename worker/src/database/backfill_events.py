@@ -0,0 +1,94 @@
+''' Copies the existing split log collections into the unified 'events' collection.
+
+Run from worker/src with the MONGODB_* and SERVER_NAME variables set, before or
+after switching the workers to LOG_STORE=unified:
+
+    python3 -m database.backfill_events --batch-size 5000
+
+Documents keep their _id, so the backfill can be stopped and rerun; documents
+already copied are skipped. Events written by the workers since the switch are
+left alone.
+'''
+
+from argparse import ArgumentParser
+import time
+import sys
+from pymongo.errors import BulkWriteError
+from .logs import EVENT_TYPES, events_collection
+
+DUPLICATE_KEY = 11000
+
+parser = ArgumentParser(
+    description='Backfill the unified events collection from the split log collections'
+)
+parser.add_argument('--batch-size',
+    dest='batch_size', type=int, default=5000,
+    help='Documents copied per insert_many'
+)
+parser.add_argument('--pause',
+    dest='pause', type=float, default=0.0,
+    help='Seconds to sleep between batches to limit the load on Mongo'
+)
+parser.add_argument('--types',
+    dest='types', nargs='+', default=list(EVENT_TYPES.values()), choices=list(EVENT_TYPES.values()),
+    help='Log types to copy'
+)
+parser.add_argument('--dry-run',
+    action='store_true', dest='dry_run', default=False,
+    help='Count the documents that would be copied without writing'
+)
+
+def insert_batch(events, batch) -> int:
+    ''' Returns the number of documents inserted. Documents copied by an earlier run are skipped. '''
+    try:
+        return len(events.insert_many(batch, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        other_errors = [error for error in e.details['writeErrors'] if error['code'] != DUPLICATE_KEY]
+        if other_errors:
+            raise
+        return e.details['nInserted']
+
+def backfill_type(events, log_type, name, args) -> tuple:
+    ''' Copies one split collection. Returns (documents seen, documents inserted). '''
+    collection = log_type._get_collection()
+    seen = 0
+    inserted = 0
+    batch = []
+    for document in collection.find({}).sort('_id', 1).batch_size(args.batch_size):
+        document['type'] = name
+        batch.append(document)
+        if len(batch) == args.batch_size:
+            seen += len(batch)
+            if not args.dry_run:
+                inserted += insert_batch(events, batch)
+            batch = []
+            print(f"\t{name}: Seen: {seen:>10} | Inserted: {inserted:>10} |")
+            sys.stdout.flush()
+            if args.pause > 0:
+                time.sleep(args.pause)
+
+    if batch:
+        seen += len(batch)
+        if not args.dry_run:
+            inserted += insert_batch(events, batch)
+    return seen, inserted
+
+def main():
+    args = parser.parse_args()
+    events = events_collection()
+
+    start = time.time()
+    for log_type, name in EVENT_TYPES.items():
+        if name not in args.types:
+            continue
+        seen, inserted = backfill_type(events, log_type, name, args)
+        if args.dry_run:
+            print(f"{name}: {seen} documents would be copied")
+        else:
+            print(f"{name}: {seen} documents, {inserted} inserted, {seen - inserted} already copied")
+        sys.stdout.flush()
+
+    print(f"Finished in {time.time()-start:.1f}s, events collection has {events.estimated_document_count()} documents")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+''' Mongo connections shared by the account and log documents and the raw pymongo paths.
+
+Connections are registered with mongoengine when this module is imported but the
+clients are only created on first use. main.py waits for Mongo to answer and warms
+the pools before the worker starts consuming, so the first commands don't pay for
+connection setup. Settings:
+
+    MONGO_MAX_POOL_SIZE=100          connections per client
+    MONGO_MIN_POOL_SIZE=8            connections opened at startup and kept open
+    MONGO_COMPRESSORS=zstd,snappy,zlib
+                                     wire compression, in order of preference. zstd and snappy
+                                     need the zstandard/python-snappy packages and are skipped
+                                     by pymongo when those aren't installed.
+    MONGO_SEPARATE_LOGS_CLIENT=false logs get their own client (and pool), so log writes
+                                     don't queue behind account updates
+    MONGODB_LOGS_HOSTNAME            host of the logs client (defaults to MONGODB_HOSTNAME)
+    MONGO_READY_TIMEOUT=60           seconds to wait for Mongo at startup
+    STORAGE=mongo                    memory keeps the accounts and logs in the worker process
+                                     instead (account_repository.MemoryAccountRepository,
+                                     logs.MemoryEventLog) and nothing connects to Mongo
+'''
+
+import os
+import sys
+import time
+import threading
+import mongoengine
+from pymongo.errors import PyMongoError
+
+ACCOUNTS_ALIAS = mongoengine.DEFAULT_CONNECTION_NAME
+SEPARATE_LOGS_CLIENT = os.environ.get('MONGO_SEPARATE_LOGS_CLIENT', 'false').lower() in ('1', 'true', 'yes')
+LOGS_ALIAS = 'logs' if SEPARATE_LOGS_CLIENT else ACCOUNTS_ALIAS
+
+MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', 100))
+MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', 8))
+COMPRESSORS = os.environ.get('MONGO_COMPRESSORS', 'zstd,snappy,zlib')
+READY_TIMEOUT = float(os.environ.get('MONGO_READY_TIMEOUT', 60))
+STORAGE = os.environ.get('STORAGE', 'mongo')
+
+
+def mongo_uri(hostname=None) -> str:
+    hostname = hostname or os.environ['MONGODB_HOSTNAME']
+    return 'mongodb://' + os.environ['MONGODB_USERNAME'] + ':' + os.environ['MONGODB_PASSWORD'] + '@' + hostname + ':27017/' + os.environ['MONGODB_DATABASE']
+
+def client_options() -> dict:
+    options = {
+        'maxPoolSize': MAX_POOL_SIZE,
+        'minPoolSize': min(MIN_POOL_SIZE, MAX_POOL_SIZE)
+    }
+    if COMPRESSORS:
+        options['compressors'] = COMPRESSORS
+    return options
+
+def aliases() -> list:
+    return [ACCOUNTS_ALIAS, LOGS_ALIAS] if SEPARATE_LOGS_CLIENT else [ACCOUNTS_ALIAS]
+
+def register():
+    ''' Registers the connection settings. mongoengine creates each client the first time it's used. '''
+    mongoengine.register_connection(alias=ACCOUNTS_ALIAS, host=mongo_uri(), **client_options())
+    if SEPARATE_LOGS_CLIENT:
+        mongoengine.register_connection(alias=LOGS_ALIAS, host=mongo_uri(os.environ.get('MONGODB_LOGS_HOSTNAME')), **client_options())
+
+def wait_until_ready(timeout=READY_TIMEOUT):
+    ''' Blocks until every client answers a ping. Raises RuntimeError after timeout seconds. '''
+    deadline = time.time() + timeout
+    for alias in aliases():
+        client = mongoengine.get_connection(alias)
+        while True:
+            try:
+                client.admin.command('ping')
+                break
+            except PyMongoError as e:
+                if time.time() >= deadline:
+                    raise RuntimeError(f"Mongo ({alias}) was not reachable after {timeout}s: {e}")
+                print(f"Waiting for Mongo ({alias}): {e}")
+                sys.stdout.flush()
+                time.sleep(1)
+
+def prewarm(documents=()):
+    '''
+    Opens MIN_POOL_SIZE connections on every client, then resolves the documents'
+    collections so mongoengine's index checks are done before the first command.
+    '''
+    start = time.time()
+    for alias in aliases():
+        client = mongoengine.get_connection(alias)
+        # Pings held at the same time each need their own connection.
+        barrier = threading.Barrier(MIN_POOL_SIZE) if MIN_POOL_SIZE > 0 else None
+
+        def ping():
+            try:
+                barrier.wait(timeout=5)
+            except threading.BrokenBarrierError:
+                pass
+            client.admin.command('ping')
+
+        threads = [threading.Thread(target=ping) for _ in range(MIN_POOL_SIZE)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    for document in documents:
+        document._get_collection()
+
+    print(f"Warmed {MIN_POOL_SIZE} Mongo connections per client in {time.time()-start:.3f}s (compressors: {COMPRESSORS or 'none'})")
+    sys.stdout.flush()
+
+
+if STORAGE != 'memory':
+    register()
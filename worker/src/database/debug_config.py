@@ -0,0 +1,108 @@
+''' Decides which debug events are recorded.
+
+Debug events have a level and are sampled per command. Sampling is decided per
+transaction, so a sampled command keeps all of its debug events. The starting
+config comes from the environment:
+
+    DEBUG_LEVEL=info                  off, info or verbose
+    DEBUG_SAMPLE_RATE=1.0             fraction of commands whose debug events are kept
+    DEBUG_SAMPLE_RATES="SET_BUY_AMOUNT:0.1;BUY:0.5"
+
+and can be changed at runtime through the 'debug_config' Redis hash, ex.
+
+    HSET debug_config level verbose sample_rate 0.01 sample_rate:SET_SELL_TRIGGER 1.0
+
+The hash is read again at most every DEBUG_REFRESH_PERIOD seconds, when a debug event is checked.
+'''
+
+import os
+import time
+import threading
+
+OFF = 0
+INFO = 1
+VERBOSE = 2
+LEVELS = {'off': OFF, 'info': INFO, 'verbose': VERBOSE}
+
+REDIS_KEY = 'debug_config'
+SAMPLE_PREFIX = 'sample_rate:'
+
+
+def parse_rates(spec: str) -> dict:
+    rates = {}
+    for entry in (spec or '').split(';'):
+        if not entry.strip():
+            continue
+        command, _, rate = entry.partition(':')
+        rates[command.strip()] = float(rate)
+    return rates
+
+
+class DebugConfig:
+    def __init__(self, level='info', sample_rate=1.0, sample_rates=None, refresh_period=5.0):
+        self.level = LEVELS[level]
+        self.sample_rate = sample_rate
+        self.sample_rates = sample_rates or {}
+        self.refresh_period = refresh_period
+
+        self._defaults = (self.level, self.sample_rate, dict(self.sample_rates))
+        self._redis_cache = None
+        self._next_refresh = 0.0
+        self._refresh_lock = threading.Lock()
+
+    def attach(self, redis_cache):
+        ''' Enables runtime changes through the Redis hash. '''
+        self._redis_cache = redis_cache
+        self._next_refresh = 0.0
+
+    def enabled(self, command, transactionNum, level=INFO) -> bool:
+        ''' Whether a debug event of this level for this command should be recorded. '''
+        self._maybe_refresh()
+        if level > self.level:
+            return False
+
+        rate = self.sample_rates.get(command, self.sample_rate)
+        if rate >= 1.0:
+            return True
+        if rate <= 0.0:
+            return False
+        # Knuth's multiplicative hash spreads consecutive transaction numbers evenly.
+        return ((int(transactionNum) * 2654435761) % 4294967296) / 4294967296 < rate
+
+    def _maybe_refresh(self):
+        if self._redis_cache is None or time.monotonic() < self._next_refresh:
+            return
+        # Only one thread reads the hash, the others keep the current config.
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_refresh = time.monotonic() + self.refresh_period
+            values = self._redis_cache.hgetall(REDIS_KEY)
+            self._apply({key.decode('utf-8'): value.decode('utf-8') for key, value in values.items()})
+        except Exception as e:
+            print(f"Error: Could not read the debug config. {e}")
+        finally:
+            self._refresh_lock.release()
+
+    def _apply(self, values):
+        level, sample_rate, sample_rates = self._defaults
+        sample_rates = dict(sample_rates)
+        for key, value in values.items():
+            if key == 'level' and value in LEVELS:
+                level = LEVELS[value]
+            elif key == 'sample_rate':
+                sample_rate = float(value)
+            elif key.startswith(SAMPLE_PREFIX):
+                sample_rates[key[len(SAMPLE_PREFIX):]] = float(value)
+
+        self.sample_rates = sample_rates
+        self.sample_rate = sample_rate
+        self.level = level
+
+
+debug_config = DebugConfig(
+    level=os.environ.get('DEBUG_LEVEL', 'info'),
+    sample_rate=float(os.environ.get('DEBUG_SAMPLE_RATE', 1.0)),
+    sample_rates=parse_rates(os.environ.get('DEBUG_SAMPLE_RATES')),
+    refresh_period=float(os.environ.get('DEBUG_REFRESH_PERIOD', 5.0))
+)
@@ -1,16 +1,28 @@
 # Interfaces with the 'logs' collection.
 import os
 import time
+import json
+import decimal
+import threading
 import mongoengine
+from pymongo import ASCENDING
+from .connection import LOGS_ALIAS, STORAGE
+from .write_concern import write_concern, strongest, with_write_concern
+from .debug_config import debug_config, INFO
 
-MONGO_URI = 'mongodb://' + os.environ['MONGODB_USERNAME'] + ':' + os.environ['MONGODB_PASSWORD'] + '@' + os.environ['MONGODB_HOSTNAME'] + ':27017/' + os.environ['MONGODB_DATABASE']
-mongoengine.connect(host = MONGO_URI)
 
 SERVER_NAME = os.environ["SERVER_NAME"]
 
+# split: one collection per log type (default).
+# unified: every log goes to the 'events' collection with a 'type' discriminator.
+LOG_STORE = os.environ.get("LOG_STORE", "split")
+EVENTS_COLLECTION = 'events'
+TWO_PLACES = decimal.Decimal('0.01')
+
 # assuming timestamp is in unix time, add later to check for it
 
 class DebugType(mongoengine.Document):
+    meta = {'db_alias': LOGS_ALIAS}
     timestamp = mongoengine.IntField(required=True)
     server = mongoengine.StringField(required=True)
     transactionNum = mongoengine.IntField(required=True, min_value=0)
@@ -21,11 +33,20 @@ class DebugType(mongoengine.Document):
     funds = mongoengine.DecimalField(precision=2)
     debugMessage = mongoengine.StringField()
 
-    def log(self, transactionNum, command, username=None, stockSymbol=None, filename=None, funds=None, debugMessage=None):
-        debug_log = DebugType(timestamp=(round(time.time()*1000)), server=SERVER_NAME, transactionNum=transactionNum, command=command, username=username, stockSymbol=stockSymbol, filename=filename, funds=funds, debugMessage=debugMessage).save()
+    def log(self, transactionNum, command, username=None, stockSymbol=None, filename=None, funds=None, debugMessage=None, level=INFO):
+        '''
+        Skipped unless debug_config records this level and samples this command.
+        debugMessage can be a callable so expensive messages are only built when recorded.
+        '''
+        if not debug_config.enabled(command, transactionNum, level):
+            return
+        if callable(debugMessage):
+            debugMessage = debugMessage()
+        _write(DebugType, timestamp=(round(time.time()*1000)), server=SERVER_NAME, transactionNum=transactionNum, command=command, username=username, stockSymbol=stockSymbol, filename=filename, funds=funds, debugMessage=debugMessage)
 
 
 class ErrorEventType(mongoengine.Document):
+    meta = {'db_alias': LOGS_ALIAS}
     timestamp = mongoengine.IntField(required=True)
     server = mongoengine.StringField(required=True)
     transactionNum = mongoengine.IntField(required=True, min_value=0)
@@ -37,9 +58,10 @@ class ErrorEventType(mongoengine.Document):
     errorMessage = mongoengine.StringField()
 
     def log(self, transactionNum, command, username=None, stockSymbol=None, filename=None, funds=None, errorMessage=None):
-        err_log = ErrorEventType(timestamp=(round(time.time()*1000)), server=SERVER_NAME, transactionNum=transactionNum, command=command, username=username, stockSymbol=stockSymbol, filename=filename, funds=funds, errorMessage=errorMessage).save()
+        _write(ErrorEventType, timestamp=(round(time.time()*1000)), server=SERVER_NAME, transactionNum=transactionNum, command=command, username=username, stockSymbol=stockSymbol, filename=filename, funds=funds, errorMessage=errorMessage)
 
 class SystemEventType(mongoengine.Document):
+    meta = {'db_alias': LOGS_ALIAS}
     timestamp = mongoengine.IntField(required=True)
     server = mongoengine.StringField(required=True)
     transactionNum = mongoengine.IntField(required=True, min_value=0)
@@ -50,9 +72,10 @@ class SystemEventType(mongoengine.Document):
     funds = mongoengine.DecimalField(precision=2)
 
     def log(self, transactionNum, command, username=None, stockSymbol=None, filename=None, funds=None):
-        sys_evnt_log = SystemEventType(timestamp=(round(time.time()*1000)), server=SERVER_NAME, transactionNum=transactionNum, command=command, username=username, stockSymbol=stockSymbol, filename=filename, funds=funds).save()
+        _write(SystemEventType, timestamp=(round(time.time()*1000)), server=SERVER_NAME, transactionNum=transactionNum, command=command, username=username, stockSymbol=stockSymbol, filename=filename, funds=funds)
 
 class AccountTransactionType(mongoengine.Document):
+    meta = {'db_alias': LOGS_ALIAS}
     timestamp = mongoengine.IntField(required=True)
     server = mongoengine.StringField(required=True)
     transactionNum = mongoengine.IntField(required=True, min_value=0)
@@ -61,9 +84,10 @@ class AccountTransactionType(mongoengine.Document):
     funds = mongoengine.DecimalField(required=True, precision=2)
 
     def log(self, transactionNum, action, username, funds):
-        transaction_log = AccountTransactionType(timestamp=(round(time.time()*1000)), server=SERVER_NAME, transactionNum=transactionNum, action=action, username=username, funds=funds).save()
+        _write(AccountTransactionType, timestamp=(round(time.time()*1000)), server=SERVER_NAME, transactionNum=transactionNum, action=action, username=username, funds=funds)
 
 class QuoteServerType(mongoengine.Document):
+    meta = {'db_alias': LOGS_ALIAS}
     timestamp = mongoengine.IntField(required=True)
     server = mongoengine.StringField(required=True)
     transactionNum = mongoengine.IntField(required=True, min_value=0)
@@ -74,10 +98,11 @@ class QuoteServerType(mongoengine.Document):
     cryptokey = mongoengine.StringField(required=True)
 
     def log(self, transactionNum, price, stockSymbol, username, quoteServerTime, cryptokey):
-        quote_log = QuoteServerType(timestamp=(round(time.time()*1000)), server=SERVER_NAME, transactionNum=transactionNum, price=price, stockSymbol=stockSymbol, username=username, quoteServerTime=quoteServerTime, cryptokey=cryptokey).save()
+        _write(QuoteServerType, timestamp=(round(time.time()*1000)), server=SERVER_NAME, transactionNum=transactionNum, price=price, stockSymbol=stockSymbol, username=username, quoteServerTime=quoteServerTime, cryptokey=cryptokey)
 
 
 class UserCommandType(mongoengine.Document):
+    meta = {'db_alias': LOGS_ALIAS}
     timestamp = mongoengine.IntField(required=True)
     server = mongoengine.StringField(required=True)
     transactionNum = mongoengine.IntField(required=True, min_value=0)
@@ -88,11 +113,153 @@ class UserCommandType(mongoengine.Document):
     funds = mongoengine.DecimalField(precision=2)
 
     def log(self, transactionNum, command, username=None, stockSymbol=None, filename=None, funds=None):
-        command_log = UserCommandType(timestamp=(round(time.time()*1000)), server=SERVER_NAME, transactionNum=transactionNum, command=command, username=username, stockSymbol=stockSymbol, filename=filename, funds=funds).save()
+        _write(UserCommandType, timestamp=(round(time.time()*1000)), server=SERVER_NAME, transactionNum=transactionNum, command=command, username=username, stockSymbol=stockSymbol, filename=filename, funds=funds)
+
+# Discriminator stored in 'type' for each log type. The values are the keys of the DUMPLOG json.
+EVENT_TYPES = {
+    UserCommandType: 'userCommand',
+    QuoteServerType: 'quoteServer',
+    AccountTransactionType: 'accountTransaction',
+    SystemEventType: 'systemEvent',
+    ErrorEventType: 'errorEvent',
+    DebugType: 'debugEvent'
+}
+MONEY_FIELDS = ('funds', 'price')
+
+_batch = threading.local()
+_indexes_created = False
+
+def events_collection():
+    global _indexes_created
+    collection = mongoengine.get_db(LOGS_ALIAS)[EVENTS_COLLECTION]
+    if not _indexes_created:
+        # Per-user dumps scan this index in order. _id breaks ties within a transaction.
+        collection.create_index([('username', ASCENDING), ('transactionNum', ASCENDING), ('_id', ASCENDING)])
+        _indexes_created = True
+    return collection
+
+def to_event(log_type, fields) -> dict:
+    '''
+    Builds an events document in the same shape the split collections store:
+    unset fields are left out and money is stored as a 2 decimal place float.
+    '''
+    event = {'type': EVENT_TYPES[log_type]}
+    for name, value in fields.items():
+        if value is None:
+            continue
+        if name in MONEY_FIELDS:
+            value = float(decimal.Decimal(str(value)).quantize(TWO_PLACES, rounding=decimal.ROUND_HALF_UP))
+        event[name] = value
+    return event
+
+class MongoEventLog:
+    ''' Writes the events to one collection per log type, or to the events collection with LOG_STORE=unified. '''
+
+    def begin_batch(self):
+        ''' Collects the events logged by this thread until flush_batch is called. Only used with LOG_STORE=unified. '''
+        if LOG_STORE == 'unified':
+            _batch.events = []
+
+    def flush_batch(self):
+        ''' Writes the events collected since begin_batch with one insert_many. '''
+        events = getattr(_batch, 'events', None)
+        _batch.events = None
+        if events:
+            # One write for the command, as durable as its most important event.
+            policy = strongest({event['type'] for event in events})
+            with_write_concern(events_collection(), policy).insert_many(events, ordered=True)
+
+    def write(self, log_type, fields):
+        name = EVENT_TYPES[log_type]
+        if LOG_STORE != 'unified':
+            log_type(**fields).save(write_concern=write_concern(name))
+            return
+
+        event = to_event(log_type, fields)
+        events = getattr(_batch, 'events', None)
+        if events is not None:
+            events.append(event)
+        else:
+            # Logged outside of a command (ex. the quote polling thread).
+            with_write_concern(events_collection(), name).insert_one(event)
+
+    def dump(self, user_id) -> str:
+        if LOG_STORE == 'unified':
+            return get_unified_logs(user_id)
+        if user_id:
+            return get_user_logs(user_id)
+        return get_split_logs()
+
+
+class MemoryEventLog:
+    '''
+    Keeps the events in this process (STORAGE=memory), in the shape the unified
+    store writes them. Dumps have the same json and order as get_unified_logs.
+    '''
+
+    def __init__(self):
+        self.events = []
+        self._mutex = threading.Lock()
+
+    def __len__(self):
+        return len(self.events)
+
+    def begin_batch(self):
+        pass # Every event is kept as soon as it is logged.
+
+    def flush_batch(self):
+        pass
+
+    def write(self, log_type, fields):
+        event = to_event(log_type, fields)
+        with self._mutex:
+            self.events.append(event)
+
+    def dump(self, user_id) -> str:
+        with self._mutex:
+            events = list(self.events)
+        if user_id:
+            events = sorted((event for event in events if event.get('username') == user_id), key=lambda event: event['transactionNum'])
+
+        grouped = {key: [] for key in EVENT_TYPES.values()}
+        for event in events:
+            event = dict(event)
+            grouped[event.pop('type')].append(event)
+        return json.dumps(grouped)
+
+
+event_log = MemoryEventLog() if STORAGE == 'memory' else MongoEventLog()
+
+def begin_batch():
+    event_log.begin_batch()
+
+def flush_batch():
+    event_log.flush_batch()
+
+def _write(log_type, **fields):
+    event_log.write(log_type, fields)
 
 def get_logs(user_id):
+    return event_log.dump(user_id)
+
+def get_unified_logs(user_id):
+    '''
+    One ordered scan of the events collection, regrouped by type into the split store's json.
+    Per-user dumps follow the (username, transactionNum) index, full dumps the _id order.
+    ObjectIds start with their creation time so the _id order is time ordered.
+    '''
+    grouped = {key: [] for key in EVENT_TYPES.values()}
     if user_id:
-        return get_user_logs(user_id)
+        cursor = events_collection().find({'username': user_id}, {'_id': 0}).sort([('username', ASCENDING), ('transactionNum', ASCENDING), ('_id', ASCENDING)])
+    else:
+        cursor = events_collection().find({}, {'_id': 0}).sort('_id', ASCENDING)
+
+    for event in cursor:
+        grouped[event.pop('type')].append(event)
+
+    return json.dumps(grouped)
+
+def get_split_logs():
     json_data = "{ \"userCommand\": " + UserCommandType.objects.exclude("id").to_json()
     json_data += ",\"quoteServer\" : " + QuoteServerType.objects.exclude("id").to_json()
     json_data += ",\"accountTransaction\" : " + AccountTransactionType.objects.exclude("id").to_json()
@@ -0,0 +1,92 @@
+''' Online migration of accounts from the list layout to the symbol keyed map layout.
+
+Set ACCOUNT_LAYOUT=map on every worker first; workers convert any account they touch
+that has not been migrated yet, so commands keep running during the migration.
+Then run from worker/src with the MONGODB_* variables set:
+
+    python3 -m database.migrate_accounts --batch-size 500 --pause 0.05
+
+Accounts are read in _id order a batch at a time and converted with one unordered
+bulk write per batch. Each conversion is guarded on the account's arrays being
+unchanged since it was read, so an account updated in between is skipped and
+picked up again by the next pass.
+'''
+
+from argparse import ArgumentParser
+import time
+import sys
+from pymongo import UpdateOne
+from .accounts import Accounts
+from .account_repository import MAP_LAYOUT, migration_update
+
+parser = ArgumentParser(
+    description='Convert accounts to the symbol keyed map layout'
+)
+parser.add_argument('--batch-size',
+    dest='batch_size', type=int, default=500,
+    help='Accounts converted per bulk write'
+)
+parser.add_argument('--pause',
+    dest='pause', type=float, default=0.0,
+    help='Seconds to sleep between batches to limit the load on Mongo'
+)
+parser.add_argument('--max-passes',
+    dest='max_passes', type=int, default=5,
+    help='Passes over the remaining accounts before giving up on ones that keep changing'
+)
+parser.add_argument('--dry-run',
+    action='store_true', dest='dry_run', default=False,
+    help='Count the accounts that would be converted without writing'
+)
+
+def convert_batch(collection, documents) -> int:
+    requests = [UpdateOne(*migration_update(document)) for document in documents]
+    result = collection.bulk_write(requests, ordered=False)
+    return result.modified_count
+
+def migrate_pass(collection, args) -> tuple:
+    ''' One pass over the unconverted accounts. Returns (accounts seen, accounts converted). '''
+    seen = 0
+    converted = 0
+    last_id = None
+    while True:
+        query = {'layout': {'$ne': MAP_LAYOUT}}
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+        batch = list(collection.find(query).sort('_id', 1).limit(args.batch_size))
+        if not batch:
+            break
+
+        seen += len(batch)
+        if not args.dry_run:
+            converted += convert_batch(collection, batch)
+        last_id = batch[-1]['_id']
+
+        print(f"\tSeen: {seen:>10} | Converted: {converted:>10} |")
+        sys.stdout.flush()
+        if args.pause > 0:
+            time.sleep(args.pause)
+
+    return seen, converted
+
+def main():
+    args = parser.parse_args()
+    collection = Accounts._get_collection()
+
+    start = time.time()
+    total = 0
+    for n in range(args.max_passes):
+        print(f"Pass {n+1}")
+        seen, converted = migrate_pass(collection, args)
+        total += converted
+        if args.dry_run:
+            print(f"{seen} accounts would be converted")
+            return
+        if seen == converted:
+            break
+
+    remaining = collection.count_documents({'layout': {'$ne': MAP_LAYOUT}})
+    print(f"Converted {total} accounts in {time.time()-start:.1f}s, {remaining} remaining")
+
+if __name__ == "__main__":
+    main()
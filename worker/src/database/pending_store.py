@@ -0,0 +1,71 @@
+import os
+import json
+
+# Seconds a worker's pending state is kept after its last change.
+PENDING_TTL = int(os.environ.get('PENDING_TTL', 86400))
+
+
+class PendingStore:
+    '''
+    Persists the pending state that only lives in worker memory so a restarted worker
+    (or one taking over another worker's users) can replay it instead of leaking the
+    reserved funds and shares. Each worker's state is one Redis hash with a TTL:
+
+    pending:<route_key> = {
+        'buy|user1': '{"stock": "ABC", "num_stocks": 2, ..., "deadline": 1612345678.9}',
+        'sell_trigger|user1|ABC': '{"sell_amount": 5}',
+        'auto_buy|user2|XYZ': '{"transactionNum": 42}', ... }
+    '''
+    BUY = 'buy'
+    SELL = 'sell'
+    SELL_TRIGGER = 'sell_trigger'
+    AUTO_BUY = 'auto_buy'
+    AUTO_SELL = 'auto_sell'
+
+    def __init__(self, redis_cache, route_key):
+        self.redis_cache = redis_cache
+        self.route_key = route_key
+
+    @staticmethod
+    def _hash_key(route_key) -> str:
+        return f"pending:{route_key}"
+
+    @staticmethod
+    def _field(kind, user_id, stock_symbol=None) -> str:
+        if stock_symbol is None:
+            return f"{kind}|{user_id}"
+        return f"{kind}|{user_id}|{stock_symbol}"
+
+    def put(self, kind, user_id, value: dict, stock_symbol=None):
+        key = self._hash_key(self.route_key)
+        pipe = self.redis_cache.pipeline(transaction=False)
+        pipe.hset(key, self._field(kind, user_id, stock_symbol), json.dumps(value))
+        pipe.expire(key, PENDING_TTL)
+        pipe.execute()
+
+    def remove(self, kind, user_id, stock_symbol=None):
+        self.redis_cache.hdel(self._hash_key(self.route_key), self._field(kind, user_id, stock_symbol))
+
+    def load(self, route_key=None) -> list:
+        '''
+        Returns all pending entries of a worker (this worker by default) as a list of
+        tuples (kind, user_id, stock_symbol or None, value).
+        '''
+        entries = []
+        for field, value in self.redis_cache.hgetall(self._hash_key(route_key or self.route_key)).items():
+            tokens = field.decode('utf-8').split('|')
+            stock_symbol = tokens[2] if len(tokens) > 2 else None
+            entries.append((tokens[0], tokens[1], stock_symbol, json.loads(value)))
+        return entries
+
+    def take_over(self, route_key) -> list:
+        ''' Moves another worker's pending entries into this worker's hash and returns them. '''
+        entries = self.load(route_key)
+        if entries:
+            pipe = self.redis_cache.pipeline(transaction=True)
+            for kind, user_id, stock_symbol, value in entries:
+                pipe.hset(self._hash_key(self.route_key), self._field(kind, user_id, stock_symbol), json.dumps(value))
+            pipe.delete(self._hash_key(route_key))
+            pipe.expire(self._hash_key(self.route_key), PENDING_TTL)
+            pipe.execute()
+        return entries
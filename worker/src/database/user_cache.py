@@ -1,11 +1,116 @@
+import os
+import time
+import threading
 import redis
+from collections import OrderedDict
+from legacy import quote_cache
 
 user_set = 'user_ids'
 
+# Users this worker already knows exist. Users are always routed to the same
+# worker so this avoids a Redis round trip for almost every command.
+_known_users = set()
+
+# Users recently found to not exist: user_id -> time the entry expires, oldest first.
+# Expired entries are pruned on insert and at most NEGATIVE_MAX are kept, so a
+# workload full of unknown user ids can't grow it without bound.
+NEGATIVE_TTL = float(os.environ.get('USER_NEGATIVE_TTL', 5.0)) # seconds
+NEGATIVE_MAX = int(os.environ.get('USER_NEGATIVE_MAX', 100000))
+_missing_users = OrderedDict()
+_missing_lock = threading.Lock()
+
+# Checks the user set and reads the cached quote for a stock in one round trip.
+# KEYS[1] = user set, KEYS[2] = stock symbol, ARGV[1] = user id
+_USER_QUOTE_LUA = """
+return {redis.call('SISMEMBER', KEYS[1], ARGV[1]), redis.call('GET', KEYS[2])}
+"""
+_user_quote_script = None
+
 
 def add_user(user_id: str, redis_cache):
     redis_cache.sadd(user_set, user_id)
+    _known_users.add(user_id)
+    with _missing_lock:
+        _missing_users.pop(user_id, None)
+
+
+def add_users(user_ids, redis_cache, batch_size=1000):
+    ''' Bulk adds users to the cache using pipelined SADDs. Returns the number of users added. '''
+    count = 0
+    batch = []
+    pipe = redis_cache.pipeline(transaction=False)
+    for user_id in user_ids:
+        batch.append(user_id)
+        if len(batch) >= batch_size:
+            pipe.sadd(user_set, *batch)
+            pipe.execute()
+            _known_users.update(batch)
+            count += len(batch)
+            batch = []
+
+    if batch:
+        pipe.sadd(user_set, *batch)
+        pipe.execute()
+        _known_users.update(batch)
+        count += len(batch)
+
+    return count
+
+
+def mark_missing(user_id: str):
+    ''' Caches a failed lookup for NEGATIVE_TTL seconds. '''
+    now = time.time()
+    with _missing_lock:
+        _missing_users[user_id] = now + NEGATIVE_TTL
+        _missing_users.move_to_end(user_id)
+        # Every entry has the same TTL, so the oldest expire first.
+        while _missing_users and (len(_missing_users) > NEGATIVE_MAX or next(iter(_missing_users.values())) < now):
+            _missing_users.popitem(last=False)
+
+
+def is_missing(user_id: str) -> bool:
+    expires = _missing_users.get(user_id)
+    if expires is None:
+        return False
+    if expires < time.time():
+        with _missing_lock:
+            _missing_users.pop(user_id, None)
+        return False
+    return True
 
 
 def user_exists(user_id: str, redis_cache) -> bool:
-    return redis_cache.sismember(user_set, user_id)
+    if user_id in _known_users:
+        return True
+    if is_missing(user_id):
+        return False
+
+    if redis_cache.sismember(user_set, user_id):
+        _known_users.add(user_id)
+        return True
+    return False
+
+
+def user_exists_with_quote(user_id: str, stock_symbol: str, redis_cache):
+    '''
+    Returns a tuple (user in cache, cached stock price or None) using a single
+    round trip to Redis.
+    '''
+    global _user_quote_script
+
+    if user_id in _known_users:
+        return True, quote_cache.get(stock_symbol, redis_cache)
+    if is_missing(user_id):
+        return False, None
+
+    if _user_quote_script is None:
+        _user_quote_script = redis_cache.register_script(_USER_QUOTE_LUA)
+
+    is_member, stock_price = _user_quote_script(keys=[user_set, stock_symbol], args=[user_id])
+    if is_member:
+        _known_users.add(user_id)
+
+    local_price = quote_cache.local_quotes.get(stock_symbol)
+    if local_price is not None:
+        return bool(is_member), local_price
+    return bool(is_member), (float(stock_price) if stock_price else None)
@@ -0,0 +1,91 @@
+''' Write concern policy for each collection the worker writes to.
+
+Debug and system events are not worth a round trip, so they are unacknowledged
+by default. Command, quote and error logs are acknowledged, and the writes that
+move money are journaled. Policies are overridden with WRITE_CONCERNS, ex.
+
+    WRITE_CONCERNS="debugEvent:w=1;accounts:w=majority,j=true"
+'''
+
+import os
+from pymongo import WriteConcern
+
+DEFAULT_POLICIES = {
+    'debugEvent': 'w=0',
+    'systemEvent': 'w=0',
+    'errorEvent': 'w=1',
+    'userCommand': 'w=1',
+    'quoteServer': 'w=1',
+    'accountTransaction': 'w=1,j=true',
+    'accounts': 'w=1,j=true'
+}
+
+# The account handlers check the number of documents updated, which needs an acknowledged write.
+ACKNOWLEDGED_ONLY = ('accounts',)
+
+def parse_policy(spec: str) -> dict:
+    ''' Parses "w=1,j=true,wtimeout=500" into WriteConcern keyword arguments. '''
+    policy = {}
+    for option in spec.split(','):
+        option = option.strip()
+        if not option:
+            continue
+        key, _, value = option.partition('=')
+        key = key.strip()
+        value = value.strip()
+        if key == 'w':
+            policy['w'] = int(value) if value.isdigit() else value
+        elif key == 'j':
+            policy['j'] = value.lower() in ('1', 'true', 'yes')
+        elif key == 'wtimeout':
+            policy['wtimeout'] = int(value)
+        else:
+            raise ValueError(f"Unknown write concern option '{key}' in '{spec}'")
+
+    if policy.get('w') == 0 and policy.get('j'):
+        raise ValueError(f"An unacknowledged write (w=0) can't be journaled: '{spec}'")
+    return policy
+
+def load_policies(overrides: str = None) -> dict:
+    policies = {name: parse_policy(spec) for name, spec in DEFAULT_POLICIES.items()}
+    for entry in (overrides or '').split(';'):
+        if not entry.strip():
+            continue
+        name, _, spec = entry.partition(':')
+        name = name.strip()
+        if name not in policies:
+            raise ValueError(f"Unknown collection '{name}' in WRITE_CONCERNS. Expected one of {list(policies)}")
+        policies[name] = parse_policy(spec)
+
+    for name in ACKNOWLEDGED_ONLY:
+        if policies[name].get('w') == 0:
+            raise ValueError(f"The {name} write concern has to be acknowledged")
+    return policies
+
+POLICIES = load_policies(os.environ.get('WRITE_CONCERNS'))
+
+def write_concern(name: str) -> dict:
+    ''' The policy as keyword arguments, ex. for mongoengine's save(write_concern=...). '''
+    return POLICIES[name]
+
+def strongest(names) -> dict:
+    ''' The strictest of the policies, used when a single write holds several log types. '''
+    w = 0
+    policy = {}
+    for name in names:
+        current = POLICIES[name]
+        current_w = current.get('w', 1)
+        if current_w == 'majority' or (w != 'majority' and isinstance(current_w, int) and current_w > w):
+            w = current_w
+        if current.get('j'):
+            policy['j'] = True
+        if 'wtimeout' in current:
+            policy['wtimeout'] = max(policy.get('wtimeout', 0), current['wtimeout'])
+    policy['w'] = w
+    return policy
+
+def with_write_concern(collection, policy):
+    ''' The pymongo collection using the policy (a policy name or keyword arguments). '''
+    if isinstance(policy, str):
+        policy = POLICIES[policy]
+    return collection.with_options(write_concern=WriteConcern(**policy))
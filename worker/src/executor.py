@@ -0,0 +1,142 @@
+import sys
+import time
+import threading
+import zlib
+from legacy.parser import command_parse
+from priority import PriorityLaneQueue, LatencyStats, lane_of, ingress_time, sequence, sequence_base, is_fence, INTERACTIVE, BULK
+from credits import AppliedWatermark
+
+
+class Lane(threading.Thread):
+    '''
+    Executes the commands for a subset of users one at a time, in the order they were received.
+    Every lane has its own CMDHandler so uncommitted buys/sells and pending sell triggers
+    are partitioned by lane (a user always maps to the same lane).
+    '''
+
+    def __init__(self, index, command_handler, max_depth=0, latency=None, watermark=None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.index = index
+        self.command_handler = command_handler
+        # Interactive and bulk commands are queued separately and taken by weighted round robin.
+        # Full lanes block the dispatcher so back pressure reaches the consumer.
+        self.queue = PriorityLaneQueue(maxsize=max_depth)
+        self.latency = latency
+        self.watermark = watermark
+
+        # Stats
+        self.processed = 0
+        self.service_time = 0.0 # Total seconds spent executing commands.
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+
+            start = time.time()
+            self.command_handler.handle_command(item[0], item[1], item[2])
+            end = time.time()
+            self.service_time += end - start
+            self.processed += 1
+            if self.latency is not None and item[4] is not None:
+                self.latency.record(item[3], end - item[4])
+            if self.watermark is not None:
+                self.watermark.applied(item[5])
+
+            self.queue.task_done()
+
+
+class LaneExecutor:
+    '''
+    Shards users over a number of lanes so that commands for different users run
+    concurrently while each user's commands still run serially.
+    '''
+    _PRINT_PERIOD = 10.0 # Seconds
+
+    def __init__(self, command_handlers, max_lane_depth=1000):
+        self.latency = LatencyStats()
+        self.watermark = AppliedWatermark()
+        self.lanes = [Lane(i, handler, max_lane_depth, self.latency, self.watermark) for i, handler in enumerate(command_handlers)]
+        self._NUM_LANES = len(self.lanes)
+        self._print_status_timer = None
+        self.processed_inline = 0 # Fences, applied by the dispatcher itself.
+
+    def start(self):
+        for lane in self.lanes:
+            lane.start()
+        self._schedule_print_status()
+
+    def lane_for(self, user_id: str) -> Lane:
+        return self.lanes[zlib.crc32(user_id.encode('utf-8')) % self._NUM_LANES]
+
+    def submit(self, command: str, properties=None):
+        self.watermark.received(sequence(properties), sequence_base(properties))
+        if is_fence(properties):
+            self.processed_inline += 1
+            self.watermark.applied(sequence(properties))
+            return
+
+        result = command_parse(command)
+        transactionNum, cmd, params = result[0], result[1], result[2]
+        priority_lane = lane_of(properties)
+        item = (transactionNum, cmd, params, priority_lane, ingress_time(properties), sequence(properties))
+
+        if cmd == "DUMPLOG":
+            # The manager only sends it once every command before it has been applied
+            # (see manager/src/barrier.py), so the other lanes don't have to be drained.
+            self.lanes[0].queue.put(item, priority_lane)
+            return
+
+        user_id = params[0] if len(params) > 0 and isinstance(params[0], str) else ''
+        self.lane_for(user_id).queue.put(item, priority_lane)
+
+    def drain(self):
+        ''' Blocks until every lane has finished all of its queued commands. '''
+        for lane in self.lanes:
+            lane.queue.join()
+
+    def completed(self) -> int:
+        ''' Number of commands finished so far. '''
+        return sum(lane.processed for lane in self.lanes) + self.processed_inline
+
+    def stop(self):
+        if self._print_status_timer is not None:
+            self._print_status_timer.cancel()
+        for lane in self.lanes:
+            lane.queue.put(None)
+        for lane in self.lanes:
+            lane.join()
+
+    def stats(self) -> list:
+        ''' Returns the queue depth, number of processed commands and average service time (ms) of each lane. '''
+        return [
+            {
+                'lane': lane.index,
+                'depth': lane.queue.qsize(),
+                'interactive_depth': lane.queue.lane_length(INTERACTIVE),
+                'processed': lane.processed,
+                'avg_service_ms': (lane.service_time / lane.processed * 1000) if lane.processed else 0.0
+            }
+            for lane in self.lanes
+        ]
+
+    def print_status(self):
+        for lane in self.stats():
+            print("Lane: {:>3} | Depth: {:>8} | Interactive: {:>6} | Processed: {:>10} | Avg service (ms): {:>8.2f} |".format(
+                lane['lane'], lane['depth'], lane['interactive_depth'], lane['processed'], lane['avg_service_ms'])
+            )
+        for priority_lane in (INTERACTIVE, BULK):
+            p50, p99 = self.latency.percentiles(priority_lane)
+            print("Priority: {:>12} | Commands: {:>10} | Latency p50 (ms): {:>10.1f} | p99 (ms): {:>10.1f} |".format(
+                priority_lane, self.latency.counts[priority_lane], p50, p99)
+            )
+        sys.stdout.flush()
+        self._schedule_print_status()
+
+    def _schedule_print_status(self):
+        self._print_status_timer = threading.Timer(self._PRINT_PERIOD, self.print_status)
+        self._print_status_timer.setDaemon(True)
+        self._print_status_timer.start()
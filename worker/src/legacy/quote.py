@@ -2,14 +2,18 @@ import sys
 import os
 import socket
 import time
+import threading
 from random import randrange
 from . import parser
 from . import quote_cache
 from database.logs import QuoteServerType, SystemEventType
 
-QUOTE_ADDRESS = "192.168.4.2"
+# The legacy quote server, or the quote gateway (quote_gateway/) when QUOTE_SERVER_HOST points at it.
+QUOTE_ADDRESS = os.environ.get('QUOTE_SERVER_HOST', "192.168.4.2")
 PORT = int(os.environ['QUOTE_SERVER_PORT'])
 s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+# The socket is shared by every lane and the polling thread of the worker.
+_socket_lock = threading.RLock()
 
 def quote_server_connect():
     global s
@@ -19,44 +23,75 @@ def quote_server_connect():
     s.settimeout(None)
 
 
-def get_quote(uid: str, stock_name: str, transactionNum: int, userCommand: str, redis_cache) -> float:
+def get_quote(uid: str, stock_name: str, transactionNum: int, userCommand: str, redis_cache, cached_quote=quote_cache.UNCHECKED) -> float:
+    ''' cached_quote can be given when the cache has already been read (None if it was a miss). '''
     global s
 
-    result = quote_cache.get(stock_name, redis_cache)
+    if cached_quote is quote_cache.UNCHECKED:
+        result = quote_cache.get(stock_name, redis_cache)
+    else:
+        result = cached_quote
+
+    quote_cache.demand.record(stock_name, transactionNum, userCommand, uid, hit=result is not None)
 
     if result is None:
-        command = f'{stock_name}, {uid}\n'
+        if quote_cache.QUOTE_PREFETCH:
+            redis_cache.hincrby(quote_cache.PREFETCH_STATS, 'misses', 1)
+        with _socket_lock:
+            return _request_quote(uid, stock_name, transactionNum, userCommand, redis_cache)
 
-        try:
-            s.send(command.encode('utf-8'))
-            data = s.recv(1024)
-            if len(data) < 2 :
-                quote_server_connect()
-                return get_quote(uid, stock_name, transactionNum, userCommand, redis_cache)
+    prefetched = quote_cache.claim_prefetched(stock_name, result, redis_cache) if quote_cache.QUOTE_PREFETCH else None
+    if prefetched is not None:
+        # The manager fetched this quote for the queued commands, the first one to use it logs the hit.
+        QuoteServerType().log(transactionNum=transactionNum, price=result, stockSymbol=stock_name, username=uid, quoteServerTime=prefetched[0], cryptokey=prefetched[1])
+        return result
+
+    # add user funds after confirming
+    # System Event log since received from cache
+    #print("Quote used from cache!!")
+    SystemEventType().log(transactionNum=transactionNum, command=userCommand, username=uid, stockSymbol=stock_name)
 
-            response = parser.quote_result_parse(data.decode('utf-8'))
+    return result
 
-            quote_cache.add(stock_name, response[0], response[3], redis_cache)
 
-            QuoteServerType().log(transactionNum=transactionNum, price=response[0], stockSymbol=stock_name, username=uid, quoteServerTime=response[3], cryptokey=response[4])
+def fetch_quote(uid: str, stock_name: str, transactionNum: int, userCommand: str, redis_cache) -> float:
+    ''' Gets a quote from the quote server without checking the cache. '''
+    with _socket_lock:
+        return _request_quote(uid, stock_name, transactionNum, userCommand, redis_cache)
 
-            return response[0] # Only returns the stock price
 
-        except socket.error:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            try:
-                quote_server_connect()
-            except socket.timeout:
-                print("Socket connection timeout")
-                time.sleep(0.1) # Just to reduce spam error messages
+def _request_quote(uid: str, stock_name: str, transactionNum: int, userCommand: str, redis_cache) -> float:
+    ''' Gets a quote from the quote server. Must hold _socket_lock. '''
+    global s
+
+    command = f'{stock_name}, {uid}\n'
 
+    try:
+        s.send(command.encode('utf-8'))
+        data = s.recv(1024)
+        if len(data) < 2 :
+            quote_server_connect()
             return get_quote(uid, stock_name, transactionNum, userCommand, redis_cache)
 
+        response = parser.quote_result_parse(data.decode('utf-8'))
 
+        quote_cache.add(stock_name, response[0], response[3], redis_cache, cryptokey=response[4].strip())
 
-    # add user funds after confirming
-    # System Event log since received from cache
-    #print("Quote used from cache!!")
-    SystemEventType().log(transactionNum=transactionNum, command=userCommand, username=uid, stockSymbol=stock_name)
+        if len(response) > 5 and response[5].strip() == 'C':
+            # The gateway answered from its cache (the quote server hit was logged by whoever caused it).
+            SystemEventType().log(transactionNum=transactionNum, command=userCommand, username=uid, stockSymbol=stock_name)
+        else:
+            QuoteServerType().log(transactionNum=transactionNum, price=response[0], stockSymbol=stock_name, username=uid, quoteServerTime=response[3], cryptokey=response[4].strip())
+
+        return response[0] # Only returns the stock price
+
+    except socket.error:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            quote_server_connect()
+        except socket.timeout:
+            print("Socket connection timeout")
+            time.sleep(0.1) # Just to reduce spam error messages
+
+        return get_quote(uid, stock_name, transactionNum, userCommand, redis_cache)
 
-    return result
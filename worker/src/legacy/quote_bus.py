@@ -0,0 +1,53 @@
+import sys
+import time
+import threading
+import redis
+from . import quote_cache
+
+
+class QuoteSubscriber(threading.Thread):
+    '''
+    Listens on the quote channel for the quotes other workers got from the quote
+    server. Each one is added to the local cache and passed to the quote listeners
+    (the polling thread's triggers), so a symbol is only fetched once per validity
+    window no matter how many workers need it.
+    '''
+
+    def __init__(self, redis_cache):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.redis_cache = redis_cache
+
+        # Stats
+        self.received = 0
+        self.ingested = 0
+
+    def run(self):
+        while True:
+            try:
+                pubsub = self.redis_cache.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(quote_cache.CHANNEL)
+                for message in pubsub.listen():
+                    self.ingest(message['data'])
+            except redis.ConnectionError as e:
+                print(f"Error: Quote bus connection lost. {e}")
+                sys.stdout.flush()
+                time.sleep(1)
+
+    def ingest(self, data):
+        self.received += 1
+        try:
+            stock_symbol, stock_price, quote_server_time, cryptokey, server = quote_cache.decode(data)
+        except (ValueError, IndexError):
+            print(f"Error: Invalid quote on the quote bus: {data}")
+            return
+
+        # This worker's own quotes were cached when they were received.
+        if server == quote_cache.SERVER_NAME:
+            return
+
+        self.ingested += 1
+        if server == quote_cache.PREFETCH_SERVER:
+            quote_cache.prefetched[stock_symbol] = (stock_price, quote_server_time, cryptokey)
+        quote_cache.local_quotes.put(stock_symbol, stock_price)
+        quote_cache.notify(stock_symbol, stock_price)
@@ -1,13 +1,187 @@
+import os
+import math
+import time
+import threading
 import redis
 from datetime import timedelta
 
+# Passed to quote.get_quote when the caller has not already checked the cache.
+UNCHECKED = object()
 
-def add(stock_symbol, stock_price, quote_server_time, redis_cache):
-    redis_cache.set(stock_symbol, stock_price)
-    redis_cache.expire(stock_symbol, (int(quote_server_time)+1000))
+# Quotes from the quote server are published on this channel so every worker
+# gets them (see quote_bus.py). Message: "symbol,price,quote server time,cryptokey,server".
+CHANNEL = 'quotes'
+QUOTE_BUS = os.environ.get('QUOTE_BUS', 'true').lower() in ('1', 'true', 'yes')
+SERVER_NAME = os.environ.get('SERVER_NAME', '')
+
+# The manager prefetches quotes for queued commands (manager/src/quote_prefetch.py) and
+# publishes them as this server. It sets a marker for each fetched quote; the worker
+# that deletes it logs the quote server hit. Prefetch hits/misses are counted in STATS_KEY.
+PREFETCH_SERVER = 'manager'
+PREFETCH_MARKER = 'prefetched:'
+PREFETCH_STATS = 'prefetch:stats'
+# The prefetched quotes' details arrive on the quote bus, the manager doesn't prefetch without it.
+QUOTE_PREFETCH = QUOTE_BUS and os.environ.get('QUOTE_PREFETCH', 'true').lower() in ('1', 'true', 'yes')
+
+# Quotes are valid for 60 seconds.
+QUOTE_TTL = int(os.environ.get('QUOTE_TTL', 60)) # seconds
+LOCAL_TTL = float(os.environ.get('QUOTE_LOCAL_TTL', QUOTE_TTL)) # seconds
+
+
+class LocalQuoteCache:
+    '''
+    In-process tier in front of the Redis cache, filled by this worker's quote
+    server requests and by the quotes other workers publish. Entries expire
+    LOCAL_TTL seconds after they were received.
+    '''
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._quotes = {} # symbol -> (price, expiry time)
+
+    def __len__(self):
+        return len(self._quotes)
+
+    def put(self, stock_symbol, stock_price):
+        self._quotes[stock_symbol] = (stock_price, time.time() + self.ttl)
+
+    def expiring(self, within) -> list:
+        ''' Returns (symbol, expiry time) for the quotes that are still valid but expire in the next within seconds. '''
+        now = time.time()
+        return [(symbol, entry[1]) for symbol, entry in list(self._quotes.items()) if now < entry[1] <= now + within]
+
+    def get(self, stock_symbol):
+        entry = self._quotes.get(stock_symbol)
+        if entry is None:
+            return None
+        if entry[1] < time.time():
+            self._quotes.pop(stock_symbol, None)
+            return None
+        return entry[0]
+
+
+local_quotes = LocalQuoteCache(LOCAL_TTL)
+
+
+class QuoteDemand:
+    '''
+    Tracks how often each symbol is requested (an exponentially decayed rate) and
+    the last request for it, which the refresh-ahead thread uses to log its fetches.
+    Also counts cache hits/misses and how many refreshed quotes were used.
+    '''
+
+    def __init__(self, half_life):
+        self.tau = half_life / math.log(2)
+        self._lock = threading.Lock()
+        self._symbols = {} # symbol -> [decayed request count, last request time, (transactionNum, command, user_id)]
+        self._refreshed = set() # Refreshed ahead of expiry and not requested since.
+
+        # Stats
+        self.hits = 0
+        self.misses = 0
+        self.refresh_hits = 0
+
+    def record(self, stock_symbol, transactionNum, command, user_id, hit):
+        now = time.time()
+        with self._lock:
+            entry = self._symbols.get(stock_symbol)
+            if entry is None:
+                entry = [0.0, now, None]
+                self._symbols[stock_symbol] = entry
+            entry[0] = entry[0] * math.exp(-(now - entry[1]) / self.tau) + 1.0
+            entry[1] = now
+            entry[2] = (transactionNum, command, user_id)
+
+            if hit:
+                self.hits += 1
+                if stock_symbol in self._refreshed:
+                    self._refreshed.discard(stock_symbol)
+                    self.refresh_hits += 1
+            else:
+                self.misses += 1
+
+    def rate(self, stock_symbol) -> float:
+        ''' Requests per second, averaged over roughly the last half life. '''
+        entry = self._symbols.get(stock_symbol)
+        if entry is None:
+            return 0.0
+        return entry[0] * math.exp(-(time.time() - entry[1]) / self.tau) / self.tau
+
+    def last_request(self, stock_symbol):
+        ''' (transactionNum, command, user_id) of the last request, or None. '''
+        entry = self._symbols.get(stock_symbol)
+        return entry[2] if entry is not None else None
+
+    def mark_refreshed(self, stock_symbol):
+        with self._lock:
+            self._refreshed.add(stock_symbol)
+
+    def prune(self, min_rate):
+        ''' Forgets symbols whose rate dropped below min_rate. '''
+        with self._lock:
+            for stock_symbol in [s for s in self._symbols if self.rate(s) < min_rate]:
+                del self._symbols[stock_symbol]
+                self._refreshed.discard(stock_symbol)
+
+
+demand = QuoteDemand(half_life=float(os.environ.get('QUOTE_DEMAND_HALF_LIFE', 60)))
+
+# symbol -> (price, quote server time, cryptokey) of quotes the manager prefetched, until one is used here.
+prefetched = {}
+
+def claim_prefetched(stock_symbol, stock_price, redis_cache):
+    ''' Returns (quote server time, cryptokey) if stock_price is a prefetched quote no other command has used yet. '''
+    entry = prefetched.pop(stock_symbol, None)
+    if entry is None or entry[0] != stock_price:
+        return None
+    if not redis_cache.delete(PREFETCH_MARKER + stock_symbol):
+        return None # Another worker used it first.
+    redis_cache.hincrby(PREFETCH_STATS, 'hits', 1)
+    return entry[1], entry[2]
+
+# Called with (stock_symbol, price) for every new quote, local or from the bus.
+_listeners = []
+
+def add_listener(listener):
+    _listeners.append(listener)
+
+def notify(stock_symbol, stock_price):
+    for listener in _listeners:
+        listener(stock_symbol, stock_price)
+
+
+def encode(stock_symbol, stock_price, quote_server_time, cryptokey) -> str:
+    return f"{stock_symbol},{stock_price},{quote_server_time},{cryptokey},{SERVER_NAME}"
+
+def decode(message) -> list:
+    ''' Returns [symbol, price, quote server time, cryptokey, server]. '''
+    if isinstance(message, bytes):
+        message = message.decode('utf-8')
+    tokens = message.split(',')
+    tokens[1] = float(tokens[1])
+    return tokens
+
+
+def add(stock_symbol, stock_price, quote_server_time, redis_cache, cryptokey=''):
+    if stock_price is None:
+        return # Unparsable quote, don't cache it.
+
+    local_quotes.put(stock_symbol, stock_price)
+
+    pipe = redis_cache.pipeline(transaction=False)
+    pipe.set(stock_symbol, stock_price, ex=QUOTE_TTL)
+    if QUOTE_BUS:
+        pipe.publish(CHANNEL, encode(stock_symbol, stock_price, quote_server_time, cryptokey))
+    pipe.execute()
+
+    notify(stock_symbol, stock_price)
 
 
 def get(stock_symbol, redis_cache):
+    stock_price = local_quotes.get(stock_symbol)
+    if stock_price is not None:
+        return stock_price
+
     stock_price = redis_cache.get(stock_symbol)
     if stock_price:
         stock_price = float(stock_price)
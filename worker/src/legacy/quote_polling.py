@@ -1,9 +1,9 @@
 import threading
 import time
-from database.accounts import Accounts, Stocks
+from database.account_repository import account_repository
 from database.logs import DebugType, AccountTransactionType, ErrorEventType
-from legacy import quote
-from mongoengine import DoesNotExist
+from database.pending_store import PendingStore
+from legacy import quote, quote_cache
 import decimal
 
 class UserPollingStocks:
@@ -12,8 +12,9 @@ class UserPollingStocks:
     transactions for each of those stocks. This info will eventually be in a cache.
     '''
 
-    def __init__(self):
+    def __init__(self, pending_store=None):
         self._lock = threading.Lock()
+        self.pending_store = pending_store # Persists the auto transactions being polled (optional).
         self.user_polling_stocks = {}
         ''' user_polling_stocks format
         { 'stock_symbol' : { 
@@ -26,7 +27,8 @@ class UserPollingStocks:
 
     def get_stocks(self):
         ''' Returns a list of all keys. '''
-        return list(self.user_polling_stocks)
+        with self._lock:
+            return list(self.user_polling_stocks)
 
     def get_last_info(self, stock_symbol) -> list:
         """
@@ -61,10 +63,15 @@ class UserPollingStocks:
             if stock_symbol in self.user_polling_stocks:
                 user_transaction_num = self.user_polling_stocks[stock_symbol]['auto_buy'].pop(user_id, None)
                 self.remove_if_empty(stock_symbol)
+                if user_transaction_num is not None and self.pending_store is not None:
+                    self.pending_store.remove(PendingStore.AUTO_BUY, user_id, stock_symbol)
                 return user_transaction_num
             else: return None
 
-    def add_user_autobuy(self, user_id, stock_symbol, transactionNum, command):
+    def add_user_autobuy(self, user_id, stock_symbol, transactionNum, command, persist=True):
+        if persist and self.pending_store is not None:
+            self.pending_store.put(PendingStore.AUTO_BUY, user_id, {'transactionNum': transactionNum, 'command': command}, stock_symbol)
+
         with self._lock:
             # Create dictionary for this stock if it's not made.
             auto_transactions = self.user_polling_stocks.setdefault(stock_symbol, {'auto_buy': {}, 'auto_sell': {}})
@@ -77,7 +84,8 @@ class UserPollingStocks:
 
     def get_autobuy_users(self, stock_symbol):
         ''' Returns a list of all users with an autobuy setup. '''
-        return list(self.user_polling_stocks[stock_symbol]['auto_buy'])
+        with self._lock:
+            return list(self.user_polling_stocks.get(stock_symbol, {}).get('auto_buy', {}))
 
     def get_user_autosell(self, user_id, stock_symbol):
         ''' Removes the user from the dictionary and returns the user's transaction number (None if does not exist). '''
@@ -85,10 +93,15 @@ class UserPollingStocks:
             if stock_symbol in self.user_polling_stocks:
                 user_transaction_num = self.user_polling_stocks[stock_symbol]['auto_sell'].pop(user_id, None)
                 self.remove_if_empty(stock_symbol)
+                if user_transaction_num is not None and self.pending_store is not None:
+                    self.pending_store.remove(PendingStore.AUTO_SELL, user_id, stock_symbol)
                 return user_transaction_num
             else: return None
 
-    def add_user_autosell(self, user_id, stock_symbol, transactionNum, command):
+    def add_user_autosell(self, user_id, stock_symbol, transactionNum, command, persist=True):
+        if persist and self.pending_store is not None:
+            self.pending_store.put(PendingStore.AUTO_SELL, user_id, {'transactionNum': transactionNum, 'command': command}, stock_symbol)
+
         with self._lock:
             # Create dictionary for this stock if it's not made.
             auto_transactions = self.user_polling_stocks.setdefault(stock_symbol, {'auto_buy': {}, 'auto_sell': {}})
@@ -101,12 +114,15 @@ class UserPollingStocks:
 
     def get_autosell_users(self, stock_symbol):
         """ Returns a list of all users with an autosell setup. """
-        return list(self.user_polling_stocks[stock_symbol]['auto_sell'])
+        with self._lock:
+            return list(self.user_polling_stocks.get(stock_symbol, {}).get('auto_sell', {}))
 
 
 class QuotePollingThread(threading.Thread):
     """
     Polls the stocks prices and triggers any auto sell/buy transactions when necessary.
+    Quotes received between polls (by the lanes or from other workers through the
+    quote bus) are checked against the triggers as soon as they arrive.
     """
 
     def __init__(self, quote_polling, polling_rate, response_publisher, redis_cache):
@@ -116,20 +132,44 @@ class QuotePollingThread(threading.Thread):
         self.response_publisher = response_publisher
         self.redis_cache = redis_cache
 
-    def run(self):
-        while True:
-            # Get all the stocks that have auto buy/sells.
-            stocks = self.quote_polling.get_stocks()
-
-            # For each stock call the quote update handler.
-            if len(stocks) != 0:
-                for stock in stocks:
-                    self.quote_update_handler(stock)
+        self._fresh_quotes = {} # symbol -> latest price not yet checked against the triggers
+        self._fresh_lock = threading.Lock()
+        self._wake = threading.Event()
+        quote_cache.add_listener(self.on_quote)
 
-            # Sleep for the polling rate.
-            time.sleep(self.polling_rate)
+    def on_quote(self, stock_symbol, price):
+        # Quotes requested by this thread are already being checked.
+        if threading.current_thread() is self:
+            return
+        if stock_symbol not in self.quote_polling.user_polling_stocks:
+            return
+        with self._fresh_lock:
+            self._fresh_quotes[stock_symbol] = price
+        self._wake.set()
 
-    def quote_update_handler(self, stock_symbol):
+    def run(self):
+        next_poll = 0.0
+        while True:
+            if time.time() >= next_poll:
+                # Get all the stocks that have auto buy/sells.
+                stocks = self.quote_polling.get_stocks()
+
+                # For each stock call the quote update handler.
+                if len(stocks) != 0:
+                    for stock in stocks:
+                        self.quote_update_handler(stock)
+
+                next_poll = time.time() + self.polling_rate
+
+            # Sleep for the polling rate, or until a new quote arrives.
+            self._wake.wait(timeout=max(next_poll - time.time(), 0.0))
+            self._wake.clear()
+            with self._fresh_lock:
+                fresh_quotes, self._fresh_quotes = self._fresh_quotes, {}
+            for stock, value in fresh_quotes.items():
+                self.quote_update_handler(stock, value=value)
+
+    def quote_update_handler(self, stock_symbol, value=None):
         # Get the most up-to-date command information for logging purposes.
         info = self.quote_polling.get_last_info(stock_symbol)
 
@@ -137,20 +177,18 @@ class QuotePollingThread(threading.Thread):
         if not info:
             return
 
-        # Get the current stock price.
-        value = quote.get_quote(uid=info[2], stock_name=stock_symbol, transactionNum=info[0], userCommand=info[1], redis_cache = self.redis_cache)
+        # Get the current stock price (unless it was just received).
+        if value is None:
+            value = quote.get_quote(uid=info[2], stock_name=stock_symbol, transactionNum=info[0], userCommand=info[1], redis_cache = self.redis_cache)
 
         # Get all users that have an auto buy trigger equal to or less than the quote value.
-        auto_buy_users = Accounts.objects(__raw__={"_id": {"$in": self.quote_polling.get_autobuy_users(stock_symbol)}, "auto_buy": {"$elemMatch": {"symbol": stock_symbol, "trigger": {"$lte": value}}}}).only('user_id')
-        #print(f"AUTO_BUY_USERS: {auto_buy_users.to_json()}")
+        auto_buy_users = account_repository.get_triggered_users(account_repository.AUTO_BUY, self.quote_polling.get_autobuy_users(stock_symbol), stock_symbol, value)
 
         # Get all users that have an auto sell trigger equal to or greater than the quote value.
-        auto_sell_users = Accounts.objects(__raw__={"_id": {"$in": self.quote_polling.get_autosell_users(stock_symbol)}, "auto_sell": {"$elemMatch": {"symbol": stock_symbol, "trigger": {"$gte": value}}}}).only('user_id')
-        #print(f"AUTO_SELL_USERS: {auto_buy_users.to_json()}")
+        auto_sell_users = account_repository.get_triggered_users(account_repository.AUTO_SELL, self.quote_polling.get_autosell_users(stock_symbol), stock_symbol, value)
 
         # Perform auto buy for all the users.
-        for user in auto_buy_users:
-            user_id = user.user_id
+        for user_id in auto_buy_users:
             transactionNum = self.quote_polling.get_user_autobuy(user_id=user_id, stock_symbol=stock_symbol)
 
             if transactionNum is None:
@@ -162,8 +200,7 @@ class QuotePollingThread(threading.Thread):
                 self.auto_buy_handler(user_id=user_id, stock_symbol=stock_symbol, value=value, transactionNum=transactionNum) 
         
         # Perform auto sell for all the users.
-        for user in auto_sell_users:
-            user_id = user.user_id
+        for user_id in auto_sell_users:
             transactionNum = self.quote_polling.get_user_autosell(user_id=user_id, stock_symbol=stock_symbol)
             
             if transactionNum is None:
@@ -181,39 +218,17 @@ class QuotePollingThread(threading.Thread):
         DebugType().log(transactionNum=transactionNum, command="SET_BUY_TRIGGER", username=user_id, debugMessage=info_msg)
 
         # Get the user document
-        user_account = Accounts.objects(__raw__={'_id': user_id}).only('auto_buy', 'available', 'account', 'stocks').first()
-
-        users_auto_buy = user_account.auto_buy.get(symbol=stock_symbol)
+        users_auto_buy, users_stock = account_repository.get_auto_with_stock(account_repository.AUTO_BUY, user_id, stock_symbol)
 
-        if users_auto_buy.trigger > value:
+        if users_auto_buy is None or users_auto_buy.trigger > value:
             return
 
         reserved_amount = users_auto_buy.amount * users_auto_buy.trigger
         transaction_cost = users_auto_buy.amount * value
-        update = {
-            'pull__auto_buy__symbol': stock_symbol, # Remove the auto buy transaction from the users list of auto buys
-            'inc__available': (decimal.Decimal(reserved_amount) - decimal.Decimal(transaction_cost)), # Add the difference between the reserved amount and transaction cost to the amount available.
-            'inc__account': -decimal.Decimal(transaction_cost) # Deduct the transaction cost from the account.
-        }
-        
-        # Update the number of stocks owned.
-        try:
-            users_stock = user_account.stocks.get(symbol=stock_symbol)
-        except DoesNotExist:
-            # Create a new stock
-            new_stock = Stocks(symbol=stock_symbol, amount=users_auto_buy.amount, available=users_auto_buy.amount)      
-            update['push__stocks'] = new_stock
 
-            ret = Accounts.objects(pk=user_id).update_one(**update)
-        else:
-            # Increment the amount of stock
-            update['inc__stocks__S__amount'] = users_auto_buy.amount
-            update['inc__stocks__S__available'] = users_auto_buy.amount
-
-            ret = Accounts.objects(pk=user_id, stocks__symbol=stock_symbol).update_one(**update)
-
-        # Check the update succeeded.
-        if ret != 1:
+        # Remove the auto buy, add the stocks and add the difference between the reserved amount and
+        # transaction cost to the amount available. Check the update succeeded.
+        if not account_repository.complete_auto_buy(user_id, stock_symbol, users_auto_buy.amount, reserved_amount, transaction_cost, has_stock=users_stock is not None):
             err_msg = f"[{transactionNum}] Error: (AutoBuyHandler) Failed to update account {user_id}."
             print(err_msg)
             ErrorEventType().log(transactionNum=transactionNum, command="SET_BUY_TRIGGER", username=user_id, errorMessage=err_msg)
@@ -232,30 +247,17 @@ class QuotePollingThread(threading.Thread):
         DebugType().log(transactionNum=transactionNum, command="SET_SELL_TRIGGER", username=user_id, debugMessage=info_msg)
 
         # Get the user document
-        users_account = Accounts.objects(__raw__={'_id': user_id}).only('auto_sell', 'available', 'account', 'stocks').first()
-
-        users_auto_sell = users_account.auto_sell.get(symbol=stock_symbol)
+        users_auto_sell, users_stock = account_repository.get_auto_with_stock(account_repository.AUTO_SELL, user_id, stock_symbol)
 
-        if users_auto_sell.trigger < value:
+        if users_auto_sell is None or users_auto_sell.trigger < value:
             return
 
-        users_stock = users_account.stocks.get(symbol=stock_symbol)
         sale_profit = decimal.Decimal(value) * decimal.Decimal(users_auto_sell.amount)
-        update = {
-            'pull__auto_sell__symbol': stock_symbol, # Remove the auto sell
-            'inc__account': sale_profit,
-            'inc__available': sale_profit
-        }
-
-        if users_stock.amount == users_auto_sell.amount:
-            update['pull__stocks__symbol'] = stock_symbol # Remove the stock if there is none remaining
-            ret = Accounts.objects(pk=user_id).update_one(**update)
-        else:
-            update['inc__stocks__S__amount'] = -users_auto_sell.amount # Decrement the number of the stock
-            ret = Accounts.objects(pk=user_id, stocks__symbol=stock_symbol).update_one(**update)
 
+        # Remove the auto sell and the sold stocks (the whole stock if there is none remaining).
         # Check the update succeeded.
-        if ret != 1:
+        remove_stock = users_stock is not None and users_stock.amount == users_auto_sell.amount
+        if not account_repository.complete_auto_sell(user_id, stock_symbol, users_auto_sell.amount, sale_profit, remove_stock):
             err_msg = f"[{transactionNum}] Error: (AutoSellHandler) Failed to update account {user_id}."
             print(err_msg)
             ErrorEventType().log(transactionNum=transactionNum, command="SET_SELL_TRIGGER", username=user_id, errorMessage=err_msg)
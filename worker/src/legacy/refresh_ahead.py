@@ -0,0 +1,125 @@
+import os
+import sys
+import time
+import threading
+from . import quote, quote_cache
+
+REFRESH_AHEAD = os.environ.get('REFRESH_AHEAD', 'true').lower() in ('1', 'true', 'yes')
+WINDOW = float(os.environ.get('REFRESH_AHEAD_WINDOW', 5)) # Seconds before expiry a quote can be refreshed
+MIN_RATE = float(os.environ.get('REFRESH_AHEAD_MIN_RATE', 0.05)) # Requests per second for a symbol to be refreshed
+BUDGET = float(os.environ.get('REFRESH_AHEAD_BUDGET', 5)) # Refresh fetches per second
+
+# Held by the worker refreshing a symbol so the other workers don't refresh it too.
+LOCK_PREFIX = 'refresh:'
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1.0)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self._tokens < 1.0:
+            return False
+        self._tokens -= 1.0
+        return True
+
+
+class RefreshAheadThread(threading.Thread):
+    '''
+    Fetches new quotes shortly before the cached ones expire, so the next command
+    for the symbol doesn't wait on the quote server. Only symbols with auto buy/sell
+    triggers or enough demand are refreshed (triggers first, then by demand), at most
+    BUDGET times per second.
+    '''
+    _TICK = 0.5 # Seconds
+    _PRINT_PERIOD = 10.0 # Seconds
+
+    def __init__(self, quote_polling, redis_cache, window=WINDOW, min_rate=MIN_RATE, budget=BUDGET):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.quote_polling = quote_polling
+        self.redis_cache = redis_cache
+        self.window = window
+        self.min_rate = min_rate
+        self.bucket = TokenBucket(budget)
+
+        # Stats
+        self.refreshes = 0
+        self.over_budget = 0 # Candidates skipped because the budget was used up.
+        self.locked = 0 # Candidates another worker was already refreshing.
+        self.errors = 0
+        self._next_print = time.time() + self._PRINT_PERIOD
+
+    def run(self):
+        while True:
+            time.sleep(self._TICK)
+            try:
+                self.refresh_expiring()
+            except Exception as e:
+                self.errors += 1
+                print(f"Error: Refresh ahead failed. {e}")
+
+            if time.time() >= self._next_print:
+                quote_cache.demand.prune(self.min_rate / 100)
+                self.print_status()
+
+    def candidates(self) -> list:
+        ''' Symbols worth refreshing, in the order they should be refreshed. '''
+        candidates = []
+        for stock_symbol, expiry in quote_cache.local_quotes.expiring(self.window):
+            has_triggers = stock_symbol in self.quote_polling.user_polling_stocks
+            rate = quote_cache.demand.rate(stock_symbol)
+            if has_triggers or rate >= self.min_rate:
+                candidates.append((not has_triggers, -rate, expiry, stock_symbol))
+        candidates.sort()
+        return [candidate[3] for candidate in candidates]
+
+    def refresh_expiring(self):
+        candidates = self.candidates()
+        for i, stock_symbol in enumerate(candidates):
+            if not self.bucket.take():
+                self.over_budget += len(candidates) - i
+                return
+
+            # Logged as part of the last command that asked for this symbol.
+            info = quote_cache.demand.last_request(stock_symbol)
+            if info is None:
+                info = self.quote_polling.get_last_info(stock_symbol)
+            if not info:
+                continue
+
+            if not self.redis_cache.set(LOCK_PREFIX + stock_symbol, quote_cache.SERVER_NAME, nx=True, ex=max(int(self.window), 1)):
+                self.locked += 1
+                continue
+
+            quote.fetch_quote(uid=info[2], stock_name=stock_symbol, transactionNum=info[0], userCommand=info[1], redis_cache=self.redis_cache)
+            quote_cache.demand.mark_refreshed(stock_symbol)
+            self.refreshes += 1
+
+    def stats(self) -> dict:
+        demand = quote_cache.demand
+        lookups = demand.hits + demand.misses
+        return {
+            'refreshes': self.refreshes,
+            'refresh_hits': demand.refresh_hits,
+            'refresh_hit_rate': (demand.refresh_hits / self.refreshes) if self.refreshes else 0.0, # Refreshed quotes that were used
+            'cache_hit_rate': (demand.hits / lookups) if lookups else 0.0,
+            'misses': demand.misses,
+            'over_budget': self.over_budget,
+            'locked': self.locked,
+            'errors': self.errors
+        }
+
+    def print_status(self):
+        stats = self.stats()
+        print("Refreshes: {:>8} | Refresh hit rate: {:>6.1%} | Cache hit rate: {:>6.1%} | Misses: {:>8} | Over budget: {:>8} | Locked: {:>8} |".format(
+            stats['refreshes'], stats['refresh_hit_rate'], stats['cache_hit_rate'], stats['misses'], stats['over_budget'], stats['locked'])
+        )
+        sys.stdout.flush()
+        self._next_print = time.time() + self._PRINT_PERIOD
@@ -12,13 +12,21 @@ except:
 import signal
 import pika
 import queue
-from threading import Thread, Lock
+from threading import Thread
 import redis
 from rabbitmq.consumer import Consumer
 from rabbitmq.publisher import Publisher
-from rabbitmq.ThreadCommunication import ThreadCommunication
-from legacy.parser import command_parse
+from rabbitmq.ring_buffer import RingBuffer
 from cmd_handler import CMDHandler
+from executor import LaneExecutor
+from credits import CreditReporter
+from priority import QUEUE_ARGUMENTS
+from bootstrap import Bootstrap
+from database.pending_store import PendingStore
+from database.debug_config import debug_config
+from database import connection
+from database.accounts import Accounts
+from database.logs import EVENT_TYPES, LOG_STORE, events_collection
 
 # Handles exiting when SIGTERM (sent by ^C input) is received
 # in a gracefull way. Main loop will only exit after a completed iteration
@@ -31,50 +39,110 @@ def exit_gracefully(self, signum):
 signal.signal(signal.SIGINT, exit_gracefully)
 signal.signal(signal.SIGTERM, exit_gracefully)
 
-def queue_thread(communication):
-     rabbit_queue = Consumer(
-         communication=communication,
-         connection_param='rabbitmq',
-         exchange_name=os.environ["BACKEND_EXCHANGE"],
-         queue_name=os.environ["ROUTE_KEY"],
-         routing_key=os.environ["ROUTE_KEY"]
-     )
+def queue_thread(rabbit_queue):
      rabbit_queue.run()
 
+def replay_pending(pending, executor, quote_polling):
+    for kind, user_id, stock_symbol, value in pending:
+        if kind == PendingStore.AUTO_BUY:
+            quote_polling.add_user_autobuy(user_id, stock_symbol, value['transactionNum'], value['command'], persist=False)
+        elif kind == PendingStore.AUTO_SELL:
+            quote_polling.add_user_autosell(user_id, stock_symbol, value['transactionNum'], value['command'], persist=False)
+        else:
+            executor.lane_for(user_id).command_handler.restore_pending(kind, user_id, stock_symbol, value)
+
 def main():
     publisher = Publisher()
     publisher.setup_communication()
 
-    redis_cache = redis.Redis(host='redishost')
+    redis_cache = redis.Redis(host=os.environ.get("REDIS_HOST", "redishost"))
+    debug_config.attach(redis_cache) # Debug events can be switched at runtime through Redis.
+
+    # Don't consume anything until Mongo answers, and open the connections up front.
+    if connection.STORAGE != 'memory':
+        connection.wait_until_ready()
+        connection.prewarm(documents=[Accounts, *EVENT_TYPES])
+        if LOG_STORE == 'unified':
+            events_collection()
+
+    # Consuming pauses while the buffer is above its high watermark (commands sent
+    # straight from the frontends aren't limited by the manager's credits).
+    capacity = int(os.environ.get("CONSUMER_BUFFER", 1000))
+    prefetch = min(int(os.environ.get("CONSUMER_PREFETCH", 100)), capacity // 2)
+    rabbit_queue = Consumer(
+        connection_param=os.environ.get("RABBITMQ_HOST", "rabbitmq"),
+        exchange_name=os.environ["BACKEND_EXCHANGE"],
+        queue_name=os.environ["ROUTE_KEY"],
+        routing_key=os.environ["ROUTE_KEY"],
+        prefetch=prefetch,
+        queue_arguments=QUEUE_ARGUMENTS,
+        with_properties=True
+    )
+    communication = RingBuffer(
+        capacity=capacity,
+        high_watermark=capacity - prefetch,
+        low_watermark=(capacity - prefetch) // 2,
+        on_high=rabbit_queue.pause,
+        on_low=rabbit_queue.resume
+    )
+    rabbit_queue.communication = communication
+
+    # Users are sharded over the lanes. All lanes share the first handler's quote polling.
+    NUM_LANES = int(os.environ.get("NUM_LANES", 4))
+    pending_store = PendingStore(redis_cache=redis_cache, route_key=os.environ["ROUTE_KEY"])
+    command_handlers = [CMDHandler(response_publisher=publisher, redis_cache=redis_cache, pending_store=pending_store)]
+    for _ in range(1, NUM_LANES):
+        command_handlers.append(CMDHandler(response_publisher=publisher, redis_cache=redis_cache, quote_polling=command_handlers[0].quote_polling, pending_store=pending_store))
+
+    executor = LaneExecutor(command_handlers=command_handlers)
 
-    communication = ThreadCommunication(
-        buffer=[],
-        length=0,
-        mutex=Lock()
+    # Load this worker's users and auto transactions before consuming commands
+    # (or in the background when BOOTSTRAP_MODE=lazy).
+    bootstrap = Bootstrap(
+        quote_polling=command_handlers[0].quote_polling,
+        redis_cache=redis_cache,
+        worker_index=int(os.environ["WORKER_INDEX"]),
+        num_workers=int(os.environ["NUM_WORKERS"]),
+        batch_size=int(os.environ.get("BOOTSTRAP_BATCH_SIZE", 1000))
     )
-    command_handler = CMDHandler(response_publisher=publisher, redis_cache=redis_cache)
+    if os.environ.get("BOOTSTRAP_MODE", "eager") == "lazy":
+        bootstrap.run_lazy()
+    else:
+        bootstrap.run()
 
-    t_consumer = Thread(target=queue_thread, args=(communication,))
+    # Replay the pending transactions left by a previous run of this worker
+    # and by any workers whose users this worker is taking over.
+    start = time.time()
+    pending = pending_store.load()
+    for route_key in filter(None, os.environ.get("TAKE_OVER_ROUTE_KEYS", "").split(',')):
+        pending += pending_store.take_over(route_key.strip())
+    replay_pending(pending, executor, command_handlers[0].quote_polling)
+    print(f"Replayed {len(pending)} pending transactions in {time.time()-start:.3f}s")
+
+    executor.start()
+
+    credit_reporter = CreditReporter(
+        redis_cache=redis_cache,
+        route_key=os.environ["ROUTE_KEY"],
+        executor=executor,
+        capacity=int(os.environ.get("WORKER_CREDITS", capacity))
+    )
+    credit_reporter.start()
+
+    t_consumer = Thread(target=queue_thread, args=(rabbit_queue,))
     t_consumer.start()
 
     global EXIT_PROGRAM
     while not EXIT_PROGRAM:
-        if communication.length > 0:
-            buffer = None
-            with communication.mutex:
-                buffer = communication.buffer
-                communication.buffer = []
-                communication.length = 0
-
-            for command in buffer:
-                result = command_parse(command)
-                command_handler.handle_command(result[0], result[1], result[2])
+        # Wakes as soon as commands arrive, the timeout only lets the exit flag be checked.
+        buffer = communication.get_batch(timeout=0.5)
+        if buffer:
+            for command, properties in buffer:
+                executor.submit(command, properties)
 
             sys.stdout.flush()
 
-        else:
-            time.sleep(0.1)
-
+    executor.stop()
     t_consumer.join()
 
 if __name__ == "__main__":
@@ -0,0 +1,156 @@
+import os
+import threading
+from collections import deque
+
+# Commands from the web frontend are tagged INTERACTIVE_PRIORITY, workload files BULK_PRIORITY.
+# The worker queues are priority queues up to MAX_PRIORITY, so RabbitMQ delivers waiting
+# interactive commands first. Must match manager/src/priority.py.
+MAX_PRIORITY = 5
+INTERACTIVE_PRIORITY = 5
+BULK_PRIORITY = 0
+QUEUE_ARGUMENTS = {"x-max-priority": MAX_PRIORITY}
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+# Commands taken from each lane per round when both have commands waiting.
+# At least 1, a lane with no quantum would never be popped.
+WEIGHTS = {
+    INTERACTIVE: max(1, int(os.environ.get('INTERACTIVE_WEIGHT', 8))),
+    BULK: 1
+}
+
+
+def lane_of(properties) -> str:
+    if properties is not None and (properties.priority or 0) >= INTERACTIVE_PRIORITY:
+        return INTERACTIVE
+    return BULK
+
+def ingress_time(properties):
+    ''' Time the frontend published the command, or None. '''
+    if properties is None or not properties.headers:
+        return None
+    return properties.headers.get('ingress')
+
+def sequence(properties):
+    ''' The manager's sequence number for this worker (see credits.AppliedWatermark), or None. '''
+    if properties is None or not properties.headers:
+        return None
+    return properties.headers.get('seq')
+
+def sequence_base(properties):
+    ''' Sequence numbers the manager sent this worker's previous sessions (see credits.AppliedWatermark), or None. '''
+    if properties is None or not properties.headers:
+        return None
+    return properties.headers.get('base')
+
+def is_fence(properties) -> bool:
+    ''' The empty command the manager sends after this worker restarted (see manager/src/balancer.py). '''
+    return properties is not None and bool(properties.headers) and bool(properties.headers.get('fence'))
+
+
+class WeightedFairQueue:
+    '''
+    One FIFO per priority lane, popped by weighted round robin: up to
+    weights[lane] items are taken from a lane before moving to the next one
+    that has items. Bulk commands keep moving while interactive ones jump ahead.
+    '''
+
+    def __init__(self, weights=WEIGHTS):
+        self._weights = weights
+        self._order = list(weights)
+        self._queues = {lane: deque() for lane in self._order}
+        self._current = 0
+        self._quantum = weights[self._order[0]]
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def lane_length(self, lane) -> int:
+        return len(self._queues[lane])
+
+    def append(self, lane, item):
+        self._queues[lane].append(item)
+        self._size += 1
+
+    def popleft(self):
+        if self._size == 0:
+            raise IndexError("pop from an empty WeightedFairQueue")
+
+        while True:
+            queue = self._queues[self._order[self._current]]
+            if queue and self._quantum > 0:
+                self._quantum -= 1
+                self._size -= 1
+                return queue.popleft()
+            self._current = (self._current + 1) % len(self._order)
+            self._quantum = self._weights[self._order[self._current]]
+
+
+class PriorityLaneQueue:
+    '''
+    Blocking, bounded WeightedFairQueue with the parts of queue.Queue the
+    executor uses (put, get, task_done, join, qsize).
+    '''
+
+    def __init__(self, maxsize=0, weights=WEIGHTS):
+        self.maxsize = maxsize
+        self._items = WeightedFairQueue(weights)
+        self._unfinished = 0
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+        self._all_done = threading.Condition(self._mutex)
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def lane_length(self, lane) -> int:
+        return self._items.lane_length(lane)
+
+    def put(self, item, lane=BULK):
+        with self._not_full:
+            while self.maxsize > 0 and len(self._items) >= self.maxsize:
+                self._not_full.wait()
+            self._items.append(lane, item)
+            self._unfinished += 1
+            self._not_empty.notify()
+
+    def get(self):
+        with self._not_empty:
+            while len(self._items) == 0:
+                self._not_empty.wait()
+            item = self._items.popleft()
+            self._not_full.notify()
+            return item
+
+    def task_done(self):
+        with self._all_done:
+            self._unfinished -= 1
+            if self._unfinished <= 0:
+                self._all_done.notify_all()
+
+    def join(self):
+        with self._all_done:
+            while self._unfinished > 0:
+                self._all_done.wait()
+
+
+class LatencyStats:
+    ''' Recent end-to-end latencies (frontend publish to command finished) per priority lane. '''
+    SAMPLES = 10000 # Per lane
+
+    def __init__(self):
+        self._samples = {lane: deque(maxlen=self.SAMPLES) for lane in WEIGHTS}
+        self.counts = {lane: 0 for lane in WEIGHTS}
+
+    def record(self, lane, seconds):
+        self._samples[lane].append(seconds)
+        self.counts[lane] += 1
+
+    def percentiles(self, lane, points=(50, 99)) -> list:
+        ''' Milliseconds, 0 when there are no samples. '''
+        samples = sorted(self._samples[lane])
+        if not samples:
+            return [0.0 for _ in points]
+        return [samples[min(len(samples) - 1, len(samples) * p // 100)] * 1000 for p in points]
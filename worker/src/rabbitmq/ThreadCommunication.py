@@ -1,8 +0,0 @@
-from dataclasses import dataclass
-import threading
-
-@dataclass
-class ThreadCommunication:
-    buffer: list
-    length: int
-    mutex: threading.Lock
\ No newline at end of file
@@ -1,42 +1,49 @@
 import sys
 import os
 import pika
-import queue
-import time
 import functools
 import threading
-from rabbitmq.ThreadCommunication import ThreadCommunication
+from rabbitmq.ring_buffer import RingBuffer
+from rabbitmq.transport import LocalPublisher
 
 class Publisher:
-    def __init__(self):
-        self._send_address = "rabbitmq"
+    BUFFER_CAPACITY = 100000
+    # Marks the responses to commands taken from the worker queue. The manager counts
+    # only these against the commands sent, not trigger or timeout notifications.
+    ROUTED = pika.BasicProperties(headers={'routed': 1})
+
+    def __init__(self, broker=None):
+        self._send_address = os.environ.get("RABBITMQ_HOST", "rabbitmq")
+        self.broker = broker # LocalBroker when running in one process, RabbitMQ otherwise
         self.communication = None
         self.publisher = None
         self.t_publisher = None
 
     def setup_communication(self):
-        self.communication = ThreadCommunication(
-            buffer = [],
-            length=0,
-            mutex=threading.Lock()
-        )
-
-        self.publisher = RabbitPublisher(
-            connection_param=self._send_address,
-            exchange_name=os.environ["CONFIRMS_EXCHANGE"],
-            communication = self.communication
-        )
+        self.communication = RingBuffer(capacity=self.BUFFER_CAPACITY)
+
+        if self.broker is not None:
+            self.publisher = LocalPublisher(
+                broker=self.broker,
+                exchange_name=os.environ["CONFIRMS_EXCHANGE"],
+                communication=self.communication,
+                routing_key=""
+            )
+        else:
+            self.publisher = RabbitPublisher(
+                connection_param=self._send_address,
+                exchange_name=os.environ["CONFIRMS_EXCHANGE"],
+                communication = self.communication
+            )
+        self.communication.on_not_empty = self.publisher.wake
         self.t_publisher = threading.Thread(target=self.publisher.run)
         self.t_publisher.start()
 
-    def send(self, message: str):
-        with self.communication.mutex:
-            self.communication.buffer.append(message)
-            self.communication.length += 1
+    def send(self, message: str, routed=False):
+        self.communication.put((message, self.ROUTED if routed else None))
 
 class RabbitPublisher():
-    QUICK_SEND = 0.01
-    SLOW_SEND = 2.0
+    PUBLISH_BATCH = 1000 # Max messages published per ioloop callback
 
     def __init__(self, connection_param, exchange_name, communication):
         self._connection = None
@@ -45,7 +52,7 @@ class RabbitPublisher():
         self._connection_param = connection_param
 
         self.communication = communication
-        self._publish_buffer = [] # Tuple(routing_key, message)
+        self._publish_buffer = [] # Tuple(message, properties)
         self._deliveries = {}
         self._acked = 0
         self._nacked = 0
@@ -103,7 +110,8 @@ class RabbitPublisher():
         """
         print(f"{self._connection_param}: Issuing consumer related RPC commands")
         # self._channel.confirm_delivery(self.on_delivery_confirmation)
-        self.schedule_next_message(self.SLOW_SEND)
+        # Send whatever was buffered while the channel was down.
+        self.publish_message()
 
     def on_delivery_confirmation(self, method_frame):
         conf_message = self._deliveries.get(method_frame.method.delivery_tag)
@@ -116,37 +124,36 @@ class RabbitPublisher():
             sys.stdout.flush()
             self._nacked += 1
 
-    def schedule_next_message(self, publish_interval):
-        #self._connection.ioloop.call_soon(self.publish_message)
-        self._connection.ioloop.call_later(publish_interval, self.publish_message)
+    def wake(self):
+        """Called from the sending thread when the buffer stops being empty.
+        Publishing is scheduled on the ioloop thread.
+        """
+        connection = self._connection
+        if connection is not None:
+            connection.ioloop.add_callback_threadsafe(self.publish_message)
 
     def publish_message(self):
-        if self._channel is None or self.communication.length <= 0:
-            self.schedule_next_message(self.SLOW_SEND)
-        else:
-            with self.communication.mutex:
-                self._publish_buffer = self.communication.buffer
-                self.communication.buffer = []
-                self.communication.length = 0
-
-            for data in self._publish_buffer:
-                routing_key = "confirm"
-                message = data
-
-                self._channel.basic_publish(
-                    exchange=self._exchange,
-                    routing_key="",#routing_key,
-                    body=message,
-                    properties=pika.BasicProperties(),
-                    mandatory=True
-                )
-
-                # self._message_number += 1
-                # self._deliveries.update({self._message_number: message})
-
-            self.schedule_next_message(self.QUICK_SEND)
-
-
+        if self._channel is None:
+            return
+
+        self._publish_buffer = self.communication.get_batch(max_items=self.PUBLISH_BATCH, timeout=0)
+        for message, properties in self._publish_buffer:
+            routing_key = "confirm"
+
+            self._channel.basic_publish(
+                exchange=self._exchange,
+                routing_key="",#routing_key,
+                body=message,
+                properties=properties or pika.BasicProperties(),
+                mandatory=True
+            )
+
+            # self._message_number += 1
+            # self._deliveries.update({self._message_number: message})
+
+        # Let the ioloop handle other events before sending the rest.
+        if len(self.communication) > 0:
+            self._connection.ioloop.add_callback_threadsafe(self.publish_message)
 
     def run(self):
         """Run the example code by connecting and then starting the IOLoop.
@@ -0,0 +1,155 @@
+import threading
+import time
+
+
+class RingBuffer:
+    '''
+    Bounded FIFO used to hand messages between threads (pika IO threads, the main
+    loop and the command lanes). A fixed size ring guarded by one lock with
+    condition variables, so consumers block in get_batch instead of polling
+    with sleeps and producers block in put/put_batch while the buffer is full.
+
+    Optional callbacks are called outside the lock by the thread that caused the change:
+        on_not_empty: the buffer went from empty to non empty.
+        on_high: occupancy reached high_watermark.
+        on_low: occupancy dropped back to low_watermark after reaching high_watermark.
+    '''
+
+    def __init__(self, capacity, high_watermark=None, low_watermark=None, on_high=None, on_low=None, on_not_empty=None):
+        if capacity <= 0:
+            raise ValueError("RingBuffer capacity must be positive")
+
+        self.capacity = capacity
+        self.high_watermark = high_watermark if high_watermark is not None else capacity
+        self.low_watermark = low_watermark if low_watermark is not None else self.high_watermark // 2
+        self.on_high = on_high
+        self.on_low = on_low
+        self.on_not_empty = on_not_empty
+
+        self._items = [None] * capacity
+        self._head = 0 # Next item to get
+        self._size = 0
+        self._closed = False
+        self._above_high = False
+
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+
+        # Stats
+        self.total_put = 0
+        self.total_get = 0
+        self.peak = 0
+        self.put_wait_time = 0.0 # Seconds producers spent blocked on a full buffer
+        self.high_count = 0
+
+    def __len__(self):
+        return self._size
+
+    def put(self, item, timeout=None) -> bool:
+        ''' Adds one item, blocking while the buffer is full. Returns False on timeout or close. '''
+        return self.put_batch((item,), timeout=timeout) == 1
+
+    def put_batch(self, items, timeout=None) -> int:
+        '''
+        Adds the items in order, blocking while the buffer is full.
+        Returns the number of items added, which is less than len(items) only on timeout or close.
+        '''
+        added = 0
+        events = []
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._mutex:
+            count = len(items)
+            while added < count:
+                if self._closed:
+                    break
+
+                if self._size == self.capacity:
+                    waited = time.monotonic()
+                    remaining = None if deadline is None else deadline - waited
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self._not_full.wait(remaining)
+                    self.put_wait_time += time.monotonic() - waited
+                    continue
+
+                was_empty = self._size == 0
+                space = min(self.capacity - self._size, count - added)
+                for i in range(space):
+                    self._items[(self._head + self._size + i) % self.capacity] = items[added + i]
+                self._size += space
+                added += space
+                self.total_put += space
+                if self._size > self.peak:
+                    self.peak = self._size
+
+                self._not_empty.notify()
+                if was_empty and self.on_not_empty is not None:
+                    events.append(self.on_not_empty)
+                if not self._above_high and self._size >= self.high_watermark:
+                    self._above_high = True
+                    self.high_count += 1
+                    if self.on_high is not None:
+                        events.append(self.on_high)
+
+        for callback in events:
+            callback()
+        return added
+
+    def get_batch(self, max_items=None, timeout=None) -> list:
+        '''
+        Removes and returns up to max_items (all by default) items, blocking until at
+        least one is available. Returns an empty list on timeout or once closed and empty.
+        A timeout of 0 never blocks.
+        '''
+        events = []
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._mutex:
+            while self._size == 0:
+                if self._closed:
+                    return []
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return []
+                self._not_empty.wait(remaining)
+
+            count = self._size if max_items is None else min(max_items, self._size)
+            batch = [None] * count
+            for i in range(count):
+                index = (self._head + i) % self.capacity
+                batch[i] = self._items[index]
+                self._items[index] = None
+            self._head = (self._head + count) % self.capacity
+            self._size -= count
+            self.total_get += count
+
+            self._not_full.notify_all()
+            if self._above_high and self._size <= self.low_watermark:
+                self._above_high = False
+                if self.on_low is not None:
+                    events.append(self.on_low)
+
+        for callback in events:
+            callback()
+        return batch
+
+    def close(self):
+        ''' Wakes every blocked producer and consumer. Items already buffered can still be read. '''
+        with self._mutex:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+    def stats(self) -> dict:
+        return {
+            'size': self._size,
+            'capacity': self.capacity,
+            'occupancy': self._size / self.capacity,
+            'peak': self.peak,
+            'total_put': self.total_put,
+            'total_get': self.total_get,
+            'put_wait_time': self.put_wait_time,
+            'high_count': self.high_count
+        }
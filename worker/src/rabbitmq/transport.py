@@ -0,0 +1,163 @@
+import threading
+from collections import deque
+
+''' In-process stand ins for RabbitMQ, used to run the frontend, manager and
+workers in one process (see single_node.py at the root of the repo).
+LocalConsumer and LocalPublisher have the same interface as the RabbitMQ
+Consumer and Publisher, so they can be swapped in wherever those are created.
+Must match manager/src/transport.py and worker/src/rabbitmq/transport.py.
+'''
+
+
+class LocalQueue:
+    '''
+    A queue bound to a LocalBroker exchange. With x-max-priority in its arguments
+    higher priority messages are delivered first, like RabbitMQ's priority queues.
+    '''
+
+    def __init__(self, arguments=None):
+        self.max_priority = (arguments or {}).get('x-max-priority', 0)
+        self._levels = [deque() for _ in range(self.max_priority + 1)] # FIFO per priority
+        self._size = 0
+        self._not_empty = threading.Condition()
+
+    def __len__(self):
+        return self._size
+
+    def put(self, body, properties=None):
+        priority = getattr(properties, 'priority', None) or 0
+        with self._not_empty:
+            self._levels[min(priority, self.max_priority)].append((body, properties))
+            self._size += 1
+            self._not_empty.notify()
+
+    def get_batch(self, max_items, timeout=None) -> list:
+        ''' Up to max_items (body, properties) tuples, highest priority first. Empty on timeout. '''
+        with self._not_empty:
+            if self._size == 0:
+                self._not_empty.wait(timeout)
+
+            batch = []
+            for level in reversed(self._levels):
+                while level and len(batch) < max_items:
+                    batch.append(level.popleft())
+            self._size -= len(batch)
+            return batch
+
+
+class LocalBroker:
+    '''
+    Routes published messages to the queues bound to an exchange: every queue
+    for fanout exchanges, the queues bound with the routing key otherwise.
+    Messages nobody is bound for are dropped, so consumers have to be created
+    before anything is published.
+    '''
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._queues = {} # Queue name -> LocalQueue
+        self._bindings = {} # Exchange name -> list of (routing key, LocalQueue)
+        self._fanout = set() # Fanout exchange names
+        self.published = 0
+        self.dropped = 0
+
+    def declare(self, exchange_name, queue_name, routing_key, exchange_type='direct', arguments=None) -> LocalQueue:
+        with self._mutex:
+            queue = self._queues.get(queue_name)
+            if queue is None:
+                queue = LocalQueue(arguments)
+                self._queues[queue_name] = queue
+            if exchange_type == 'fanout':
+                self._fanout.add(exchange_name)
+            bindings = self._bindings.setdefault(exchange_name, [])
+            if (routing_key, queue) not in bindings:
+                bindings.append((routing_key, queue))
+            return queue
+
+    def publish(self, exchange_name, routing_key, body, properties=None):
+        fanout = exchange_name in self._fanout
+        routed = False
+        for key, queue in self._bindings.get(exchange_name, ()):
+            if fanout or key == routing_key:
+                queue.put(body, properties)
+                routed = True
+
+        self.published += 1
+        if not routed:
+            self.dropped += 1
+
+
+class LocalConsumer:
+    ''' Consumer that reads from a LocalBroker queue. The queue is declared and bound when it is created. '''
+    _POLL = 0.5 # Seconds, how often a paused or idle consumer checks whether it was stopped
+
+    def __init__(self, broker, exchange_name, queue_name, routing_key, exchange_type='direct', communication=None, call_on_callback=None, prefetch=1000, queue_arguments=None, with_properties=False):
+        self._queue = broker.declare(exchange_name, queue_name, routing_key, exchange_type, queue_arguments)
+        self._stopping = False
+        self._resumed = threading.Event()
+        self._resumed.set()
+        self.prefetch = prefetch # Messages taken from the queue at a time
+        self.pauses = 0
+        self._with_properties = with_properties # Buffer (and call back with) (body, properties) instead of the body
+        self.communication = communication
+        self._call_on_callback = call_on_callback
+
+    def run(self):
+        while not self._stopping:
+            if not self._resumed.wait(self._POLL):
+                continue
+
+            for body, properties in self._queue.get_batch(self.prefetch, timeout=self._POLL):
+                data = body.decode() if isinstance(body, bytes) else body
+                if self.communication is not None:
+                    # Only blocks if more than prefetch messages arrive after pause().
+                    self.communication.put((data, properties) if self._with_properties else data)
+
+                if self._call_on_callback is not None:
+                    self._call_on_callback((data, properties) if self._with_properties else data)
+
+    ''' Messages wait in the queue instead of in this process until resume(). Can be called from any thread. '''
+    def pause(self):
+        if self._resumed.is_set():
+            self._resumed.clear()
+            self.pauses += 1
+
+    def resume(self):
+        self._resumed.set()
+
+    def stop(self):
+        self._stopping = True
+
+
+class LocalPublisher:
+    '''
+    Publisher that hands messages to a LocalBroker. communication holds
+    (routing key, message[, properties]) tuples like the RabbitMQ Publisher's,
+    or (message, properties) when a routing key is given (the worker's confirms).
+    '''
+    PUBLISH_BATCH = 1000
+    _POLL = 0.5 # Seconds
+
+    def __init__(self, broker, exchange_name, communication, routing_key=None):
+        self._broker = broker
+        self._exchange = exchange_name
+        self._routing_key = routing_key
+        self.communication = communication
+        self._stopping = False
+
+    def wake(self):
+        ''' Nothing to do, run() blocks on the buffer. Kept for the RabbitMQ Publisher's interface. '''
+
+    def run(self):
+        while not self._stopping:
+            for data in self.communication.get_batch(max_items=self.PUBLISH_BATCH, timeout=self._POLL):
+                if self._routing_key is not None:
+                    self._broker.publish(self._exchange, self._routing_key, data[0], data[1])
+                else:
+                    properties = data[2] if len(data) > 2 else None
+                    self._broker.publish(self._exchange, data[0], data[1], properties)
+
+        print("Stopping publisher thread")
+
+    def stop(self):
+        self._stopping = True